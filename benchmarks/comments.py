@@ -0,0 +1,102 @@
+"""
+Measure the prefilter skipping the url regexes, and parsing the markup, for
+comments which cannot contain urls, on a generated corpus of short comments
+where most have no links.
+
+    $ python benchmarks/comments.py [--comments N] [--links F] [--repeat N]
+
+Each function is run over every comment, with and without the prefilter.
+Responses come from an in-memory provider, so only the parsing is measured.
+"""
+import argparse
+import contextlib
+import random
+import timeit
+from unittest import mock
+
+from common import make_registry
+
+from micawber.parsers import extract
+from micawber.parsers import extract_html
+from micawber.parsers import html_engines
+from micawber.parsers import lxml_html
+from micawber.parsers import parse_html
+from micawber.parsers import parse_text
+
+
+def make_comments(count, links, seed=0):
+    # Comments of one to a few short paragraphs, a fraction of which link to
+    # a video or to some other page. Returns the text and html versions.
+    rng = random.Random(seed)
+    words = ('lorem ipsum dolor sit amet consectetur adipiscing elit sed do '
+             'eiusmod tempor incididunt ut labore et dolore magna aliqua '
+             'thanks great post +1 agreed :) why?').split()
+
+    def sentence():
+        return ' '.join(rng.choice(words) for _ in range(rng.randint(3, 25)))
+
+    texts, htmls = [], []
+    for i in range(count):
+        paragraphs = [sentence() for _ in range(rng.choice((1, 1, 1, 2, 3)))]
+        if rng.random() < links:
+            if rng.random() < 0.5:
+                url = 'https://www.youtube.com/watch?v=%s' % rng.randrange(200)
+            else:
+                url = 'https://example.com/post/%s' % i
+            if rng.random() < 0.5:
+                paragraphs.append(url)
+            else:
+                paragraphs[-1] += ' see %s' % url
+        texts.append('\n\n'.join(paragraphs))
+        htmls.append(''.join(
+            '<p>%s%s</p>' % (p.replace(' :)', ' &amp; :)'),
+                             '<br>' if rng.random() < 0.1 else '')
+            for p in paragraphs))
+    return texts, htmls
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--comments', type=int, default=5000)
+    parser.add_argument('--links', type=float, default=0.05,
+                        help='fraction of comments containing a link')
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    pr = make_registry()
+    texts, htmls = make_comments(args.comments, args.links)
+    print('%s comments, %s with links' % (
+        len(texts), sum('http' in text for text in texts)))
+
+    def run(fn, documents, **kwargs):
+        return [fn(document, pr, **kwargs) for document in documents]
+
+    benchmarks = [('parse_text', parse_text, texts, {}),
+                  ('extract', extract, texts, {})]
+    for engine in html_engines:
+        if engine == 'lxml' and lxml_html is None:
+            continue
+        benchmarks.append(('parse_html %s' % engine, parse_html, htmls,
+                           {'engine': engine}))
+        benchmarks.append(('extract_html %s' % engine, extract_html, htmls,
+                           {'engine': engine}))
+
+    # Without the prefilter, every document is considered to contain urls.
+    unfiltered = mock.patch.multiple('micawber.parsers',
+                                     _has_urls=lambda text: True,
+                                     _markup_has_urls=lambda html: True)
+
+    for name, fn, documents, kwargs in benchmarks:
+        timings = []
+        for prefilter in (False, True):
+            with contextlib.nullcontext() if prefilter else unfiltered:
+                timings.append(min(timeit.repeat(
+                    lambda: run(fn, documents, **kwargs), number=1,
+                    repeat=args.repeat)))
+        print('%-20s %9.2fms -> %9.2fms (%.1fx)' % (
+            name, timings[0] * 1000, timings[1] * 1000,
+            timings[0] / timings[1]))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,27 @@
+"""
+Setup shared by the benchmarks: micawber is imported from the checkout, and
+responses come from an in-memory provider, so only micawber itself is
+measured. Benchmarks import this module before micawber.
+"""
+import json
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from micawber import Provider
+from micawber import ProviderRegistry
+
+
+class MemoryProvider(Provider):
+    def fetch(self, url):
+        return json.dumps({'type': 'video', 'title': 'A video',
+                           'html': '<iframe src="https://example.com/"></iframe>'})
+
+
+def make_registry():
+    # Youtube and vimeo links are embedded, others are only urlized.
+    pr = ProviderRegistry()
+    pr.register(r'https?://(?:www\.)?(?:youtube|vimeo)\.com/\S+',
+                MemoryProvider('https://example.com/oembed'))
+    return pr
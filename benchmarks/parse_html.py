@@ -0,0 +1,73 @@
+"""
+Compare the parse_html() engines on a large generated page: "soup" builds a
+BeautifulSoup tree, "stream" rewrites the markup in a single pass and "lxml"
+(when installed) builds an lxml tree.
+
+    $ python benchmarks/parse_html.py [--sections N] [--repeat N]
+
+Responses come from an in-memory provider, so only the parsing is measured.
+"""
+import argparse
+import random
+import timeit
+
+from common import make_registry
+
+from micawber.parsers import html_engines
+from micawber.parsers import lxml_html
+from micawber.parsers import parse_html
+from micawber.parsers import url_re
+
+
+def make_page(sections, seed=0):
+    rng = random.Random(seed)
+    words = ('lorem ipsum dolor sit amet consectetur adipiscing elit sed do '
+             'eiusmod tempor incididunt ut labore et dolore magna aliqua').split()
+
+    def sentence():
+        return ' '.join(rng.choice(words) for _ in range(rng.randint(8, 30)))
+
+    parts = ['<!DOCTYPE html><html><head><title>Page</title>'
+             '<style>body { margin: 0 }</style></head><body>'
+             '<nav><ul>%s</ul></nav>' % ''.join(
+                 '<li><a href="/section/%s">Section %s</a></li>' % (i, i)
+                 for i in range(20))]
+    for i in range(sections):
+        parts.append('<section class="post"><h2>%s</h2>' % sentence())
+        for j in range(rng.randint(2, 6)):
+            text = sentence()
+            if rng.random() < 0.2:
+                text += ' https://www.youtube.com/watch?v=%s' % rng.randrange(200)
+            if rng.random() < 0.1:
+                text += ' see <a href="https://example.com/%s">this</a>' % j
+            parts.append('<p>%s <em>%s</em> &amp; %s</p>' % (
+                text, rng.choice(words), sentence()))
+        if rng.random() < 0.2:
+            parts.append('<p>https://vimeo.com/%s</p>' % rng.randrange(200))
+        parts.append('<img src="/img/%s.png" alt="">'
+                     '<script>track(%s)</script></section>' % (i, i))
+    parts.append('</body></html>')
+    return '\n'.join(parts)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--sections', type=int, default=2000)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    pr = make_registry()
+    page = make_page(args.sections)
+    print('Page: %s bytes, %s urls' % (len(page), len(url_re.findall(page))))
+
+    for engine in html_engines:
+        if engine == 'lxml' and lxml_html is None:
+            continue
+        timings = timeit.repeat(lambda: parse_html(page, pr, engine=engine),
+                                number=1, repeat=args.repeat)
+        print('%-8s best of %s: %.2fms' % (engine, args.repeat,
+                                          min(timings) * 1000))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,114 @@
+"""
+Compare parse_text() with the line-by-line implementation it replaced, which
+ran the url regex over each line at least twice.
+
+    $ python benchmarks/parse_text.py [--paragraphs N] [--repeat N]
+
+Responses come from an in-memory provider, so only the parsing is measured.
+"""
+import argparse
+import random
+import timeit
+
+from common import make_registry
+
+from micawber.exceptions import ProviderException
+from micawber.parsers import extract
+from micawber.parsers import full_handler
+from micawber.parsers import inline_handler
+from micawber.parsers import parse_text
+from micawber.parsers import standalone_url_re
+from micawber.parsers import url_re
+from micawber.parsers import urlize
+
+
+def legacy_parse_text_full(text, providers, urlize_all=True,
+                           handler=full_handler, urlize_params=None,
+                           **params):
+    all_urls, extracted_urls = extract(text, providers, **params)
+    replacements = {}
+    urlize_params = urlize_params or {}
+
+    for url in all_urls:
+        if url in extracted_urls:
+            replacements[url] = handler(url, extracted_urls[url], **params)
+        elif urlize_all:
+            replacements[url] = urlize(url, **urlize_params)
+
+    return url_re.sub(lambda m: replacements.get(m.group(), m.group()), text)
+
+
+def legacy_parse_text(text, providers, urlize_all=True, handler=full_handler,
+                      block_handler=inline_handler, urlize_params=None,
+                      **params):
+    lines = text.splitlines()
+    parsed = []
+    urlize_params = urlize_params or {}
+
+    for line in lines:
+        if standalone_url_re.match(line):
+            url = line.strip()
+            try:
+                response = providers.request(url, **params)
+            except ProviderException:
+                if urlize_all:
+                    line = urlize(url, **urlize_params)
+            else:
+                line = handler(url, response, **params)
+        elif block_handler is not None:
+            line = legacy_parse_text_full(line, providers, urlize_all,
+                                          block_handler,
+                                          urlize_params=urlize_params,
+                                          **params)
+
+        parsed.append(line)
+
+    return '\n'.join(parsed)
+
+
+def make_document(paragraphs, seed=0):
+    rng = random.Random(seed)
+    words = ('lorem ipsum dolor sit amet consectetur adipiscing elit sed do '
+             'eiusmod tempor incididunt ut labore et dolore magna aliqua').split()
+    lines = []
+    for i in range(paragraphs):
+        sentence = [rng.choice(words) for _ in range(rng.randint(8, 40))]
+        if rng.random() < 0.3:
+            sentence.insert(rng.randrange(len(sentence)),
+                            'https://www.youtube.com/watch?v=%s' %
+                            rng.randrange(200))
+        if rng.random() < 0.2:
+            sentence.insert(rng.randrange(len(sentence)),
+                            'https://example.com/page/%s' % i)
+        lines.append(' '.join(sentence))
+        if rng.random() < 0.1:
+            lines.append('https://vimeo.com/%s' % rng.randrange(200))
+        lines.append('')
+    return '\n'.join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--paragraphs', type=int, default=5000)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    pr = make_registry()
+    document = make_document(args.paragraphs)
+    print('Document: %s bytes, %s lines, %s urls' % (
+        len(document), document.count('\n') + 1,
+        len(url_re.findall(document))))
+
+    assert parse_text(document, pr) == legacy_parse_text(document, pr)
+    assert parse_text(document, pr, block_handler=None) == \
+        legacy_parse_text(document, pr, block_handler=None)
+
+    for name, fn in (('legacy', legacy_parse_text), ('parse_text', parse_text)):
+        timings = timeit.repeat(lambda: fn(document, pr), number=1,
+                                repeat=args.repeat)
+        print('%-12s best of %s: %.2fms' % (name, args.repeat,
+                                            min(timings) * 1000))
+
+
+if __name__ == '__main__':
+    main()
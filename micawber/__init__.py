@@ -1,13 +1,25 @@
 __version__ = '0.7.0'
 
 from micawber.cache import Cache
+from micawber.cache import LRUCache
 from micawber.cache import PickleCache
+from micawber.cache import SqliteCache
+from micawber.cache import TieredCache
 from micawber.exceptions import ProviderException
 from micawber.exceptions import InvalidResponseException
+from micawber.exceptions import RateLimitException
+from micawber.limiter import Limiter
+from micawber.metrics import Metrics
+from micawber.parsers import aextract
+from micawber.parsers import aextract_html
+from micawber.parsers import aparse_html
+from micawber.parsers import aparse_text
+from micawber.parsers import aparse_text_full
 from micawber.parsers import extract
 from micawber.parsers import extract_html
 from micawber.parsers import parse_text
 from micawber.parsers import parse_text_full
+from micawber.parsers import parse_text_stream
 from micawber.parsers import parse_html
 from micawber.providers import Provider
 from micawber.providers import ProviderRegistry
@@ -16,3 +28,4 @@ from micawber.providers import bootstrap_embedly
 from micawber.providers import bootstrap_iframely
 from micawber.providers import bootstrap_noembed
 from micawber.providers import bootstrap_oembed
+from micawber.transport import PooledTransport
@@ -1,24 +1,159 @@
+import asyncio
+import json
+import math
 import pickle
+import sqlite3
+import threading
+import time
+import uuid
+import zlib
+from collections import OrderedDict
 try:
     from redis import Redis
 except ImportError:
     Redis = None
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+try:
+    import lz4.frame as lz4_frame
+except ImportError:
+    lz4_frame = None
 
 
 class Cache(object):
+    # Expiration times by key. Subclasses which only set up _cache themselves
+    # get theirs on the first write with a timeout.
+    _expires = None
+
     def __init__(self):
         self._cache = {}
+        self._expires = {}
 
     def get(self, k):
+        if self._expires:
+            expires = self._expires.get(k)
+            if expires is not None and expires <= time.time():
+                self._cache.pop(k, None)
+                self._expires.pop(k, None)
+                return None
         return self._cache.get(k)
 
-    def set(self, k, v):
+    def set(self, k, v, timeout=None):
         self._cache[k] = v
+        if timeout:
+            if self._expires is None:
+                self._expires = {}
+            self._expires[k] = time.time() + timeout
+        elif self._expires:
+            self._expires.pop(k, None)
+
+    def delete(self, k):
+        self._cache.pop(k, None)
+        if self._expires:
+            self._expires.pop(k, None)
+
+    def get_many(self, keys):
+        # Returns a dict containing the keys that were found.
+        result = {}
+        for k in keys:
+            v = self.get(k)
+            if v is not None:
+                result[k] = v
+        return result
+
+    def set_many(self, mapping, timeout=None):
+        for k, v in mapping.items():
+            self.set(k, v, timeout)
+
+    # Async counterparts of get() and set(), used by the async request and
+    # parser functions. Caches backed by network or disk i/o should override
+    # these so the event loop is not blocked.
+    async def aget(self, k):
+        return self.get(k)
+
+    async def aset(self, k, v, timeout=None):
+        self.set(k, v, timeout)
+
+
+class LRUCache(Cache):
+    """
+    Bounded in-memory cache. When full, the least-recently used entries are
+    evicted. Safe to share between threads.
+
+    :param int max_size: maximum number of entries.
+    :param int max_bytes: approximate maximum total size of the cached values,
+        measured by the length of their pickled representation (optional).
+    :param int timeout: default expiration timeout in seconds (optional).
+    """
+    def __init__(self, max_size=1024, max_bytes=None, timeout=None):
+        self.max_size = max_size
+        self.max_bytes = max_bytes
+        self.timeout = timeout
+        # Maps key -> (value, expiration time or None, size in bytes).
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+        self._bytes = 0
+        self.hits = self.misses = self.evictions = 0
+
+    def _remove(self, k):
+        value, expires, size = self._cache.pop(k)
+        self._bytes -= size
+
+    def get(self, k):
+        with self._lock:
+            item = self._cache.get(k)
+            if item is not None:
+                if item[1] is None or item[1] > time.time():
+                    self._cache.move_to_end(k)
+                    self.hits += 1
+                    return item[0]
+                self._remove(k)
+            self.misses += 1
+
+    def set(self, k, v, timeout=None):
+        if timeout is None:
+            timeout = self.timeout
+        expires = time.time() + timeout if timeout else None
+        size = len(pickle.dumps(v)) if self.max_bytes else 0
+
+        with self._lock:
+            if k in self._cache:
+                self._remove(k)
+            self._cache[k] = (v, expires, size)
+            self._bytes += size
+
+            while self._cache and (
+                    len(self._cache) > self.max_size or
+                    (self.max_bytes and self._bytes > self.max_bytes)):
+                self._remove(next(iter(self._cache)))
+                self.evictions += 1
+
+    def delete(self, k):
+        with self._lock:
+            if k in self._cache:
+                self._remove(k)
+
+    def clear(self):
+        with self._lock:
+            self._cache.clear()
+            self._bytes = 0
+
+    def stats(self):
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'size': len(self._cache),
+                'bytes': self._bytes}
 
 
 class PickleCache(Cache):
     def __init__(self, filename='cache.db'):
         self.filename = filename
+        self._expires = {}
         self._cache = self.load()
 
     def load(self):
@@ -29,22 +164,358 @@ class PickleCache(Cache):
             # A cache that cannot be read (missing file, truncated write,
             # corrupt or incompatible pickle) is treated as empty.
             return {}
+
+        # Expiration times are saved alongside the data, older versions
+        # saved the data dict alone.
+        if (isinstance(data, tuple) and len(data) == 2 and
+                isinstance(data[0], dict) and isinstance(data[1], dict)):
+            data, self._expires = data
         return data if isinstance(data, dict) else {}
 
     def save(self):
+        now = time.time()
+        for k, expires in list(self._expires.items()):
+            if expires <= now:
+                self._cache.pop(k, None)
+                del self._expires[k]
         with open(self.filename, 'wb') as fh:
-            pickle.dump(self._cache, fh)
+            pickle.dump((self._cache, self._expires), fh)
+
+
+class TieredCache(Cache):
+    """
+    Two-level cache: a small in-process cache (by default an LRUCache) in
+    front of a shared, slower one such as RedisCache. Reads are served from
+    the first level when possible, falling back to the second and copying
+    what is found into the first. Writes go to both.
+
+    Entries are kept in the first level for at most ``timeout`` seconds, which
+    bounds how long a value changed by another process may be served. When a
+    ``channel`` is given and the second level supports publish/subscribe
+    (RedisCache does), writes are announced on the channel so that other
+    processes drop their copy right away.
+
+    :param cache: the second-level cache.
+    :param l1: the first-level cache (optional).
+    :param int timeout: maximum number of seconds to keep first-level entries.
+    :param str channel: name of the channel used for invalidation (optional).
+    """
+    def __init__(self, cache, l1=None, timeout=60, channel=None):
+        self.cache = cache
+        self.l1 = l1 if l1 is not None else LRUCache(max_size=1024)
+        self.timeout = timeout
+        self.channel = channel
+        # Identifies the messages this instance published itself.
+        self.node_id = uuid.uuid4().hex
+        self._subscription = None
+        if channel and hasattr(cache, 'subscribe'):
+            self._subscription = cache.subscribe(channel, self._invalidated)
+
+    def _l1_timeout(self, timeout):
+        if timeout and (not self.timeout or timeout < self.timeout):
+            return timeout
+        return self.timeout
+
+    def _invalidated(self, message):
+        if isinstance(message, bytes):
+            message = message.decode('utf-8')
+        node_id, _, k = message.partition(' ')
+        if node_id != self.node_id:
+            self.l1.delete(k)
+
+    def _publish(self, keys):
+        if self._subscription is not None:
+            for k in keys:
+                self.cache.publish(self.channel, '%s %s' % (self.node_id, k))
+
+    def get(self, k):
+        v = self.l1.get(k)
+        if v is None:
+            v = self.cache.get(k)
+            if v is not None:
+                self.l1.set(k, v, self.timeout)
+        return v
+
+    def set(self, k, v, timeout=None):
+        self.cache.set(k, v, timeout)
+        self.l1.set(k, v, self._l1_timeout(timeout))
+        self._publish([k])
+
+    def get_many(self, keys):
+        keys = list(keys)
+        result = self.l1.get_many(keys)
+        missing = [k for k in keys if k not in result]
+        if missing:
+            found = self.cache.get_many(missing)
+            self.l1.set_many(found, self.timeout)
+            result.update(found)
+        return result
+
+    def set_many(self, mapping, timeout=None):
+        self.cache.set_many(mapping, timeout)
+        self.l1.set_many(mapping, self._l1_timeout(timeout))
+        self._publish(mapping)
+
+    def delete(self, k):
+        self.cache.delete(k)
+        self.l1.delete(k)
+        self._publish([k])
+
+    async def aget(self, k):
+        v = self.l1.get(k)
+        if v is None:
+            v = await self.cache.aget(k)
+            if v is not None:
+                self.l1.set(k, v, self.timeout)
+        return v
+
+    async def aset(self, k, v, timeout=None):
+        await self.cache.aset(k, v, timeout)
+        self.l1.set(k, v, self._l1_timeout(timeout))
+        self._publish([k])
+
+    def close(self):
+        # Stops listening for invalidations.
+        if self._subscription is not None:
+            self._subscription.stop()
+            self._subscription = None
+
+
+def _json_dumps(v):
+    return json.dumps(v, separators=(',', ':')).encode('utf-8')
+
+
+def _json_loads(data):
+    return json.loads(data.decode('utf-8'))
+
+
+# name -> (format code, dumps, loads).
+_serializers = {
+    'pickle': (b'p', pickle.dumps, pickle.loads),
+    'json': (b'j', _json_dumps, _json_loads)}
+if msgpack is not None:
+    _serializers['msgpack'] = (
+        b'm',
+        lambda v: msgpack.packb(v, use_bin_type=True),
+        lambda data: msgpack.unpackb(data, raw=False))
+
+# name -> (format code, compress, decompress).
+_compressors = {'zlib': (b'z', zlib.compress, zlib.decompress)}
+if lz4_frame is not None:
+    _compressors['lz4'] = (b'l', lz4_frame.compress, lz4_frame.decompress)
+
+_loaders = dict((code, loads) for code, _, loads in _serializers.values())
+_decompressors = dict((code, decompress)
+                      for code, _, decompress in _compressors.values())
+
+
+class Serializer(object):
+    """
+    Converts cached values to and from bytes, for caches storing them outside
+    the process.
+
+    Values are stored with a two-byte header giving the serialization and
+    compression format, so entries written with other settings can still be
+    read. Uncompressed pickles are the exception: they are stored as-is, as
+    they always have been (pickles start with a byte no header does).
+
+    :param str serializer: "pickle", "json" or, when installed, "msgpack".
+        The json and msgpack formats are more compact and independent of the
+        python version, but only handle JSON-like data.
+    :param str compression: "zlib" or, when installed, "lz4" (optional).
+    :param int compress_threshold: minimum size, in bytes, of the serialized
+        value for it to be compressed.
+    """
+    def __init__(self, serializer='pickle', compression=None,
+                 compress_threshold=1024):
+        if serializer not in _serializers:
+            raise ValueError('Unsupported serializer "%s"' % serializer)
+        if compression is not None and compression not in _compressors:
+            raise ValueError('Unsupported compression "%s"' % compression)
+        self.serializer = serializer
+        self.compression = compression
+        self.compress_threshold = compress_threshold
+
+    def dumps(self, v):
+        code, dumps, _ = _serializers[self.serializer]
+        data = dumps(v)
+        if self.compression and len(data) >= self.compress_threshold:
+            compression_code, compress, _ = _compressors[self.compression]
+            return code + compression_code + compress(data)
+        elif code == b'p':
+            return data
+        return code + b'-' + data
+
+    def loads(self, data):
+        if data[:1] == b'\x80':
+            return pickle.loads(data)
+
+        code, compression_code, data = data[:1], data[1:2], data[2:]
+        if compression_code != b'-':
+            decompress = _decompressors.get(compression_code)
+            if decompress is None:
+                raise ValueError('Unsupported compression format %r' %
+                                 compression_code)
+            data = decompress(data)
+
+        loads = _loaders.get(code)
+        if loads is None:
+            raise ValueError('Unsupported serialization format %r' % code)
+        return loads(data)
+
+
+class SqliteCache(Cache):
+    """
+    Persistent cache stored in a SQLite database. Entries are read and written
+    individually, so opening the cache does not load it, nor does writing an
+    entry rewrite the file. The database is used in WAL mode, and may be
+    shared between threads and processes.
+
+    :param str filename: path to the database file.
+    :param int timeout: default expiration timeout in seconds (optional).
+    :param int max_size: maximum number of entries (optional). Once exceeded,
+        the least-recently written entries are removed by :py:meth:`purge`,
+        which is run every ``purge_interval`` writes.
+    :param str serializer: format values are stored in, see Serializer.
+    :param str compression: compression applied to large values.
+    """
+    purge_interval = 1000
+
+    def __init__(self, filename='cache.sqlite', timeout=None, max_size=None,
+                 serializer='pickle', compression=None):
+        self.filename = filename
+        self.timeout = timeout
+        self.max_size = max_size
+        self.serializer = Serializer(serializer, compression)
+        self._local = threading.local()
+        self._writes = 0
+        with self.conn:
+            self.conn.execute(
+                'CREATE TABLE IF NOT EXISTS cache ('
+                'key TEXT NOT NULL PRIMARY KEY, '
+                'value BLOB NOT NULL, '
+                'expires REAL)')
+            self.conn.execute(
+                'CREATE INDEX IF NOT EXISTS cache_expires ON cache (expires)')
+
+    @property
+    def conn(self):
+        # SQLite connections may not be shared between threads, each thread
+        # opens its own.
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.filename, timeout=30)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+        return conn
+
+    def close(self):
+        # Closes the connection of the calling thread.
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
+
+    def _expiration(self, timeout):
+        timeout = timeout or self.timeout
+        return time.time() + timeout if timeout else None
+
+    def get(self, k):
+        row = self.conn.execute(
+            'SELECT value FROM cache WHERE key = ? AND '
+            '(expires IS NULL OR expires > ?)', (k, time.time())).fetchone()
+        if row is not None:
+            return self.serializer.loads(row[0])
+
+    def set(self, k, v, timeout=None):
+        self.set_many({k: v}, timeout)
+
+    def get_many(self, keys):
+        keys = list(keys)
+        result = {}
+        now = time.time()
+        # SQLite limits the number of parameters of a query.
+        for i in range(0, len(keys), 500):
+            chunk = keys[i:i + 500]
+            rows = self.conn.execute(
+                'SELECT key, value FROM cache WHERE key IN (%s) AND '
+                '(expires IS NULL OR expires > ?)' %
+                ', '.join('?' * len(chunk)), chunk + [now])
+            for k, value in rows:
+                result[k] = self.serializer.loads(value)
+        return result
+
+    def set_many(self, mapping, timeout=None):
+        if not mapping:
+            return
+        expires = self._expiration(timeout)
+        rows = [(k, sqlite3.Binary(self.serializer.dumps(v)), expires)
+                for k, v in mapping.items()]
+        with self.conn:
+            self.conn.executemany(
+                'INSERT OR REPLACE INTO cache (key, value, expires) '
+                'VALUES (?, ?, ?)', rows)
+
+        self._writes += len(rows)
+        if self._writes >= self.purge_interval:
+            self._writes = 0
+            self.purge()
+
+    def delete(self, k):
+        with self.conn:
+            self.conn.execute('DELETE FROM cache WHERE key = ?', (k,))
+
+    def clear(self):
+        with self.conn:
+            self.conn.execute('DELETE FROM cache')
+
+    def purge(self):
+        """
+        Remove expired entries and, when there are more than ``max_size``,
+        the least-recently written ones.
+        """
+        with self.conn:
+            self.conn.execute('DELETE FROM cache WHERE expires <= ?',
+                              (time.time(),))
+            if self.max_size:
+                # Replacing a row assigns it a new rowid, so rowids are in
+                # the order entries were last written.
+                self.conn.execute(
+                    'DELETE FROM cache WHERE rowid IN (SELECT rowid FROM '
+                    'cache ORDER BY rowid DESC LIMIT -1 OFFSET ?)',
+                    (self.max_size,))
+
+    def vacuum(self):
+        # Purges the cache, then shrinks the database file.
+        self.purge()
+        self.conn.execute('VACUUM')
+
+    async def aget(self, k):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, self.get, k)
+
+    async def aset(self, k, v, timeout=None):
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, self.set, k, v, timeout)
 
 
 if Redis:
     class RedisCache(Cache):
         """
         :param str namespace: key prefix.
-        :param int timeout: expiration timeout in seconds
+        :param int timeout: default expiration timeout in seconds
+        :param str serializer: format values are stored in, see Serializer.
+        :param str compression: compression applied to large values.
+        :param int compress_threshold: minimum size of values to compress.
         """
-        def __init__(self, namespace='micawber', timeout=None, **conn):
+        def __init__(self, namespace='micawber', timeout=None,
+                     serializer='pickle', compression=None,
+                     compress_threshold=1024, **conn):
             self.namespace = namespace
             self.timeout = timeout
+            self.serializer = Serializer(serializer, compression,
+                                         compress_threshold)
             self.conn = Redis(**conn)
 
         def key_fn(self, k):
@@ -53,7 +524,76 @@ if Redis:
         def get(self, k):
             cached = self.conn.get(self.key_fn(k))
             if cached:
-                return pickle.loads(cached)
+                return self.serializer.loads(cached)
+
+        def expiration(self, timeout):
+            # Redis requires a whole number of seconds.
+            timeout = timeout or self.timeout
+            return int(math.ceil(timeout)) if timeout else None
+
+        def set(self, k, v, timeout=None):
+            self.conn.set(self.key_fn(k), self.serializer.dumps(v),
+                          ex=self.expiration(timeout))
+
+        def get_many(self, keys):
+            keys = list(keys)
+            if not keys:
+                return {}
+            values = self.conn.mget([self.key_fn(k) for k in keys])
+            return dict((k, self.serializer.loads(v))
+                        for k, v in zip(keys, values) if v)
+
+        def set_many(self, mapping, timeout=None):
+            if not mapping:
+                return
+            ex = self.expiration(timeout)
+            pipe = self.conn.pipeline(transaction=False)
+            for k, v in mapping.items():
+                pipe.set(self.key_fn(k), self.serializer.dumps(v), ex=ex)
+            pipe.execute()
+
+        # Deletes the lock only if it is still held with the given token,
+        # i.e. it has not expired and been acquired by someone else since.
+        unlock_script = (
+            "if redis.call('get', KEYS[1]) == ARGV[1] then "
+            "return redis.call('del', KEYS[1]) end return 0")
+
+        def lock(self, k, timeout):
+            """
+            Acquire the lock for the given key for at most ``timeout``
+            seconds, returning a token to release it with, or None if the
+            lock is held already.
+            """
+            token = uuid.uuid4().hex
+            if self.conn.set(self.key_fn('lock.%s' % k), token, nx=True,
+                             px=int(math.ceil(timeout * 1000))):
+                return token
+
+        def unlock(self, k, token):
+            self.conn.eval(self.unlock_script, 1, self.key_fn('lock.%s' % k),
+                           token)
+
+        def delete(self, k):
+            self.conn.delete(self.key_fn(k))
+
+        def publish(self, channel, message):
+            self.conn.publish(self.key_fn(channel), message)
+
+        def subscribe(self, channel, callback):
+            """
+            Call ``callback`` with each message published on the given
+            channel, from a background thread. Returns the thread, which is
+            stopped with its ``stop()`` method.
+            """
+            pubsub = self.conn.pubsub(ignore_subscribe_messages=True)
+            pubsub.subscribe(**{
+                self.key_fn(channel): lambda m: callback(m['data'])})
+            return pubsub.run_in_thread(sleep_time=1, daemon=True)
+
+        async def aget(self, k):
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(None, self.get, k)
 
-        def set(self, k, v):
-            self.conn.set(self.key_fn(k), pickle.dumps(v), ex=self.timeout)
+        async def aset(self, k, v, timeout=None):
+            loop = asyncio.get_running_loop()
+            await loop.run_in_executor(None, self.set, k, v, timeout)
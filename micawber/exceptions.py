@@ -6,3 +6,6 @@ class ProviderNotFoundException(ProviderException):
 
 class InvalidResponseException(ProviderException):
     pass
+
+class RateLimitException(ProviderException):
+    pass
@@ -0,0 +1,180 @@
+import asyncio
+import collections
+import threading
+import time
+
+from micawber.exceptions import RateLimitException
+
+
+class _AsyncWaiter(object):
+    # Wakes up a task waiting in an event loop, from any thread.
+    def __init__(self):
+        self.loop = asyncio.get_running_loop()
+        self.event = asyncio.Event()
+
+    def set(self):
+        self.loop.call_soon_threadsafe(self.event.set)
+
+    def clear(self):
+        self.event.clear()
+
+    async def wait(self, timeout):
+        try:
+            await asyncio.wait_for(self.event.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+
+
+class Limiter(object):
+    """
+    Limits the requests made to a provider to at most ``concurrency`` at a
+    time, and at most ``rate`` per second on average (a token bucket holding
+    up to ``burst`` requests). Share one instance between providers to limit
+    the requests made to their host as a whole.
+
+    Threads and asyncio tasks wait in a single queue, and are let through in
+    the order they arrived.
+
+    :param int concurrency: maximum number of requests in progress.
+    :param float rate: maximum number of requests per second.
+    :param int burst: number of requests which can be made at once, after
+        none were made for a while.
+    :param bool block: whether to wait for a slot rather than raise a
+        RateLimitException right away.
+    :param float timeout: maximum number of seconds to wait for a slot,
+        after which RateLimitException is raised.
+    """
+    def __init__(self, concurrency=None, rate=None, burst=1, block=True,
+                 timeout=None):
+        self.concurrency = concurrency
+        self.rate = rate
+        self.burst = burst
+        self.block = block
+        self.timeout = timeout
+        self._lock = threading.Lock()
+        self._waiters = collections.deque()
+        self._active = 0
+        self._tokens = burst
+        self._updated = time.monotonic()
+
+    def _delay(self):
+        # Seconds until a request can be made, None while waiting on a
+        # request in progress. Called with the lock held.
+        if self.concurrency and self._active >= self.concurrency:
+            return None
+        if self.rate:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens +
+                               (now - self._updated) * self.rate)
+            self._updated = now
+            if self._tokens < 1:
+                return (1 - self._tokens) / self.rate
+        return 0
+
+    def _take(self):
+        self._active += 1
+        if self.rate:
+            self._tokens -= 1
+
+    def _wake(self):
+        if self._waiters:
+            self._waiters[0].set()
+
+    def _try(self, waiter):
+        # Returns 0 once the waiter has been let through, else how long it
+        # should wait (None meaning until woken up).
+        with self._lock:
+            waiter.clear()
+            if self._waiters[0] is not waiter:
+                return None
+            delay = self._delay()
+            if delay == 0:
+                self._waiters.popleft()
+                self._take()
+                self._wake()
+            return delay
+
+    def _enter(self, waiter, block):
+        # Fast path, when nobody is queued.
+        with self._lock:
+            if not self._waiters and self._delay() == 0:
+                self._take()
+                return True
+            if not block:
+                raise RateLimitException('Rate limit exceeded')
+            self._waiters.append(waiter)
+            return False
+
+    def _leave(self, waiter):
+        # Gives up waiting, e.g. after a timeout or cancellation.
+        with self._lock:
+            if waiter in self._waiters:
+                self._waiters.remove(waiter)
+                self._wake()
+
+    def _wait_time(self, delay, deadline):
+        if deadline is None:
+            return delay
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            raise RateLimitException('Timed out waiting for the rate limit')
+        return remaining if delay is None else min(delay, remaining)
+
+    def acquire(self, block=None, timeout=None):
+        """
+        Wait until a request can be made, returning the number of seconds
+        spent waiting. Every call must be followed by one to release() once
+        the request is done.
+
+        :param bool block: overrides the limiter's ``block``.
+        :param float timeout: overrides the limiter's ``timeout``.
+        """
+        block = self.block if block is None else block
+        timeout = self.timeout if timeout is None else timeout
+        start = time.monotonic()
+        waiter = threading.Event()
+        if self._enter(waiter, block):
+            return 0.
+        deadline = start + timeout if timeout is not None else None
+        try:
+            while True:
+                delay = self._try(waiter)
+                if delay == 0:
+                    return time.monotonic() - start
+                waiter.wait(self._wait_time(delay, deadline))
+        except BaseException:
+            self._leave(waiter)
+            raise
+
+    async def aacquire(self, block=None, timeout=None):
+        """
+        Like acquire(), waiting without blocking the event loop.
+        """
+        block = self.block if block is None else block
+        timeout = self.timeout if timeout is None else timeout
+        start = time.monotonic()
+        waiter = _AsyncWaiter()
+        if self._enter(waiter, block):
+            return 0.
+        deadline = start + timeout if timeout is not None else None
+        try:
+            while True:
+                delay = self._try(waiter)
+                if delay == 0:
+                    return time.monotonic() - start
+                await waiter.wait(self._wait_time(delay, deadline))
+        except BaseException:
+            self._leave(waiter)
+            raise
+
+    def release(self):
+        with self._lock:
+            self._active -= 1
+            self._wake()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.release()
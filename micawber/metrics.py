@@ -0,0 +1,76 @@
+import bisect
+import threading
+
+
+class Metrics(object):
+    """
+    Counters and latency histograms collected by a :py:class:`ProviderRegistry`.
+    Safe to share between threads.
+
+    Every value is recorded under a name and an optional label, e.g. the
+    "hits" counter for each provider endpoint.
+
+    :param sink: function called with ``(kind, name, label, value)`` for every
+        value recorded, where kind is "counter" or "histogram" (optional).
+        Used to forward metrics to statsd, prometheus and the like.
+    """
+    # Upper bounds, in seconds, of the histogram buckets.
+    buckets = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25,
+               0.5, 1.0, 2.5, 5.0, 10.0)
+
+    def __init__(self, sink=None):
+        self.sink = sink
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._histograms = {}
+
+    def incr(self, name, label=None, value=1):
+        key = (name, label)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+        if self.sink is not None:
+            self.sink('counter', name, label, value)
+
+    def observe(self, name, seconds, label=None):
+        key = (name, label)
+        bucket = bisect.bisect_left(self.buckets, seconds)
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = {
+                    'count': 0,
+                    'sum': 0.,
+                    'buckets': [0] * (len(self.buckets) + 1)}
+            histogram['count'] += 1
+            histogram['sum'] += seconds
+            histogram['buckets'][bucket] += 1
+        if self.sink is not None:
+            self.sink('histogram', name, label, seconds)
+
+    def snapshot(self):
+        """
+        Return the values recorded so far, as a dict of the form::
+
+            {'counters': {name: {label: value}},
+             'histograms': {name: {label: {'count': n, 'sum': seconds,
+                                           'buckets': [(bound, n), ...]}}}}
+
+        Histogram buckets are not cumulative, the last has no upper bound.
+        """
+        bounds = self.buckets + (float('inf'),)
+        counters = {}
+        histograms = {}
+        with self._lock:
+            for (name, label), value in self._counters.items():
+                counters.setdefault(name, {})[label] = value
+            for (name, label), histogram in self._histograms.items():
+                histograms.setdefault(name, {})[label] = {
+                    'count': histogram['count'],
+                    'sum': histogram['sum'],
+                    'buckets': list(zip(bounds, histogram['buckets']))}
+        return {'counters': counters, 'histograms': histograms}
+
+    def reset(self):
+        with self._lock:
+            self._counters.clear()
+            self._histograms.clear()
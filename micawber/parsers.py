@@ -1,6 +1,9 @@
+import asyncio
 import json
 import re
+from concurrent.futures import ThreadPoolExecutor
 from html import escape
+from html.parser import HTMLParser
 
 try:
     from bs4 import BeautifulSoup, Comment
@@ -10,6 +13,12 @@ except ImportError:
     Comment = None
     bs_kwargs = replace_kwargs = {}
 
+try:
+    from lxml import etree
+    from lxml import html as lxml_html
+except ImportError:
+    etree = lxml_html = None
+
 from micawber.exceptions import ProviderException
 
 
@@ -17,6 +26,30 @@ url_pattern = '(https?://[-A-Za-z0-9+&@#/%?=~_()|!:,.;]*[-A-Za-z0-9+&@#/%=~_|])'
 url_re = re.compile(url_pattern)
 standalone_url_re = re.compile(r'^\s*' + url_pattern + r'\s*$')
 
+# Line boundaries recognized by str.splitlines(), other than "\n".
+line_break_re = re.compile('\r\n?|[\x0b\x0c\x1c\x1d\x1e\x85\u2028\u2029]')
+_line_break_chars = '\n\r\x0b\x0c\x1c\x1d\x1e\x85\u2028\u2029'
+
+# A url on its own line, or (only when the first group did not match) any
+# other url. Once line breaks are normalized to "\n", standalone_url_re
+# matches a line exactly when the first alternative matches all of it.
+_standalone_pattern = r'^[^\S\n]*' + url_pattern + r'[^\S\n]*$'
+_token_re = re.compile(_standalone_pattern + '|' + url_pattern, re.M)
+_standalone_token_re = re.compile(_standalone_pattern, re.M)
+
+def _has_urls(text):
+    # Cheap test ruling out most text without urls before any regex work:
+    # every url matched by url_re starts with "http".
+    return 'http' in text
+
+def _markup_has_urls(html):
+    # Same for markup, where the letters of "http" may also be written as
+    # numeric character references.
+    return 'http' in html or '&#' in html
+
+# Kinds of the segments yielded by _segments().
+TEXT, INLINE_URL, STANDALONE_URL = range(3)
+
 block_elements = set([
     'address', 'article', 'aside', 'blockquote', 'canvas', 'center', 'dir',
     'dd', 'div', 'dl', 'dt', 'fieldset', 'figcaption', 'figure', 'footer',
@@ -33,6 +66,13 @@ skip_elements = set([
     'head', 'script', 'style', 'svg', 'title',
 ])
 
+# Elements without content or end tag.
+void_elements = set([
+    'area', 'base', 'basefont', 'bgsound', 'br', 'col', 'command', 'embed',
+    'frame', 'hr', 'image', 'img', 'input', 'isindex', 'keygen', 'link',
+    'menuitem', 'meta', 'nextid', 'param', 'source', 'spacer', 'track', 'wbr',
+])
+
 
 def _escape_data(response_data):
     # The url and title in a provider response frequently contain end-user
@@ -63,29 +103,143 @@ def urlize(url, **params):
 
 class _RequestMemo(object):
     # Collapse repeated requests (or failures) for the same url within a
-    # single parse call, e.g. one url appearing in several paragraphs.
+    # single parse call, e.g. one url appearing in several paragraphs. Urls
+    # are compared in their canonical form, when the providers define one.
     def __init__(self, providers):
         self.providers = providers
         self.responses = {}
+        self.key = getattr(providers, 'canonical_url', None) or str
+
+    def _pending(self, urls):
+        # Maps the key of each url not requested yet to the url.
+        pending = {}
+        for url in urls:
+            key = self.key(url)
+            if key not in self.responses and key not in pending:
+                pending[key] = url
+        return pending
+
+    def _request(self, url, params):
+        try:
+            return self.providers.request(url, **params), None
+        except ProviderException as exc:
+            return None, exc
+
+    def prefetch(self, urls, executor, **params):
+        # Resolve all the given urls concurrently, using either an Executor or
+        # a thread pool of the given size.
+        pending = self._pending(urls)
+        if not pending:
+            return
+
+        def fn(url):
+            return self._request(url, params)
+
+        if isinstance(executor, int):
+            workers = min(executor, len(pending))
+            with ThreadPoolExecutor(max_workers=workers) as pool:
+                results = list(pool.map(fn, pending.values()))
+        else:
+            results = list(executor.map(fn, pending.values()))
+        self.responses.update(zip(pending, results))
+
+    async def _arequest(self, url, params):
+        try:
+            arequest = getattr(self.providers, 'arequest', None)
+            if arequest is not None:
+                return await arequest(url, **params), None
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(
+                None, lambda: self.providers.request(url, **params)), None
+        except ProviderException as exc:
+            return None, exc
+
+    async def aprefetch(self, urls, concurrency=None, timeout=None, **params):
+        # Resolve all the given urls concurrently, at most "concurrency" at a
+        # time. Requests still outstanding after "timeout" seconds are
+        # cancelled and treated as failures.
+        pending = self._pending(urls)
+        if not pending:
+            return
+
+        semaphore = asyncio.Semaphore(concurrency) if concurrency else None
+
+        async def fn(url):
+            if semaphore is None:
+                return await self._arequest(url, params)
+            async with semaphore:
+                return await self._arequest(url, params)
+
+        tasks = [asyncio.ensure_future(fn(url)) for url in pending.values()]
+        done, not_done = await asyncio.wait(tasks, timeout=timeout)
+        for task in not_done:
+            task.cancel()
+
+        for (key, url), task in zip(pending.items(), tasks):
+            if task in done:
+                self.responses[key] = task.result()
+            else:
+                exc = ProviderException('Timed out fetching "%s"' % url)
+                self.responses[key] = (None, exc)
 
     def request(self, url, **params):
-        if url in self.responses:
-            response, exc = self.responses[url]
-        else:
-            response = exc = None
-            try:
-                response = self.providers.request(url, **params)
-            except ProviderException as e:
-                exc = e
-            self.responses[url] = (response, exc)
+        key = self.key(url)
+        if key not in self.responses:
+            self.responses[key] = self._request(url, params)
+        response, exc = self.responses[key]
         if exc is not None:
             raise exc
         return response
 
-def extract(text, providers, **params):
+def _memoize(providers):
+    if isinstance(providers, _RequestMemo):
+        return providers
+    return _RequestMemo(providers)
+
+def _segments(text, inline=True):
+    # Split the text in a single pass into (kind, source, url) segments:
+    # plain text, urls on a line of their own (source being the whole line)
+    # and, when "inline" is True, the other urls. Lines are joined with "\n"
+    # and the last line break is dropped, as "\n".join(text.splitlines())
+    # would do.
+    text = line_break_re.sub('\n', text)
+    if text.endswith('\n'):
+        text = text[:-1]
+    if not _has_urls(text):
+        if text:
+            yield TEXT, text, None
+        return
+
+    pos = 0
+    for match in (_token_re if inline else _standalone_token_re).finditer(
+            text):
+        start, end = match.span()
+        if start > pos:
+            yield TEXT, text[pos:start], None
+        if match.group(1) is not None:
+            yield STANDALONE_URL, match.group(), match.group(1)
+        else:
+            yield INLINE_URL, match.group(), match.group(2)
+        pos = end
+    if pos < len(text):
+        yield TEXT, text[pos:], None
+
+def _text_urls(text, inline=True):
+    # Urls in the order parse_text() will request them. Only urls on their
+    # own line are included when "inline" is False.
+    return [url for kind, source, url in _segments(text, inline)
+            if kind != TEXT]
+
+def extract(text, providers, prefetch=None, **params):
     all_urls = set()
     urls = []
     extracted_urls = {}
+    if not _has_urls(text):
+        return urls, extracted_urls
+
+    providers = _memoize(providers)
+    if prefetch:
+        providers.prefetch(url_re.findall(text), prefetch, **params)
 
     for url in re.findall(url_re, text):
         if url in all_urls:
@@ -101,8 +255,10 @@ def extract(text, providers, **params):
     return urls, extracted_urls
 
 def parse_text_full(text, providers, urlize_all=True, handler=full_handler,
-                    urlize_params=None, **params):
-    all_urls, extracted_urls = extract(text, providers, **params)
+                    urlize_params=None, prefetch=None, **params):
+    if not _has_urls(text):
+        return text
+    all_urls, extracted_urls = extract(text, providers, prefetch, **params)
     replacements = {}
     urlize_params = urlize_params or {}
 
@@ -115,78 +271,132 @@ def parse_text_full(text, providers, urlize_all=True, handler=full_handler,
     return url_re.sub(lambda m: replacements.get(m.group(), m.group()), text)
 
 def parse_text(text, providers, urlize_all=True, handler=full_handler,
-               block_handler=inline_handler, urlize_params=None, **params):
-    lines = text.splitlines()
-    parsed = []
-    urlize_params = urlize_params or {}
-    providers = _RequestMemo(providers)
+               block_handler=inline_handler, urlize_params=None, prefetch=None,
+               **params):
+    providers = _memoize(providers)
+    if prefetch:
+        providers.prefetch(_text_urls(text, block_handler is not None),
+                           prefetch, **params)
+    return ''.join(_render_text(text, providers, urlize_all, handler,
+                                block_handler, urlize_params or {}, params))
+
+def _render_text(text, providers, urlize_all, handler, block_handler,
+                 urlize_params, params):
+    # The document is scanned once, each segment being rendered straight
+    # into the output. Inline urls are rendered once per document.
+    output = []
+    inline_html = {}
+    for kind, source, url in _segments(text, block_handler is not None):
+        if kind == TEXT:
+            output.append(source)
+            continue
+        elif kind == INLINE_URL and url in inline_html:
+            output.append(inline_html[url])
+            continue
 
-    for line in lines:
-        if standalone_url_re.match(line):
-            url = line.strip()
-            try:
-                response = providers.request(url, **params)
-            except ProviderException:
-                if urlize_all:
-                    line = urlize(url, **urlize_params)
+        try:
+            response = providers.request(url, **params)
+        except ProviderException:
+            html = urlize(url, **urlize_params) if urlize_all else source
+        else:
+            if kind == STANDALONE_URL:
+                html = handler(url, response, **params)
             else:
-                line = handler(url, response, **params)
-        elif block_handler is not None:
-            line = parse_text_full(line, providers, urlize_all, block_handler,
-                                   urlize_params=urlize_params, **params)
-
-        parsed.append(line)
-
-    return '\n'.join(parsed)
-
-def parse_html(html, providers, urlize_all=True, handler=full_handler,
-               block_handler=inline_handler, soup_class=BeautifulSoup,
-               urlize_params=None, **params):
-
+                html = block_handler(url, response, **params)
+        if kind == INLINE_URL:
+            inline_html[url] = html
+        output.append(html)
+
+    return output
+
+def parse_text_stream(lines, providers, urlize_all=True, handler=full_handler,
+                      block_handler=inline_handler, urlize_params=None,
+                      prefetch=None, window=1000, **params):
+    """
+    Like parse_text(), for text read from an iterable of lines such as a file
+    object. Yields the output in chunks, rendering ``window`` lines at a time
+    so that memory use does not depend on the size of the text. The urls in
+    each window are requested concurrently when ``prefetch`` is given.
+    """
+    if isinstance(lines, str):
+        lines = [lines]
+    urlize_params = urlize_params or {}
+    inline = block_handler is not None
+
+    def render(text):
+        # Requests are collapsed within each window only.
+        memo = _RequestMemo(providers)
+        if prefetch:
+            memo.prefetch(_text_urls(text, inline), prefetch, **params)
+        return ''.join(_render_text(text, memo, urlize_all, handler,
+                                    block_handler, urlize_params, params))
+
+    # Windows end with a line break, which is only output once the next
+    # window starts, as parse_text() drops the last one.
+    buffer = []
+    first = True
+    skip_lf = False
+    for line in lines:
+        if skip_lf and line:
+            # A "\r\n" line break spanning two windows.
+            skip_lf = False
+            if line[0] == '\n':
+                line = line[1:]
+        if not line:
+            continue
+        buffer.append(line)
+        if len(buffer) >= window and line[-1] in _line_break_chars:
+            skip_lf = line[-1] == '\r'
+            text, buffer = ''.join(buffer), []
+            if not first:
+                yield '\n'
+            first = False
+            yield render(text)
+
+    if buffer:
+        if not first:
+            yield '\n'
+        yield render(''.join(buffer))
+
+def _parse_soup(html, soup_class=BeautifulSoup):
     if not soup_class:
         raise Exception('Unable to parse HTML, please install BeautifulSoup '
                         'or beautifulsoup4, or use the text parser')
 
     soup = soup_class(html, **bs_kwargs)
-    providers = _RequestMemo(providers)
-
-    for url in soup.find_all(string=url_re):
-        if not _inside_skip(url):
-            if _is_standalone(url):
-                url_handler = handler
-            else:
-                url_handler = block_handler
+    nodes = [node for node in soup.find_all(string=_url_string)
+             if not _inside_skip(node)]
+    return soup, nodes
+
+def _render_soup(soup, nodes, providers, urlize_all, handler, block_handler,
+                 soup_class, urlize_params, params):
+    for url in nodes:
+        if _is_standalone(url):
+            url_handler = handler
+        else:
+            url_handler = block_handler
 
-            url_unescaped = (url.string
-                             .replace('<', '&lt;')
-                             .replace('>', '&gt;'))
+        url_unescaped = (url.string
+                         .replace('<', '&lt;')
+                         .replace('>', '&gt;'))
 
-            replacement = parse_text_full(
-                url_unescaped,
-                providers,
-                urlize_all,
-                url_handler,
-                urlize_params=urlize_params,
-                **params)
-            url.replace_with(soup_class(replacement, **replace_kwargs))
+        replacement = parse_text_full(
+            url_unescaped,
+            providers,
+            urlize_all,
+            url_handler,
+            urlize_params=urlize_params,
+            **params)
+        url.replace_with(soup_class(replacement, **replace_kwargs))
 
     return str(soup)
 
-def extract_html(html, providers, **params):
-    if not BeautifulSoup:
-        raise Exception('Unable to parse HTML, please install BeautifulSoup '
-                        'or use the text parser')
-
-    soup = BeautifulSoup(html, **bs_kwargs)
+def _extract_nodes(nodes, providers, params):
     all_urls = set()
     urls = []
     extracted_urls = {}
-    providers = _RequestMemo(providers)
-
-    for url in soup.find_all(string=url_re):
-        if _inside_skip(url):
-            continue
 
+    for url in nodes:
         block_all, block_ext = extract(str(url), providers, **params)
         for extracted_url in block_all:
             if extracted_url in all_urls:
@@ -198,6 +408,347 @@ def extract_html(html, providers, **params):
 
     return urls, extracted_urls
 
+class _HTMLScanner(HTMLParser):
+    # Streams through the markup once, recording the text nodes containing
+    # urls outside of skip elements, as (start, end, text, standalone) tuples
+    # where start and end are offsets in the markup. Elements are opened and
+    # closed the way BeautifulSoup's html.parser builder does.
+    def __init__(self, html):
+        super(_HTMLScanner, self).__init__(convert_charrefs=True)
+        self.html = html
+        self.nodes = []
+        self.stack = []
+        self.skip_depth = 0
+        self._data = []
+        self._start = None
+        self._line = 1
+        self._line_start = 0
+
+    def scan(self):
+        self.feed(self.html)
+        self.close()
+        self._end_data(len(self.html))
+        return self.nodes
+
+    def _offset(self):
+        line, column = self.getpos()
+        while self._line < line:
+            self._line_start = self.html.index('\n', self._line_start) + 1
+            self._line += 1
+        return self._line_start + column
+
+    def _end_data(self, end=None):
+        # Called when any markup follows a text node, or the document ends.
+        if self._start is None:
+            return
+        text = ''.join(self._data)
+        if not self.skip_depth and _has_urls(text) and url_re.search(text):
+            if end is None:
+                end = self._offset()
+            parent = self.stack[-1] if self.stack else '[document]'
+            standalone = bool(standalone_url_re.match(text)) and \
+                parent in block_elements
+            self.nodes.append((self._start, end, text, standalone))
+        self._data = []
+        self._start = None
+
+    def handle_data(self, data):
+        if self._start is None:
+            self._start = self._offset()
+        self._data.append(data)
+
+    def handle_starttag(self, tag, attrs):
+        self._end_data()
+        if tag not in void_elements:
+            self.stack.append(tag)
+            if tag in skip_elements:
+                self.skip_depth += 1
+
+    def handle_startendtag(self, tag, attrs):
+        self._end_data()
+
+    def handle_endtag(self, tag):
+        # Closes the innermost open element of that name, and any elements
+        # opened inside it. Stray end tags are ignored.
+        self._end_data()
+        if tag in self.stack:
+            while True:
+                name = self.stack.pop()
+                if name in skip_elements:
+                    self.skip_depth -= 1
+                if name == tag:
+                    break
+
+    def handle_comment(self, data):
+        self._end_data()
+
+    handle_decl = handle_pi = unknown_decl = handle_comment
+
+def _render_node(text, providers, urlize_all, handler, urlize_params, params):
+    # Same as parse_text_full(), for the decoded text of an html node: the
+    # text around the urls is escaped.
+    output = []
+    replacements = {}
+    pos = 0
+    for match in url_re.finditer(text):
+        url = match.group()
+        output.append(escape(text[pos:match.start()], False))
+        if url not in replacements:
+            try:
+                response = providers.request(url, **params)
+            except ProviderException:
+                if urlize_all:
+                    replacements[url] = urlize(escape(url), **urlize_params)
+                else:
+                    replacements[url] = escape(url, False)
+            else:
+                replacements[url] = handler(url, response, **params)
+        output.append(replacements[url])
+        pos = match.end()
+    output.append(escape(text[pos:], False))
+    return ''.join(output)
+
+def _render_stream(html, nodes, providers, urlize_all, handler, block_handler,
+                   urlize_params, params):
+    # The markup is copied as-is, except for the text nodes containing urls.
+    output = []
+    pos = 0
+    for start, end, text, standalone in nodes:
+        output.append(html[pos:start])
+        output.append(_render_node(text, providers, urlize_all,
+                                   handler if standalone else block_handler,
+                                   urlize_params or {}, params))
+        pos = end
+    output.append(html[pos:])
+    return ''.join(output)
+
+# Documents given to the "lxml" engine start with comments, processing
+# instructions and a doctype, which are output as they were given, and then
+# with <html>, <head> or <body> -- or anything, after a doctype. The markup
+# after </html>, which libxml2 drops, is parsed as a fragment of its own.
+_prologue_re = re.compile(r'(?:\s+|<!--.*?-->|<![^>]*>|<\?[^>]*>)*', re.S)
+_document_re = re.compile(r'<(?:html|head|body)[\s/>]', re.I)
+_doctype_re = re.compile(r'<!doctype', re.I)
+_html_end_re = re.compile(r'</html\s*>', re.I)
+
+# Placeholders for the rendered text nodes in the output of the "lxml"
+# engine, so that the rendered html is spliced in without being parsed: the
+# index of the node between two private use characters, which must not occur
+# anywhere else in the output.
+_marker_chars = [chr(c) for c in range(0xe000, 0xf900)]
+
+if etree is not None:
+    _lxml_text_nodes = etree.XPath(
+        './/text()[contains(., "http")][not(ancestor::*[%s])]' %
+        ' or '.join('self::%s' % tag for tag in sorted(skip_elements)))
+
+def _lxml_fragment(html):
+    # libxml2 drops the leading whitespace of a fragment, which is kept as
+    # given.
+    content = html.lstrip()
+    parts = [html[:len(html) - len(content)]]
+    if content:
+        parts.append((lxml_html.fragment_fromstring(
+            content, create_parent='div'), False))
+    return parts
+
+def _parse_lxml(html):
+    # Returns the parts of the html -- markup output as-is, or a parsed root
+    # element along with whether it is a whole document -- and the text
+    # nodes containing urls outside of skip elements along with whether each
+    # is a standalone url. Fragments are parsed into a <div>, standing for
+    # the document.
+    prologue = _prologue_re.match(html).group()
+    body = html[len(prologue):]
+    if not _document_re.match(body) and not _doctype_re.search(prologue):
+        parts = _lxml_fragment(html)
+    elif not body.strip():
+        parts = [html]
+    else:
+        ends = [match.end() for match in _html_end_re.finditer(body)]
+        epilogue = ''
+        if ends:
+            body, epilogue = body[:ends[-1]], body[ends[-1]:]
+        parts = [prologue, (lxml_html.document_fromstring(body), True)]
+        parts.extend(_lxml_fragment(epilogue))
+
+    nodes = []
+    for part in parts:
+        if isinstance(part, str):
+            continue
+        root, is_document = part
+        for node in _lxml_text_nodes(root):
+            if not url_re.search(node):
+                continue
+            parent = node.getparent()
+            if node.is_tail:
+                parent = parent.getparent()
+            name = '[document]' if parent is None or (
+                parent is root and not is_document) else parent.tag
+            nodes.append((node, bool(standalone_url_re.match(node)) and
+                          name in block_elements))
+    return parts, nodes
+
+def _serialize_lxml(part):
+    if isinstance(part, str):
+        return part
+    root, is_document = part
+    if is_document:
+        return lxml_html.tostring(root, encoding='unicode')
+    return escape(root.text or '', False) + ''.join(
+        lxml_html.tostring(child, encoding='unicode') for child in root)
+
+def _render_lxml(document, nodes, providers, urlize_all, handler,
+                 block_handler, urlize_params, params):
+    parts, html = document
+    if not nodes:
+        return html
+
+    replacements = [
+        _render_node(str(node), providers, urlize_all,
+                     handler if standalone else block_handler,
+                     urlize_params or {}, params)
+        for node, standalone in nodes]
+
+    # The text of the tree is decoded, so character references may spell out
+    # a marker: the first character found only in the markers is used.
+    for marker_char in _marker_chars:
+        if marker_char in html:
+            continue
+        for i, (node, standalone) in enumerate(nodes):
+            marker = '%s%d%s' % (marker_char, i, marker_char)
+            if node.is_tail:
+                node.getparent().tail = marker
+            else:
+                node.getparent().text = marker
+        output = ''.join(_serialize_lxml(part) for part in parts)
+        if output.count(marker_char) == 2 * len(nodes):
+            break
+    else:
+        raise ValueError('No placeholder available for the html')
+
+    def replace(match):
+        index = int(match.group(1))
+        if index < len(replacements):
+            return replacements[index]
+        return match.group(0)
+
+    marker_re = re.compile('%s(\\d+)%s' % (marker_char, marker_char))
+    return marker_re.sub(replace, output)
+
+html_engines = ('soup', 'stream', 'lxml')
+
+def _parse_markup(html, engine, soup_class=BeautifulSoup):
+    # Returns the engine, the parsed document, its text nodes containing urls
+    # and the text of those nodes. The "soup" engine is used by default, or
+    # when lxml is not installed, unless BeautifulSoup is not installed.
+    # Markup which cannot contain urls is not parsed at all, and is output
+    # as it was given.
+    if engine == 'lxml' and lxml_html is None:
+        engine = None
+    if engine is None:
+        engine = 'soup' if soup_class is not None else 'stream'
+    if engine in html_engines and not _markup_has_urls(html):
+        return 'stream', html, [], []
+    if engine == 'stream':
+        nodes = _HTMLScanner(html).scan()
+        return engine, html, nodes, [node[2] for node in nodes]
+    elif engine == 'lxml':
+        try:
+            parts, nodes = _parse_lxml(html)
+        except (ValueError, etree.ParserError):
+            # e.g. control characters, which libxml2 refuses.
+            return _parse_markup(html, None, soup_class)
+        return engine, (parts, html), nodes, [str(n) for n, _ in nodes]
+    elif engine == 'soup':
+        soup, nodes = _parse_soup(html, soup_class)
+        return engine, soup, nodes, nodes
+    raise ValueError('Unknown html engine "%s", expected one of: %s' %
+                     (engine, ', '.join(html_engines)))
+
+def _render_markup(engine, document, nodes, providers, urlize_all, handler,
+                   block_handler, soup_class, urlize_params, params):
+    if engine == 'stream':
+        return _render_stream(document, nodes, providers, urlize_all, handler,
+                              block_handler, urlize_params, params)
+    elif engine == 'lxml':
+        return _render_lxml(document, nodes, providers, urlize_all, handler,
+                            block_handler, urlize_params, params)
+    return _render_soup(document, nodes, providers, urlize_all, handler,
+                        block_handler, soup_class, urlize_params, params)
+
+def parse_html(html, providers, urlize_all=True, handler=full_handler,
+               block_handler=inline_handler, soup_class=BeautifulSoup,
+               urlize_params=None, prefetch=None, engine=None, **params):
+    engine, document, nodes, texts = _parse_markup(html, engine, soup_class)
+    providers = _memoize(providers)
+    if prefetch:
+        providers.prefetch(_node_urls(texts), prefetch, **params)
+    return _render_markup(engine, document, nodes, providers, urlize_all,
+                          handler, block_handler, soup_class, urlize_params,
+                          params)
+
+def extract_html(html, providers, prefetch=None, engine=None, **params):
+    engine, document, nodes, texts = _parse_markup(html, engine)
+    providers = _memoize(providers)
+    if prefetch:
+        providers.prefetch(_node_urls(texts), prefetch, **params)
+    return _extract_nodes(texts, providers, params)
+
+async def aextract(text, providers, concurrency=None, timeout=None,
+                   **params):
+    providers = _memoize(providers)
+    await providers.aprefetch(url_re.findall(text), concurrency, timeout,
+                              **params)
+    return extract(text, providers, **params)
+
+async def aparse_text_full(text, providers, urlize_all=True,
+                           handler=full_handler, urlize_params=None,
+                           concurrency=None, timeout=None, **params):
+    providers = _memoize(providers)
+    await providers.aprefetch(url_re.findall(text), concurrency, timeout,
+                              **params)
+    return parse_text_full(text, providers, urlize_all, handler,
+                           urlize_params, **params)
+
+async def aparse_text(text, providers, urlize_all=True, handler=full_handler,
+                      block_handler=inline_handler, urlize_params=None,
+                      concurrency=None, timeout=None, **params):
+    providers = _memoize(providers)
+    await providers.aprefetch(_text_urls(text, block_handler is not None),
+                              concurrency, timeout, **params)
+    return parse_text(text, providers, urlize_all, handler, block_handler,
+                      urlize_params, **params)
+
+async def aparse_html(html, providers, urlize_all=True, handler=full_handler,
+                      block_handler=inline_handler, soup_class=BeautifulSoup,
+                      urlize_params=None, concurrency=None, timeout=None,
+                      engine=None, **params):
+    engine, document, nodes, texts = _parse_markup(html, engine, soup_class)
+    providers = _memoize(providers)
+    await providers.aprefetch(_node_urls(texts), concurrency, timeout,
+                              **params)
+    return _render_markup(engine, document, nodes, providers, urlize_all,
+                          handler, block_handler, soup_class, urlize_params,
+                          params)
+
+async def aextract_html(html, providers, concurrency=None, timeout=None,
+                        engine=None, **params):
+    engine, document, nodes, texts = _parse_markup(html, engine)
+    providers = _memoize(providers)
+    await providers.aprefetch(_node_urls(texts), concurrency, timeout,
+                              **params)
+    return _extract_nodes(texts, providers, params)
+
+def _node_urls(nodes):
+    urls = []
+    for node in nodes:
+        urls.extend(url_re.findall(node))
+    return urls
+
+def _url_string(string):
+    return _has_urls(string) and url_re.search(string) is not None
+
 def _is_standalone(soup_elem):
     if standalone_url_re.match(soup_elem):
         return soup_elem.parent.name in block_elements
@@ -1,37 +1,86 @@
+import asyncio
+import functools
 import hashlib
+import inspect
 import json
 import re
 import socket
 import ssl
+import sys
+import threading
+import time
+from concurrent.futures import CancelledError
+from concurrent.futures import Future
+from concurrent.futures import ThreadPoolExecutor
+from email.utils import mktime_tz
+from email.utils import parsedate_tz
 
 from urllib.error import HTTPError
 from urllib.error import URLError
+from urllib.parse import parse_qsl
+from urllib.parse import unquote
 from urllib.parse import urlencode
+from urllib.parse import urlsplit
+from urllib.parse import urlunsplit
 from urllib.request import Request
 from urllib.request import urlopen
 
 from micawber.exceptions import InvalidResponseException
 from micawber.exceptions import ProviderException
 from micawber.exceptions import ProviderNotFoundException
+from micawber.exceptions import RateLimitException
+from micawber.parsers import _RequestMemo
+from micawber.parsers import aextract
+from micawber.parsers import aextract_html
+from micawber.parsers import aparse_html
+from micawber.parsers import aparse_text
+from micawber.parsers import aparse_text_full
 from micawber.parsers import extract
 from micawber.parsers import extract_html
 from micawber.parsers import parse_html
 from micawber.parsers import parse_text
 from micawber.parsers import parse_text_full
+from micawber.parsers import parse_text_stream
+from micawber.transport import Response
+from micawber.transport import decode_body
+
+
+class ProviderResponse(dict):
+    """
+    oEmbed response data, along with the headers of the HTTP response it was
+    read from. The headers are used when caching the response, only the data
+    itself is stored.
+    """
+    headers = None
 
 
 class Provider(object):
-    def __init__(self, endpoint, timeout=3.0, user_agent=None, **kwargs):
+    # Transport used to make requests to the endpoint, e.g. a PooledTransport.
+    # When None, each request is made with urlopen. Setting this attribute on
+    # the class changes the default for all providers.
+    transport = None
+    # Limiter for the requests made to the endpoint by a ProviderRegistry.
+    limiter = None
+
+    def __init__(self, endpoint, timeout=3.0, user_agent=None, transport=None,
+                 limiter=None, **kwargs):
         self.endpoint = endpoint
         self.socket_timeout = timeout
         self.user_agent = user_agent or 'python-micawber'
+        if transport is not None:
+            self.transport = transport
+        if limiter is not None:
+            self.limiter = limiter
         self.base_params = {'format': 'json'}
         self.base_params.update(kwargs)
 
-    def fetch(self, url):
-        req = Request(url, headers={'User-Agent': self.user_agent})
+    def fetch(self, url, headers=None):
+        headers = dict(headers or (), **{'User-Agent': self.user_agent})
         try:
-            return fetch(req, self.socket_timeout)
+            if self.transport is None:
+                return fetch(Request(url, headers=headers),
+                             self.socket_timeout)
+            return self.transport.fetch(url, headers, self.socket_timeout)
         except (HTTPError, URLError, socket.timeout, ssl.SSLError,
                 UnicodeDecodeError, LookupError) as exc:
             # LookupError covers unknown charset names from bytes.decode.
@@ -43,21 +92,56 @@ class Provider(object):
         params['url'] = url
         return urlencode(sorted(params.items()))
 
-    def request(self, url, **extra_params):
+    def endpoint_url(self, url, **extra_params):
         encoded_params = self.encode_params(url, **extra_params)
+        if '?' in self.endpoint:
+            return '%s&%s' % (self.endpoint.rstrip('&'), encoded_params)
+        return '%s?%s' % (self.endpoint, encoded_params)
 
-        endpoint_url = self.endpoint
-        if '?' in endpoint_url:
-            endpoint_url = '%s&%s' % (endpoint_url.rstrip('&'), encoded_params)
+    def request(self, url, **extra_params):
+        endpoint_url = self.endpoint_url(url, **extra_params)
+        response = self.fetch(endpoint_url)
+        if response:
+            return self.handle_response(response, url)
         else:
-            endpoint_url = '%s?%s' % (endpoint_url, encoded_params)
+            raise ProviderException('Error fetching "%s"' % endpoint_url)
 
-        response = self.fetch(endpoint_url)
+    def revalidate(self, url, etag=None, last_modified=None, **extra_params):
+        """
+        Conditionally request the url again, given the ETag and/or
+        Last-Modified header of a previous response. Returns None if the
+        endpoint reports that response is unchanged, otherwise the new
+        response data.
+        """
+        headers = {}
+        if etag:
+            headers['If-None-Match'] = etag
+        if last_modified:
+            headers['If-Modified-Since'] = last_modified
+
+        endpoint_url = self.endpoint_url(url, **extra_params)
+        if not _accepts_extra(self.fetch, endpoint_url):
+            # fetch() was overridden without the headers argument.
+            return self.request(url, **extra_params)
+        try:
+            response = self.fetch(endpoint_url, headers)
+        except ProviderException as exc:
+            if isinstance(exc.__cause__, HTTPError) and \
+               exc.__cause__.code == 304:
+                return None
+            raise
         if response:
             return self.handle_response(response, url)
         else:
             raise ProviderException('Error fetching "%s"' % endpoint_url)
 
+    async def arequest(self, url, **extra_params):
+        # The request is made on a thread in the event loop's default
+        # executor, so the loop is not blocked while waiting on the endpoint.
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            None, functools.partial(self.request, url, **extra_params))
+
     def handle_response(self, response, url):
         try:
             json_data = json.loads(response)
@@ -73,42 +157,309 @@ class Provider(object):
         if 'title' not in json_data:
             json_data['title'] = json_data['url']
 
+        headers = getattr(response, 'headers', None)
+        if headers is not None:
+            json_data = ProviderResponse(json_data)
+            json_data.headers = headers
+
         return json_data
 
 
+def _max_age_from_headers(headers):
+    directives = {}
+    for directive in (headers.get('Cache-Control') or '').split(','):
+        name, _, value = directive.strip().partition('=')
+        directives[name.lower()] = value.strip('"')
+    for name in ('s-maxage', 'max-age'):
+        if name in directives:
+            try:
+                return int(directives[name])
+            except ValueError:
+                pass
+
+    expires = parsedate_tz(headers.get('Expires') or '')
+    if expires is not None:
+        date = parsedate_tz(headers.get('Date') or '')
+        now = mktime_tz(date) if date is not None else time.time()
+        return int(mktime_tz(expires) - now)
+
+
+def response_max_age(data):
+    """
+    Number of seconds for which response data may be cached, according to the
+    oEmbed "cache_age" or, failing that, to the Cache-Control and Expires
+    headers of the HTTP response it was read from. Returns None when neither
+    gives a positive lifetime.
+    """
+    try:
+        max_age = int(data.get('cache_age'))
+    except (AttributeError, TypeError, ValueError):
+        max_age = None
+
+    headers = getattr(data, 'headers', None)
+    if not max_age or max_age < 0:
+        max_age = None
+        if headers is not None:
+            max_age = _max_age_from_headers(headers)
+
+    if max_age is not None and max_age > 0:
+        return max_age
+
+
+# Prefix of cache keys, changed along with the way keys are derived so that
+# keys of either scheme can share a cache.
+KEY_PREFIX = 'k3.'
+
+
 def make_key(*args, **kwargs):
-    # Serialized with json rather than pickle so that keys are stable across
-    # python versions and parameter ordering. Values json cannot represent
-    # fall back to their string form -- the same form urlencode gives them in
-    # the actual request.
-    data = json.dumps((args, kwargs), sort_keys=True, separators=(',', ':'),
-                      default=str)
-    return hashlib.md5(data.encode('utf-8')).hexdigest()
+    if len(args) == 2 and not kwargs and isinstance(args[0], str) and \
+       isinstance(args[1], dict):
+        # The (url, params) key of every request. The params are sorted and
+        # converted to strings, as in the request itself, so e.g. 100 and
+        # "100" give the same key. Each part is prefixed with its length,
+        # so that no other url and params can give the same data.
+        url, params = args
+        parts = ['%d:%s' % (len(url), url)]
+        for name in sorted(params):
+            value = str(params[name])
+            parts.append('%d:%s%d:%s' % (len(name), name, len(value), value))
+        data = ''.join(parts)
+    else:
+        # Serialized with json rather than pickle so that keys are stable
+        # across python versions and parameter ordering. Values json cannot
+        # represent fall back to their string form.
+        data = json.dumps((args, kwargs), sort_keys=True,
+                          separators=(',', ':'), default=str)
+    return KEY_PREFIX + hashlib.blake2b(data.encode('utf-8'),
+                                        digest_size=16).hexdigest()
+
+
+def _identity(obj):
+    # A name for functions and classes (or, for other objects, their class)
+    # which is the same in every process, unlike their repr.
+    if not hasattr(obj, '__qualname__'):
+        obj = type(obj)
+    return '%s.%s' % (obj.__module__, obj.__qualname__)
+
+
+def _callable_identity(obj):
+    # The name of a function or class which can be looked up in its module,
+    # None for other callables -- partials, lambdas, closures, bound methods
+    # or callable instances -- whose behavior their name does not capture.
+    qualname = getattr(obj, '__qualname__', None)
+    target = sys.modules.get(getattr(obj, '__module__', None))
+    if not qualname or target is None:
+        return None
+    for name in qualname.split('.'):
+        target = getattr(target, name, None)
+        if target is None:
+            return None
+    if target != obj:
+        return None
+    return '%s.%s' % (obj.__module__, qualname)
+
+
+def _fingerprint(value):
+    if value is None:
+        return None
+    if _is_entry(value):
+        value = value['data']
+    return make_key(value)
+
+
+def _endpoint(provider):
+    # Label under which metrics are recorded for a provider.
+    return getattr(provider, 'endpoint', None) or _identity(provider)
+
+
+def _is_timeout(exc):
+    cause = exc.__cause__
+    if isinstance(cause, URLError):
+        cause = cause.reason
+    return isinstance(cause, socket.timeout)
+
+
+def error_key(key):
+    # Failures are cached under keys of their own, so they can never be
+    # mistaken for, or take the place of, response data.
+    return 'error.%s' % key
+
+
+def is_permanent_error(exc):
+    """
+    Whether a ProviderException is expected to recur when the request is
+    retried: there is no provider for the url, the provider's response was
+    invalid, or the endpoint answered with a 4xx status (other than "request
+    timeout" and "too many requests"). Anything else, e.g. a timeout or a
+    5xx status, is considered transient.
+    """
+    if isinstance(exc, (ProviderNotFoundException, InvalidResponseException)):
+        return True
+    cause = exc.__cause__
+    if isinstance(cause, HTTPError):
+        return 400 <= cause.code < 500 and cause.code not in (408, 429)
+    return False
+
+
+# Marks a cached value as an entry wrapping the response data, see
+# ProviderRegistry.stale_timeout.
+ENTRY_MARKER = '__micawber_entry__'
+
+
+def _is_entry(value):
+    return isinstance(value, dict) and ENTRY_MARKER in value
+
+
+# Query parameters added to links for tracking purposes, which do not change
+# the resource being linked to. Parameters prefixed with "utm_" as well.
+tracking_params = frozenset([
+    '_hsenc', '_hsmi', 'dclid', 'fbclid', 'gclid', 'igshid', 'mc_cid',
+    'mc_eid', 'msclkid', 'ref_src', 'ref_url', 'si', 'yclid'])
+
+_default_ports = {'http': ':80', 'https': ':443'}
+
+
+def _is_tracking_param(param):
+    name = unquote(param.partition('=')[0]).lower()
+    return name.startswith('utm_') or name in tracking_params
+
+
+def normalize_url(url):
+    """
+    Normalize the parts of a url which do not change the resource it refers
+    to: the scheme and host are lowercased, default ports, trailing slashes
+    (other than that of the root path) and tracking parameters (see
+    tracking_params) are removed.
+    """
+    scheme, netloc, path, query, fragment = urlsplit(url)
+    userinfo, _, host = netloc.rpartition('@')
+    host = host.lower()
+    port = _default_ports.get(scheme)
+    if port and host.endswith(port):
+        host = host[:-len(port)]
+    netloc = '%s@%s' % (userinfo, host) if userinfo else host
+
+    if len(path) > 1:
+        path = path.rstrip('/') or '/'
+    if query:
+        query = '&'.join(param for param in query.split('&')
+                         if param and not _is_tracking_param(param))
+    return urlunsplit((scheme, netloc, path, query, fragment))
 
 
 def url_cache(fn):
     def inner(self, url, **params):
-        if self.cache is not None:
-            key = make_key(url, params)
-            data = self.cache.get(key)
-            if data is None:
-                data = fn(self, url, **params)
-                self.cache.set(key, data)
-            return data
-        return fn(self, url, **params)
+        url, canonical = self._resolve(url)
+        key = make_key(canonical, params)
+        if self.cache is None:
+            return self._coalesce(key, functools.partial(fn, self, url,
+                                                         **params))
+
+        if self.metrics is None:
+            value = self.cache.get(key)
+        else:
+            start = time.perf_counter()
+            value = self.cache.get(key)
+            self._record_get(url, value, time.perf_counter() - start)
+        if value is not None:
+            if not _is_entry(value):
+                return value
+            if value['expires'] > time.time():
+                return value['data']
+            return self._stale(key, value, url, params)
+
+        return self._coalesce(key, functools.partial(
+            self._cache_miss, fn, key, url, params))
     return inner
 
 
+def _plain_response(data):
+    # Only the response data itself is cached.
+    if isinstance(data, ProviderResponse):
+        return dict(data)
+    return data
+
+
+# Whether functions accept an optional argument, see _accepts_extra.
+_extra_arguments = {}
+
+
+def _accepts_extra(method, *args):
+    # Whether the method can be called with one more argument than the given
+    # ones. Caches are only required to implement get() and set(key, value),
+    # and providers fetch(url), so timeouts and headers are only passed to
+    # methods whose signature has room for them.
+    func = getattr(method, '__func__', method)
+    try:
+        return _extra_arguments[func]
+    except (KeyError, TypeError):
+        pass
+    try:
+        inspect.signature(method).bind(*(args + (None,)))
+    except TypeError:
+        accepts = False
+    except ValueError:
+        # No signature available, e.g. a builtin.
+        accepts = True
+    else:
+        accepts = True
+    try:
+        _extra_arguments[func] = accepts
+    except TypeError:
+        pass
+    return accepts
+
+
+def _cache_set(cache, key, value, timeout=None):
+    if timeout is None or not _accepts_extra(cache.set, key, value):
+        cache.set(key, value)
+    else:
+        cache.set(key, value, timeout)
+
+
+def _cache_get_many(cache, keys):
+    # Caches are only required to implement get() and set().
+    if hasattr(cache, 'get_many'):
+        return cache.get_many(keys)
+    return dict((key, cache.get(key)) for key in keys)
+
+
+def _cache_set_many(cache, mapping, timeout=None):
+    if hasattr(cache, 'set_many'):
+        if timeout is None or not _accepts_extra(cache.set_many, mapping):
+            cache.set_many(mapping)
+        else:
+            cache.set_many(mapping, timeout)
+    else:
+        for key, value in mapping.items():
+            _cache_set(cache, key, value, timeout)
+
+
+async def _cache_aget(cache, key):
+    # Caches are only required to implement get() and set().
+    if hasattr(cache, 'aget'):
+        return await cache.aget(key)
+    return cache.get(key)
+
+
+async def _cache_aset(cache, key, value, timeout=None):
+    if hasattr(cache, 'aset'):
+        if timeout is None or not _accepts_extra(cache.aset, key, value):
+            await cache.aset(key, value)
+        else:
+            await cache.aset(key, value, timeout)
+    else:
+        _cache_set(cache, key, value, timeout)
+
+
 def fetch(request, timeout=None):
     urlopen_params = {}
     if timeout:
         urlopen_params['timeout'] = timeout
     # urlopen raises HTTPError for any non-2xx response, so no status check.
     with urlopen(request, **urlopen_params) as resp:
-        # oEmbed responses are JSON, for which the default charset is UTF-8
-        # (RFC 8259) -- many providers omit the charset parameter entirely.
-        charset = resp.headers.get_param('charset') or 'utf-8'
-        return resp.read().decode(charset)
+        return Response(decode_body(resp.read(), resp.headers), resp.status,
+                        resp.headers)
 
 
 def fetch_cache(cache, url, refresh=False, timeout=None):
@@ -116,46 +467,789 @@ def fetch_cache(cache, url, refresh=False, timeout=None):
     if cache is not None and not refresh:
         contents = cache.get('micawber.%s' % url)
     if contents is None:
-        contents = fetch(url, timeout=timeout)
+        contents = str(fetch(url, timeout=timeout))
         if cache is not None:
             cache.set('micawber.%s' % url, contents)
     return contents
 
 
+# Patterns using backreferences or conditionals refer to groups by number,
+# which would shift once the pattern is embedded in a larger alternation.
+_group_reference_re = re.compile(r'\\(?:[1-9]|g<)|\(\?\(')
+
+
+def _is_combinable(regex):
+    if not isinstance(regex, str) or _group_reference_re.search(regex):
+        return False
+    compiled = re.compile(regex)
+    # Named groups may collide with those of other patterns, and global inline
+    # flags (e.g. a leading "(?i)") cannot appear mid-pattern.
+    return not compiled.groupindex and compiled.flags == re.UNICODE
+
+
+def _build_index(items):
+    """
+    Compile (regex, provider) pairs, given in priority order, into a list of
+    (compiled regex, providers) pairs. Consecutive patterns are merged into a
+    single alternation, each alternative wrapped in a capturing group. Since
+    nothing follows the alternation, a match is always made by the first
+    alternative that can match -- the one with the highest priority -- and its
+    wrapping group, which closes last, is reported by ``match.lastindex``.
+    ``providers`` maps that group index back to the provider.
+
+    Patterns that cannot safely be combined are compiled on their own, in which
+    case ``providers`` is the provider itself.
+    """
+    index = []
+    branches = []
+    providers = {}
+
+    def flush():
+        if branches:
+            index.append((re.compile('|'.join(branches)), dict(providers)))
+            del branches[:]
+            providers.clear()
+
+    group = 1
+    for regex, provider in items:
+        if not _is_combinable(regex):
+            flush()
+            group = 1
+            index.append((re.compile(regex), provider))
+            continue
+
+        branches.append('(%s)' % regex)
+        providers[group] = provider
+        group += re.compile(regex).groups + 1
+
+    flush()
+    return index
+
+
+_error_classes = dict((exc_class.__name__, exc_class) for exc_class in (
+    ProviderException,
+    ProviderNotFoundException,
+    InvalidResponseException))
+
+
 class ProviderRegistry(object):
-    def __init__(self, cache=None):
+    # Seconds between checks of the cache while another process holds the
+    # lock for a url, see lock_timeout.
+    lock_poll_interval = 0.05
+    # Number of urls whose request and canonical urls are remembered, see
+    # _resolve.
+    resolve_cache_size = 4096
+
+    def __init__(self, cache=None, transient_error_timeout=None,
+                 permanent_error_timeout=None, min_cache_age=None,
+                 max_cache_age=None, stale_timeout=None,
+                 refresh_executor=None, lock_timeout=None, render_cache=None,
+                 render_timeout=None, metrics=None):
         self._registry = {}
+        self._canonicalizers = {}
+        self._index = None
+        self._version = None
+        self._resolved = {}
         self.cache = cache
+        # Seconds for which failed requests are cached, see is_permanent_error.
+        self.transient_error_timeout = transient_error_timeout
+        self.permanent_error_timeout = permanent_error_timeout
+        # Bounds for the lifetime of cached responses, see cache_timeout.
+        self.min_cache_age = min_cache_age
+        self.max_cache_age = max_cache_age
+        # Seconds for which expired responses are kept, so that they can be
+        # revalidated rather than requested again in full.
+        self.stale_timeout = stale_timeout
+        # Executor (or number of threads) used to refresh expired responses
+        # in the background, serving the stale response in the meantime.
+        if isinstance(refresh_executor, int):
+            refresh_executor = ThreadPoolExecutor(refresh_executor)
+        self.refresh_executor = refresh_executor
+        self._refreshing = set()
+        self._refresh_lock = threading.Lock()
+        # Requests currently in flight, so concurrent requests for the same
+        # url are made only once.
+        self._inflight = {}
+        self._inflight_lock = threading.Lock()
+        # Seconds for which a lock in the cache is held while requesting a
+        # url, for caches shared between processes which implement lock().
+        self.lock_timeout = lock_timeout
+        # Cache for the output of parse_text(), parse_text_full() and
+        # parse_html(), see _render.
+        self.render_cache = render_cache
+        self.render_timeout = render_timeout
+        # Metrics instance recording cache and request statistics, if any.
+        self.metrics = metrics
+
+    @property
+    def caches_errors(self):
+        return bool(self.transient_error_timeout or
+                    self.permanent_error_timeout)
+
+    def cache_timeout(self, data):
+        """
+        Number of seconds for which to cache the response data: the lifetime
+        given by the provider (see response_max_age), clamped to the min and
+        max cache age. None means the response does not expire.
+        """
+        timeout = response_max_age(data)
+        if self.max_cache_age and (timeout is None or
+                                   timeout > self.max_cache_age):
+            timeout = self.max_cache_age
+        if self.min_cache_age and timeout is not None:
+            timeout = max(timeout, self.min_cache_age)
+        return timeout
+
+    def _cache_value(self, data):
+        # Returns the response data, the value to cache for it and the cache
+        # timeout. Responses which expire are wrapped in an entry recording
+        # their expiration time and validators when stale_timeout is set. The
+        # entry itself is kept for stale_timeout seconds longer.
+        timeout = self.cache_timeout(data)
+        headers = getattr(data, 'headers', None)
+        data = _plain_response(data)
+        if not timeout or not self.stale_timeout:
+            return data, data, timeout
+
+        entry = {
+            ENTRY_MARKER: 1,
+            'data': data,
+            'expires': time.time() + timeout,
+            'timeout': timeout,
+            'etag': headers.get('ETag') if headers else None,
+            'last_modified': headers.get('Last-Modified') if headers else None}
+        return data, entry, timeout + self.stale_timeout
+
+    def _refresh(self, key, entry, url, params):
+        # Refresh an expired entry, using a conditional request if the
+        # provider returned validators for it.
+        provider = self.provider_for_url(url)
+        try:
+            if provider is not None and hasattr(provider, 'revalidate') and \
+               (entry['etag'] or entry['last_modified']):
+                data = self._fetch(provider, provider.revalidate, url,
+                                   entry['etag'], entry['last_modified'],
+                                   **params)
+                if data is None:
+                    # Not modified -- keep the cached data for another
+                    # lifetime.
+                    entry = dict(entry, expires=time.time() + entry['timeout'])
+                    _cache_set(self.cache, key, entry,
+                               entry['timeout'] + (self.stale_timeout or 0))
+                    return entry['data']
+            else:
+                data = self._request(url, **params)
+        except ProviderException:
+            # The stale response is served while it cannot be refreshed.
+            return entry['data']
+
+        data, value, timeout = self._cache_value(data)
+        _cache_set(self.cache, key, value, timeout)
+        return data
+
+    def _claim(self, key):
+        # Returns the Future of the call in progress for the key, and whether
+        # it is a new one, which the caller must complete and then _unclaim.
+        with self._inflight_lock:
+            future = self._inflight.get(key)
+            if future is not None:
+                return future, False
+            future = self._inflight[key] = Future()
+            return future, True
+
+    def _unclaim(self, key):
+        with self._inflight_lock:
+            del self._inflight[key]
+
+    def _coalesce(self, key, fn):
+        # Call fn unless a call for the same key is already in progress in
+        # another thread, in which case its result (or exception) is shared.
+        future, owner = self._claim(key)
+        if not owner:
+            return future.result()
 
-    def register(self, regex, provider):
+        try:
+            result = fn()
+        except BaseException as exc:
+            future.set_exception(exc)
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            self._unclaim(key)
+
+    def _cache_miss(self, fn, key, url, params):
+        if self.caches_errors:
+            exc = self._restore_error(self.cache.get(error_key(key)), url)
+            if exc is not None:
+                raise exc
+
+        token = None
+        if self.lock_timeout and hasattr(self.cache, 'lock'):
+            # Another process may be requesting the url already, in which
+            # case its response is waited for until the lock times out.
+            deadline = time.time() + self.lock_timeout
+            token = self.cache.lock(key, self.lock_timeout)
+            while token is None and time.time() < deadline:
+                time.sleep(self.lock_poll_interval)
+                value = self.cache.get(key)
+                if value is not None:
+                    return value['data'] if _is_entry(value) else value
+                if self.caches_errors:
+                    exc = self._restore_error(
+                        self.cache.get(error_key(key)), url)
+                    if exc is not None:
+                        raise exc
+                token = self.cache.lock(key, self.lock_timeout)
+
+        try:
+            if token is not None:
+                # The response may have been cached by another process
+                # between the cache being read and the lock being taken.
+                value = self.cache.get(key)
+                if value is not None:
+                    return value['data'] if _is_entry(value) else value
+            try:
+                data = fn(self, url, **params)
+            except ProviderException as exc:
+                if self.caches_errors:
+                    entry = self._error_entry(exc)
+                    if entry is not None:
+                        _cache_set(self.cache, error_key(key), entry,
+                                   entry['timeout'])
+                raise
+
+            data, value, timeout = self._cache_value(data)
+            _cache_set(self.cache, key, value, timeout)
+            return data
+        finally:
+            if token is not None:
+                self.cache.unlock(key, token)
+
+    def _stale(self, key, entry, url, params):
+        # Without a refresh executor an expired entry is refreshed right away,
+        # once for all the threads requesting it. Otherwise its data is
+        # returned as-is, and a refresh is scheduled unless one is already
+        # underway for the same key.
+        refresh = functools.partial(self._refresh, key, entry, url, params)
+        if self.refresh_executor is None:
+            return self._coalesce(key, refresh)
+
+        with self._refresh_lock:
+            if key in self._refreshing:
+                return entry['data']
+            self._refreshing.add(key)
+
+        def background():
+            try:
+                refresh()
+            finally:
+                with self._refresh_lock:
+                    self._refreshing.discard(key)
+
+        try:
+            self.refresh_executor.submit(background)
+        except RuntimeError:
+            # The executor has been shut down.
+            with self._refresh_lock:
+                self._refreshing.discard(key)
+            return self._coalesce(key, refresh)
+        return entry['data']
+
+    def _error_entry(self, exc):
+        if isinstance(exc, RateLimitException):
+            # Raised before any request was made.
+            return None
+        if is_permanent_error(exc):
+            timeout = self.permanent_error_timeout
+        else:
+            timeout = self.transient_error_timeout
+        if timeout:
+            return {'error': type(exc).__name__, 'message': str(exc),
+                    'expires': time.time() + timeout, 'timeout': timeout}
+
+    def _restore_error(self, entry, url):
+        if entry is None or entry['expires'] <= time.time():
+            return None
+        if self.metrics is not None:
+            self.metrics.incr('negative_hits', self._metrics_label(url))
+        exc_class = _error_classes.get(entry['error'], ProviderException)
+        return exc_class(entry['message'])
+
+    def _metrics_label(self, url):
+        provider = self.provider_for_url(url)
+        return _endpoint(provider) if provider is not None else None
+
+    def _record_get(self, url, value, elapsed):
+        self.metrics.observe('cache_get', elapsed)
+        self.metrics.incr('hits' if value is not None else 'misses',
+                          self._metrics_label(url))
+
+    def _record_wait(self, provider, waited):
+        # Time spent queued by the provider's limiter, None when rejected.
+        if waited is None:
+            self.metrics.incr('rejected', _endpoint(provider))
+        else:
+            self.metrics.observe('queue_wait', waited, _endpoint(provider))
+
+    def _record_fetch(self, provider, exc, elapsed):
+        label = _endpoint(provider)
+        self.metrics.observe('fetch', elapsed, label)
+        if exc is not None:
+            self.metrics.incr('timeouts' if _is_timeout(exc) else 'errors',
+                              label)
+
+    def register(self, regex, provider, canonicalize=None):
         self._registry[regex] = provider
+        if canonicalize is not None:
+            self._canonicalizers[regex] = canonicalize
+        else:
+            self._canonicalizers.pop(regex, None)
+        self._index = self._version = None
+        self._resolved = {}
 
     def unregister(self, regex):
         del self._registry[regex]
+        self._canonicalizers.pop(regex, None)
+        self._index = self._version = None
+        self._resolved = {}
+
+    @property
+    def version(self):
+        """
+        Hash of the registered providers, which changes whenever a provider
+        is registered or unregistered. It is derived from the registrations
+        themselves, so registries configured alike share the same version.
+        """
+        if self._version is None:
+            canonicalizers = self._canonicalizers
+            self._version = make_key([
+                (regex, _identity(provider),
+                 getattr(provider, 'endpoint', None),
+                 getattr(provider, 'base_params', None),
+                 _identity(canonicalizers[regex])
+                 if regex in canonicalizers else None)
+                for regex, provider in self])
+        return self._version
 
     def __iter__(self):
         return iter(reversed(list(self._registry.items())))
 
+    def _match(self, url):
+        # Returns the (provider, canonicalize function) registered for the
+        # url. The index is rebuilt lazily, the first lookup after the
+        # registry has been modified.
+        index = self._index
+        if index is None:
+            index = self._index = _build_index(
+                (regex, (provider, self._canonicalizers.get(regex)))
+                for regex, provider in self)
+
+        for regex, entries in index:
+            match = regex.match(url)
+            if match is not None:
+                if isinstance(entries, dict):
+                    return entries[match.lastindex]
+                return entries
+        return None, None
+
     def provider_for_url(self, url):
-        for regex, provider in self:
-            if re.match(regex, url):
-                return provider
+        return self._match(url)[0]
+
+    def canonical_url(self, url):
+        """
+        The url under which the given url is cached: the url normalized (see
+        normalize_url), then rewritten by the canonicalize function
+        registered along with its provider, if any.
+        """
+        return self._resolve(url)[1]
+
+    def _resolve(self, url):
+        # Returns the url to request and its canonical url. The provider is
+        # the one matching the url as given, and the url is requested as
+        # given unless the canonicalize function registered with the provider
+        # rewrote it into a url the provider also matches: normalizing alone
+        # can give a url the provider's regex no longer matches, e.g. without
+        # its trailing slash. Results are remembered until the registry is
+        # modified, or too many urls have been resolved.
+        resolved = self._resolved
+        try:
+            return resolved[url]
+        except KeyError:
+            pass
+
+        provider, canonicalize = self._match(url)
+        canonical = normalize_url(url)
+        if canonicalize is None:
+            result = url, canonical
+        else:
+            canonical = canonicalize(canonical)
+            if self._match(canonical)[0] is provider:
+                result = canonical, canonical
+            else:
+                result = url, canonical
+        if len(resolved) >= self.resolve_cache_size:
+            resolved.clear()
+        resolved[url] = result
+        return result
+
+    def _fetch(self, provider, fn, *args, **kwargs):
+        # Call one of the provider's request methods, once its limiter (if
+        # any) lets the request through.
+        limiter = getattr(provider, 'limiter', None)
+        if limiter is not None:
+            try:
+                waited = limiter.acquire()
+            except RateLimitException:
+                if self.metrics is not None:
+                    self._record_wait(provider, None)
+                raise
+            if self.metrics is not None:
+                self._record_wait(provider, waited)
+
+        try:
+            if self.metrics is None:
+                return fn(*args, **kwargs)
+            start = time.perf_counter()
+            try:
+                data = fn(*args, **kwargs)
+            except ProviderException as exc:
+                self._record_fetch(provider, exc, time.perf_counter() - start)
+                raise
+            self._record_fetch(provider, None, time.perf_counter() - start)
+            return data
+        finally:
+            if limiter is not None:
+                limiter.release()
+
+    def _request(self, url, **params):
+        provider = self.provider_for_url(url)
+        if not provider:
+            raise ProviderNotFoundException(
+                'Provider not found for "%s"' % url)
+        return self._fetch(provider, provider.request, url, **params)
+
+    request = url_cache(_request)
+
+    def request_many(self, urls, executor=None, **params):
+        """
+        Request metadata for many urls at once, returning a dict mapping each
+        url to either its metadata or the ProviderException raised for it.
+        The cache is read and written in bulk, and the urls that were not
+        cached are requested concurrently using the given Executor (or a
+        thread pool of the given size).
+        """
+        resolved = dict((url, self._resolve(url)) for url in urls)
+        requests = {}
+        for url, canonical in resolved.values():
+            requests.setdefault(canonical, url)
+        results = self._request_many(requests, executor, params)
+        return dict((url, results[resolved[url][1]]) for url in resolved)
+
+    def _request_many(self, requests, executor, params):
+        # Maps each canonical url to the url to request for it, see _resolve.
+        # The results are keyed by canonical url.
+        results = {}
+        stale = {}
+        keys = dict((canonical, make_key(canonical, params))
+                    for canonical in requests)
+
+        if self.cache is not None:
+            now = time.time()
+            start = time.perf_counter()
+            cached = _cache_get_many(self.cache, list(keys.values()))
+            if self.metrics is not None:
+                self.metrics.observe('cache_get_many',
+                                     time.perf_counter() - start)
+            for canonical, url in requests.items():
+                key = keys[canonical]
+                value = cached.get(key)
+                if self.metrics is not None:
+                    self.metrics.incr('hits' if value is not None else
+                                      'misses', self._metrics_label(url))
+                if value is None:
+                    continue
+                elif not _is_entry(value):
+                    results[canonical] = value
+                elif value['expires'] > now:
+                    results[canonical] = value['data']
+                elif self.refresh_executor is not None:
+                    results[canonical] = self._stale(key, value, url, params)
+                else:
+                    stale[canonical] = value
+
+            misses = [canonical for canonical in requests
+                      if canonical not in results and canonical not in stale]
+            if misses and self.caches_errors:
+                errors = _cache_get_many(
+                    self.cache, [error_key(keys[c]) for c in misses])
+                for canonical in misses:
+                    exc = self._restore_error(
+                        errors.get(error_key(keys[canonical])),
+                        requests[canonical])
+                    if exc is not None:
+                        results[canonical] = exc
+
+        misses = [canonical for canonical in requests
+                  if canonical not in results]
+        if not misses:
+            return results
+
+        # Misses are requested once, as by request(): the urls already being
+        # requested by another thread are waited for, and those locked by
+        # another process (see lock_timeout) are handled by _cache_miss. The
+        # others, and the stale entries, are claimed by this call until their
+        # responses are written.
+        shared = {}
+        owned = {}
+        contended = set()
+        tokens = {}
+        to_cache = {}
+        pending = []
+        locks = self.cache is not None and self.lock_timeout and \
+            hasattr(self.cache, 'lock')
+
+        def fn(canonical):
+            url = requests[canonical]
+            key = keys[canonical]
+            # Waiters are given the response as soon as it is fetched, the key
+            # remaining claimed until it has been cached.
+            future = owned[canonical]
+            try:
+                try:
+                    if canonical in stale:
+                        data = self._refresh(key, stale[canonical], url,
+                                             params)
+                    elif canonical in contended:
+                        data = self._cache_miss(type(self)._request, key, url,
+                                                params)
+                    else:
+                        data = self._request(url, **params)
+                        data, value, timeout = self._cache_value(data)
+                        to_cache[canonical] = (value, timeout)
+                except BaseException as exc:
+                    future.set_exception(exc)
+                    raise
+                future.set_result(data)
+                return data
+            except ProviderException as exc:
+                return exc
+
+        try:
+            for canonical in misses:
+                future, owner = self._claim(keys[canonical])
+                (owned if owner else shared)[canonical] = future
+            pending.extend(owned)
+
+            if locks:
+                for canonical in pending:
+                    if canonical in stale:
+                        continue
+                    token = self.cache.lock(keys[canonical], self.lock_timeout)
+                    if token is None:
+                        contended.add(canonical)
+                    else:
+                        tokens[canonical] = token
+                if tokens:
+                    # Responses cached by another process between the cache
+                    # being read and the locks being taken are not requested.
+                    cached = _cache_get_many(
+                        self.cache, [keys[c] for c in tokens])
+                    for canonical in tokens:
+                        value = cached.get(keys[canonical])
+                        if value is not None:
+                            if _is_entry(value):
+                                value = value['data']
+                            results[canonical] = value
+                            owned[canonical].set_result(value)
+                            pending.remove(canonical)
+
+            # Only the work owned by this call is run by the executor, whose
+            # workers could otherwise all be waiting on calls queued behind
+            # them.
+            if executor is None or isinstance(executor, int):
+                with ThreadPoolExecutor(max_workers=executor) as pool:
+                    fetched = list(pool.map(fn, pending))
+            else:
+                fetched = list(executor.map(fn, pending))
+            results.update(zip(pending, fetched))
+
+            if self.cache is not None:
+                # Entries are written in bulk, one call for each distinct
+                # timeout. Others have been written already.
+                mappings = {}
+                for canonical, data in zip(pending, fetched):
+                    if canonical in to_cache:
+                        value, timeout = to_cache[canonical]
+                        mappings.setdefault(timeout, {})[
+                            keys[canonical]] = value
+                    elif canonical not in contended and \
+                            isinstance(data, ProviderException) and \
+                            self.caches_errors:
+                        entry = self._error_entry(data)
+                        if entry is not None:
+                            mappings.setdefault(entry['timeout'], {})[
+                                error_key(keys[canonical])] = entry
+                for timeout, mapping in mappings.items():
+                    _cache_set_many(self.cache, mapping, timeout)
+        finally:
+            for canonical, token in tokens.items():
+                self.cache.unlock(keys[canonical], token)
+            for canonical, future in owned.items():
+                if not future.done():
+                    future.cancel()
+                self._unclaim(keys[canonical])
+
+        for canonical, future in shared.items():
+            try:
+                results[canonical] = future.result()
+            except CancelledError:
+                # The call requesting it failed before getting to it.
+                try:
+                    results[canonical] = self.request(requests[canonical],
+                                                      **params)
+                except ProviderException as exc:
+                    results[canonical] = exc
+            except ProviderException as exc:
+                results[canonical] = exc
+        return results
+
+    async def arequest(self, url, **params):
+        url, canonical = self._resolve(url)
+        if self.cache is None:
+            return await self._arequest(url, **params)
+
+        key = make_key(canonical, params)
+        start = time.perf_counter()
+        value = await _cache_aget(self.cache, key)
+        if self.metrics is not None:
+            self._record_get(url, value, time.perf_counter() - start)
+        if value is not None:
+            if not _is_entry(value):
+                return value
+            if value['expires'] > time.time():
+                return value['data']
+            elif self.refresh_executor is not None:
+                return self._stale(key, value, url, params)
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(
+                None, self._stale, key, value, url, params)
+
+        if self.caches_errors:
+            entry = await _cache_aget(self.cache, error_key(key))
+            exc = self._restore_error(entry, url)
+            if exc is not None:
+                raise exc
 
-    @url_cache
-    def request(self, url, **params):
+        try:
+            data = await self._arequest(url, **params)
+        except ProviderException as exc:
+            if self.caches_errors:
+                entry = self._error_entry(exc)
+                if entry is not None:
+                    await _cache_aset(self.cache, error_key(key), entry,
+                                      entry['timeout'])
+            raise
+
+        data, value, timeout = self._cache_value(data)
+        await _cache_aset(self.cache, key, value, timeout)
+        return data
+
+    async def _arequest(self, url, **params):
         provider = self.provider_for_url(url)
-        if provider:
-            return provider.request(url, **params)
-        raise ProviderNotFoundException('Provider not found for "%s"' % url)
+        if not provider:
+            raise ProviderNotFoundException(
+                'Provider not found for "%s"' % url)
+
+        limiter = getattr(provider, 'limiter', None)
+        if limiter is not None:
+            try:
+                waited = await limiter.aacquire()
+            except RateLimitException:
+                if self.metrics is not None:
+                    self._record_wait(provider, None)
+                raise
+            if self.metrics is not None:
+                self._record_wait(provider, waited)
+
+        try:
+            if self.metrics is None:
+                return await provider.arequest(url, **params)
+            start = time.perf_counter()
+            try:
+                data = await provider.arequest(url, **params)
+            except ProviderException as exc:
+                self._record_fetch(provider, exc, time.perf_counter() - start)
+                raise
+            self._record_fetch(provider, None, time.perf_counter() - start)
+            return data
+        finally:
+            if limiter is not None:
+                limiter.release()
+
+    def _render(self, fn, text, kwargs):
+        # Output is cached under a hash of the input, the parser options and
+        # the registry version, along with the fingerprints of the cached
+        # responses for the urls it embeds. It is rendered again once any of
+        # those responses has changed (or expired). Output is not cached when
+        # a callable option cannot be identified by name, or when a request
+        # failed for a url which has a provider.
+        if self.render_cache is None:
+            return fn(text, self, **kwargs)
+
+        options = {}
+        for name, value in kwargs.items():
+            if name == 'prefetch':
+                continue
+            if callable(value):
+                value = _callable_identity(value)
+                if value is None:
+                    return fn(text, self, **kwargs)
+            options[name] = value
+        key = 'render.%s' % make_key(fn.__name__, text, options, self.version)
+        entry = self.render_cache.get(key)
+        if entry is not None:
+            dependencies = entry['dependencies']
+            values = _cache_get_many(self.cache, list(dependencies)) \
+                if dependencies else {}
+            if all(_fingerprint(values.get(dependency)) == fingerprint
+                   for dependency, fingerprint in dependencies.items()):
+                return entry['output']
+
+        memo = _RequestMemo(self)
+        output = fn(text, memo, **kwargs)
+        if any(exc is not None and
+               not isinstance(exc, ProviderNotFoundException)
+               for response, exc in memo.responses.values()):
+            return output
+
+        dependencies = {}
+        if self.cache is not None and memo.responses:
+            arguments = inspect.signature(fn).parameters
+            params = dict((k, v) for k, v in kwargs.items()
+                          if k not in arguments)
+            keys = [make_key(url, params) for url in memo.responses]
+            values = _cache_get_many(self.cache, keys)
+            dependencies = dict((key, _fingerprint(values.get(key)))
+                                for key in keys)
+
+        _cache_set(self.render_cache, key,
+                   {'output': output, 'dependencies': dependencies},
+                   self.render_timeout)
+        return output
 
     def parse_text(self, text, **kwargs):
-        return parse_text(text, self, **kwargs)
+        return self._render(parse_text, text, kwargs)
 
     def parse_text_full(self, text, **kwargs):
-        return parse_text_full(text, self, **kwargs)
+        return self._render(parse_text_full, text, kwargs)
+
+    def parse_text_stream(self, lines, **kwargs):
+        return parse_text_stream(lines, self, **kwargs)
 
     def parse_html(self, html, **kwargs):
-        return parse_html(html, self, **kwargs)
+        return self._render(parse_html, html, kwargs)
 
     def extract(self, text, **kwargs):
         return extract(text, self, **kwargs)
@@ -163,9 +1257,37 @@ class ProviderRegistry(object):
     def extract_html(self, html, **kwargs):
         return extract_html(html, self, **kwargs)
 
+    async def aparse_text(self, text, **kwargs):
+        return await aparse_text(text, self, **kwargs)
+
+    async def aparse_text_full(self, text, **kwargs):
+        return await aparse_text_full(text, self, **kwargs)
+
+    async def aparse_html(self, html, **kwargs):
+        return await aparse_html(html, self, **kwargs)
+
+    async def aextract(self, text, **kwargs):
+        return await aextract(text, self, **kwargs)
+
+    async def aextract_html(self, html, **kwargs):
+        return await aextract_html(html, self, **kwargs)
+
 
 youtube_re = r'https?://(?:\S*\.)?youtu(?:\.be/|be\.com/(?:watch|shorts/))\S+'
 
+def youtube_canonical_url(url):
+    # All the forms of a link to a video become its "watch" url.
+    parts = urlsplit(url)
+    if parts.netloc.endswith('youtu.be'):
+        video_id = parts.path.strip('/')
+    elif parts.path.startswith('/shorts/'):
+        video_id = parts.path[len('/shorts/'):].strip('/')
+    else:
+        video_id = dict(parse_qsl(parts.query)).get('v')
+    if video_id and re.match(r'[\w-]+$', video_id):
+        return 'https://www.youtube.com/watch?v=%s' % video_id
+    return url
+
 def bootstrap_basic(cache=None, registry=None):
     # complements of oembed.com#section7
     pr = registry or ProviderRegistry(cache)
@@ -206,7 +1328,8 @@ def bootstrap_basic(cache=None, registry=None):
     pr.register(r'https?://wordpress\.tv/\S+', Provider('https://wordpress.tv/oembed/'))
 
     # y
-    pr.register(youtube_re, Provider('https://www.youtube.com/oembed'))
+    pr.register(youtube_re, Provider('https://www.youtube.com/oembed'),
+                youtube_canonical_url)
 
     return pr
 
@@ -292,6 +1415,7 @@ def bootstrap_oembed(cache=None, registry=None, refresh=False, **params):
 
     # Currently oembed.com does not provide patterns for YouTube, so we'll add
     # these ourselves.
-    pr.register(youtube_re, Provider('https://www.youtube.com/oembed'))
+    pr.register(youtube_re, Provider('https://www.youtube.com/oembed'),
+                youtube_canonical_url)
 
     return pr
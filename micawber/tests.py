@@ -1,9 +1,23 @@
+import asyncio
+import functools
+import io
+import json
 import os
+import pickle
+import re
 import shutil
+import socket
 import sys
 import tempfile
+import threading
+import time
 import unittest
+from concurrent.futures import ThreadPoolExecutor
 from email.message import Message
+from urllib.error import HTTPError
+from urllib.parse import quote
+from http.server import BaseHTTPRequestHandler
+from http.server import ThreadingHTTPServer
 from unittest import mock
 
 from micawber import *
@@ -19,8 +33,21 @@ try:
     import flask
 except ImportError:
     flask = None
+from micawber.cache import Serializer
 from micawber.contrib.providers import GoogleMapsProvider
+from micawber.exceptions import ProviderNotFoundException
+import micawber.providers
+from micawber.parsers import BeautifulSoup
 from micawber.parsers import full_handler
+from micawber.parsers import html_engines
+from micawber.parsers import inline_handler
+from micawber.parsers import lxml_html
+from micawber.providers import error_key
+from micawber.providers import make_key
+from micawber.providers import normalize_url
+from micawber.providers import response_max_age
+from micawber.transport import Response
+from micawber import warm
 from micawber.test_utils import test_pr, test_cache, test_pr_cache, TestProvider, BaseTestCase
 
 
@@ -58,6 +85,162 @@ class ProviderTestCase(BaseTestCase):
         pr.unregister(r'1\d+')
         self.assertEqual(pr.provider_for_url('11'), provider1)
 
+    def test_provider_index(self):
+        pr = ProviderRegistry()
+        p_named, p_flags, p_backref, p_plain = [
+            TestProvider(name) for name in ('named', 'flags', 'backref',
+                                            'plain')]
+        pr.register(r'http://(?P<host>\w+)\.com/\S+', p_named)
+        pr.register(r'(?i)http://FOO\.com/\S+', p_flags)
+        pr.register(r'http://(\w)\1\.com/\S+', p_backref)
+        pr.register(r'http://(foo|aa)\.com/(\d+)', p_plain)
+
+        # Later registrations take precedence, regardless of whether the
+        # pattern could be combined with its neighbors.
+        self.assertEqual(pr.provider_for_url('http://foo.com/1'), p_plain)
+        self.assertEqual(pr.provider_for_url('http://aa.com/1'), p_plain)
+        self.assertEqual(pr.provider_for_url('http://aa.com/x'), p_backref)
+        self.assertEqual(pr.provider_for_url('http://foo.com/x'), p_flags)
+        self.assertEqual(pr.provider_for_url('http://bar.com/x'), p_named)
+        self.assertEqual(pr.provider_for_url('http://bar.com'), None)
+
+        # The index is rebuilt whenever the registry is modified.
+        pr.register(r'http://bar\.com/\S+', p_plain)
+        self.assertEqual(pr.provider_for_url('http://bar.com/x'), p_plain)
+        pr.unregister(r'http://(foo|aa)\.com/(\d+)')
+        self.assertEqual(pr.provider_for_url('http://aa.com/1'), p_backref)
+
+    def test_provider_index_priority(self):
+        pr = bootstrap_basic()
+        # Compare against a linear scan of the registry in priority order.
+        for url in ('https://www.youtube.com/watch?v=dQw4w9WgXcQ',
+                    'https://vimeo.com/76979871',
+                    'https://someblog.wordpress.com/2011/10/28/1000-posts/',
+                    'https://www.flickr.com/photos/bees/2341623661/',
+                    'https://example.com/nothing'):
+            expected = None
+            for regex, provider in pr:
+                if re.match(regex, url):
+                    expected = provider
+                    break
+            self.assertTrue(pr.provider_for_url(url) is expected, url)
+
+    def test_normalize_url(self):
+        for url, expected in (
+                ('HTTPS://Example.COM:443/Path/?a=1',
+                 'https://example.com/Path?a=1'),
+                ('http://example.com:80/', 'http://example.com/'),
+                ('http://example.com:8080', 'http://example.com:8080'),
+                ('http://User@Example.com/a//', 'http://User@example.com/a'),
+                ('https://example.com/a?utm_source=x&id=1&UTM_Medium=y',
+                 'https://example.com/a?id=1'),
+                ('https://example.com/a?fbclid=1&si=2&gclid=3',
+                 'https://example.com/a'),
+                ('https://example.com/a?b=%20&c#frag',
+                 'https://example.com/a?b=%20&c#frag')):
+            self.assertEqual(normalize_url(url), expected)
+
+    def test_canonical_url(self):
+        pr = bootstrap_basic()
+        for url in ('https://youtu.be/dQw4w9WgXcQ',
+                    'https://youtu.be/dQw4w9WgXcQ?si=abc&t=10',
+                    'http://youtube.com/watch?v=dQw4w9WgXcQ',
+                    'https://www.youtube.com/watch?v=dQw4w9WgXcQ&feature=share',
+                    'https://m.youtube.com/watch?feature=share&v=dQw4w9WgXcQ',
+                    'https://www.youtube.com/shorts/dQw4w9WgXcQ'):
+            self.assertEqual(pr.canonical_url(url),
+                             'https://www.youtube.com/watch?v=dQw4w9WgXcQ')
+        self.assertEqual(pr.canonical_url('https://Vimeo.com/76979871/'),
+                         'https://vimeo.com/76979871')
+
+        class CountingProvider(TestProvider):
+            def fetch(self, url):
+                self.urls.append(url)
+                return super(CountingProvider, self).fetch(url)
+
+        cache = Cache()
+        provider = CountingProvider('link')
+        provider.urls = []
+        pr = ProviderRegistry(cache)
+        pr.register(r'(?i)http://link\S*', provider,
+                    lambda url: url.replace('-alias', '-test'))
+        variants = ['http://link-test1', 'http://link-alias1',
+                    'http://LINK-test1?utm_campaign=x']
+        expected = test_pr.request('http://link-test1')
+        for url in variants:
+            self.assertEqual(pr.request(url), expected)
+        self.assertEqual(provider.urls,
+                         ['link?format=json&url=http%3A%2F%2Flink-test1'])
+        self.assertEqual(list(cache._cache),
+                         [make_key('http://link-test1', {})])
+
+        urls = variants + ['http://link-alias2']
+        results = pr.request_many(urls)
+        self.assertEqual(sorted(results), sorted(urls))
+        self.assertEqual(results['http://link-alias1'], expected)
+        self.assertEqual(len(provider.urls), 2)
+
+        # Parsers request each canonical url once.
+        provider.urls = []
+        cache._cache.clear()
+        urls, extracted = extract(' '.join(variants), pr)
+        self.assertEqual(urls, variants)
+        self.assertEqual(extracted, dict((url, expected) for url in variants))
+        self.assertEqual(len(provider.urls), 1)
+
+        # Resolved urls are remembered until the registry is modified.
+        canonicalize = mock.Mock(side_effect=lambda url: url + '1')
+        pr.register(r'(?i)http://link\S*', provider, canonicalize)
+        for i in range(3):
+            self.assertEqual(pr.canonical_url('http://link-test'),
+                             'http://link-test1')
+        self.assertEqual(canonicalize.call_count, 1)
+        pr.resolve_cache_size = 2
+        for url in ('http://link-a', 'http://link-b', 'http://link-test'):
+            pr.canonical_url(url)
+        self.assertEqual(len(pr._resolved), 2)
+        self.assertEqual(canonicalize.call_count, 4)
+
+        pr.unregister(r'(?i)http://link\S*')
+        self.assertEqual(pr._canonicalizers, {})
+        self.assertEqual(pr.canonical_url('http://link-test'),
+                         'http://link-test')
+
+    def test_canonical_url_matching(self):
+        # Urls are matched and requested as given, their canonical form only
+        # being the key they are cached and collapsed under.
+        class EchoProvider(Provider):
+            def fetch(self, url):
+                self.urls.append(url)
+                return json.dumps({'type': 'link', 'title': url})
+
+        provider = EchoProvider('echo')
+        provider.urls = []
+        cache = Cache()
+        pr = ProviderRegistry(cache)
+        pr.register(r'https://example\.com/p/[^/]+/', provider)
+        pr.register(r'https?://Example\.com/\S+', provider)
+        for url in ('https://example.com/p/abc/', 'https://Example.com/x'):
+            provider.urls = []
+            expected = 'echo?format=json&url=%s' % quote(url, safe='')
+            self.assertEqual(pr.request(url)['title'], expected)
+            self.assertEqual(pr.request_many([url])[url]['title'], expected)
+            self.assertEqual(asyncio.run(pr.arequest(url))['title'], expected)
+            self.assertEqual(provider.urls, [expected])
+            self.assertEqual(list(cache._cache)[-1],
+                             make_key(pr.canonical_url(url), {}))
+
+        # Canonicalizers giving a url the provider does not match are only
+        # used for the cache key.
+        provider.urls = []
+        pr.register(r'https://example\.com/p/[^/]+/', provider,
+                    lambda url: url + '?canonical')
+        self.assertEqual(pr.canonical_url('https://example.com/p/def/'),
+                         'https://example.com/p/def?canonical')
+        pr.request('https://example.com/p/def/')
+        self.assertEqual(provider.urls, ['echo?format=json&url=%s' % quote(
+            'https://example.com/p/def/', safe='')])
+
     def test_provider_matching(self):
         provider = test_pr.provider_for_url('http://link-test1')
         self.assertFalse(provider is None)
@@ -119,6 +302,353 @@ class ProviderTestCase(BaseTestCase):
 
         self.assertFalse(resp == resp_p)
 
+    def test_request_many(self):
+        class CountingCache(Cache):
+            def __init__(self):
+                super(CountingCache, self).__init__()
+                self.calls = []
+            def get_many(self, keys):
+                self.calls.append('get_many')
+                return super(CountingCache, self).get_many(keys)
+            def set_many(self, mapping):
+                self.calls.append('set_many')
+                super(CountingCache, self).set_many(mapping)
+
+        cache = CountingCache()
+        pr = ProviderRegistry(cache)
+        pr.register(r'http://link\S*', TestProvider('link'))
+        pr.register(r'http://photo\S*', TestProvider('photo'))
+        cache.set(make_key('http://photo-test2', {}), {'cached': True})
+
+        urls = ['http://link-test1', 'http://photo-test2', 'http://link-test3',
+                'http://not-here', 'http://link-test1']
+        results = pr.request_many(urls)
+        self.assertEqual(sorted(results), sorted(set(urls)))
+        self.assertEqual(results['http://link-test1'],
+                         test_pr.request('http://link-test1'))
+        self.assertEqual(results['http://photo-test2'], {'cached': True})
+        self.assertTrue(isinstance(results['http://link-test3'],
+                                   ProviderException))
+        self.assertTrue(isinstance(results['http://not-here'],
+                                   ProviderNotFoundException))
+        self.assertEqual(cache.calls, ['get_many', 'set_many'])
+
+        # Only successful responses were cached.
+        self.assertEqual(len(cache._cache), 2)
+        self.assertEqual(pr.request_many(['http://link-test1']),
+                         {'http://link-test1': results['http://link-test1']})
+
+        # Without a cache, using a caller-supplied executor.
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            results = test_pr.request_many(urls, executor=executor)
+        self.assertEqual(results['http://photo-test2'],
+                         test_pr.request('http://photo-test2'))
+
+    def test_negative_caching(self):
+        class ErrorProvider(Provider):
+            fetch_count = 0
+            code = 404
+            def fetch(self, url):
+                ErrorProvider.fetch_count += 1
+                raise ProviderException('Error fetching') from HTTPError(
+                    url, self.code, 'error', {}, None)
+
+        cache = Cache()
+        pr = ProviderRegistry(cache, transient_error_timeout=10,
+                              permanent_error_timeout=100)
+        pr.register(r'http://error\S*', ErrorProvider('error'))
+
+        def assertCachedError(url, timeout):
+            entry = cache.get(error_key(make_key(url, {})))
+            self.assertTrue(entry is not None)
+            self.assertAlmostEqual(entry['expires'], time.time() + timeout,
+                                   delta=5)
+
+        self.assertRaises(ProviderNotFoundException, pr.request,
+                          'http://not-here')
+        assertCachedError('http://not-here', 100)
+        # Cached failures are raised without consulting the registry.
+        pr.register(r'http://not-here', TestProvider('link'))
+        self.assertRaises(ProviderNotFoundException, pr.request,
+                          'http://not-here')
+
+        for code, timeout in ((404, 100), (503, 10), (429, 10)):
+            url = 'http://error-%s' % code
+            ErrorProvider.code = code
+            ErrorProvider.fetch_count = 0
+            for i in range(3):
+                with self.assertRaises(ProviderException) as ctx:
+                    pr.request(url)
+                self.assertEqual(str(ctx.exception), 'Error fetching')
+            self.assertEqual(ErrorProvider.fetch_count, 1)
+            assertCachedError(url, timeout)
+
+            results = pr.request_many([url])
+            self.assertTrue(isinstance(results[url], ProviderException))
+            self.assertEqual(ErrorProvider.fetch_count, 1)
+
+        # Response data is never shadowed by a cached failure.
+        cache.set(make_key('http://error-404', {}), {'title': 'ok'})
+        self.assertEqual(pr.request('http://error-404'), {'title': 'ok'})
+
+        # Expired failures are retried.
+        ErrorProvider.fetch_count = 0
+        with mock.patch('micawber.providers.time.time',
+                        return_value=time.time() + 11):
+            self.assertRaises(ProviderException, pr.request,
+                              'http://error-503')
+            self.assertRaises(ProviderException, pr.request,
+                              'http://error-429')
+        self.assertEqual(ErrorProvider.fetch_count, 2)
+
+        # Failures are not cached unless enabled.
+        cache = Cache()
+        pr = ProviderRegistry(cache)
+        self.assertRaises(ProviderException, pr.request, 'http://not-here')
+        self.assertEqual(cache._cache, {})
+
+    def test_coalescing(self):
+        class BlockingProvider(TestProvider):
+            calls = 0
+            def fetch(self, url):
+                self.calls += 1
+                self.released.wait(5)
+                return super(BlockingProvider, self).fetch(url)
+
+        for cache in (None, Cache()):
+            provider = BlockingProvider('link')
+            provider.released = threading.Event()
+            pr = ProviderRegistry(cache)
+            pr.register(r'http://link\S*', provider)
+
+            with ThreadPoolExecutor(8) as executor:
+                futures = [executor.submit(pr.request, url)
+                           for url in ['http://link-test1'] * 6 +
+                                      ['http://link-test2'] * 2]
+                while len(pr._inflight) < 2 or provider.calls < 2:
+                    time.sleep(0.01)
+                time.sleep(0.05)
+                provider.released.set()
+                results = [future.result() for future in futures]
+
+            # Concurrent requests for the same url are made only once.
+            self.assertEqual(provider.calls, 2)
+            self.assertEqual(results[0], test_pr.request('http://link-test1'))
+            self.assertEqual(results[:6], [results[0]] * 6)
+            self.assertEqual(results[6:], [results[6]] * 2)
+            self.assertEqual(pr._inflight, {})
+
+        # Failures are shared likewise.
+        provider = BlockingProvider('link')
+        provider.released = threading.Event()
+        pr = ProviderRegistry()
+        pr.register(r'http://link\S*', provider)
+        with ThreadPoolExecutor(4) as executor:
+            futures = [executor.submit(pr.request, 'http://link-missing')
+                       for i in range(4)]
+            while provider.calls < 1:
+                time.sleep(0.01)
+            time.sleep(0.05)
+            provider.released.set()
+            for future in futures:
+                self.assertRaises(ProviderException, future.result)
+        self.assertEqual(provider.calls, 1)
+
+    def test_coalescing_request_many(self):
+        class BlockingProvider(TestProvider):
+            calls = 0
+            def fetch(self, url):
+                self.calls += 1
+                self.released.wait(5)
+                return super(BlockingProvider, self).fetch(url)
+
+        expected = test_pr.request('http://link-test1')
+        for cache in (None, Cache()):
+            provider = BlockingProvider('link')
+            provider.released = threading.Event()
+            pr = ProviderRegistry(cache)
+            pr.register(r'http://link\S*', provider)
+
+            # request_many() shares the requests in progress, and the
+            # requests it makes are shared in turn.
+            with ThreadPoolExecutor(4) as executor:
+                first = executor.submit(pr.request, 'http://link-test1')
+                while provider.calls < 1:
+                    time.sleep(0.01)
+                many = executor.submit(pr.request_many, [
+                    'http://link-test1', 'http://link-test2'])
+                while provider.calls < 2:
+                    time.sleep(0.01)
+                last = [executor.submit(pr.request, 'http://link-test2')
+                        for i in range(2)]
+                time.sleep(0.05)
+                provider.released.set()
+                self.assertEqual(first.result(), expected)
+                self.assertEqual(many.result()['http://link-test1'], expected)
+                results = [future.result() for future in last]
+            self.assertEqual(results, [many.result()['http://link-test2']] * 2)
+            self.assertEqual(provider.calls, 2)
+            self.assertEqual(pr._inflight, {})
+
+        # Calls waiting on each other's requests do not tie up the executor
+        # they share: each claims one url and then finds the other claimed.
+        pr = ProviderRegistry()
+        pr.register(r'http://link\S*', TestProvider('link'))
+        barrier = threading.Barrier(2, timeout=5)
+        claim = pr._claim
+
+        def interleaved_claim(key):
+            result = claim(key)
+            barrier.wait()
+            return result
+
+        urls = ['http://link-test1', 'http://link-test2']
+        with mock.patch.object(pr, '_claim', side_effect=interleaved_claim):
+            with ThreadPoolExecutor(1) as shared, \
+                    ThreadPoolExecutor(2) as executor:
+                futures = [executor.submit(pr.request_many, u, shared)
+                           for u in (urls, urls[::-1])]
+                results = [future.result(5) for future in futures]
+        self.assertEqual(results[0], results[1])
+        self.assertEqual(results[0]['http://link-test1'], expected)
+        self.assertEqual(pr._inflight, {})
+
+    def test_response_max_age(self):
+        def data(cache_age=None, **headers):
+            response = Message()
+            for header, value in headers.items():
+                response[header.replace('_', '-')] = value
+            body = {'type': 'link'}
+            if cache_age is not None:
+                body['cache_age'] = cache_age
+            return Provider('').handle_response(
+                Response(json.dumps(body), 200, response), 'http://foo')
+
+        self.assertEqual(response_max_age({'cache_age': 60}), 60)
+        self.assertEqual(response_max_age({'cache_age': '60'}), 60)
+        self.assertEqual(response_max_age({}), None)
+        self.assertEqual(response_max_age({'cache_age': 'x'}), None)
+
+        # cache_age takes precedence over the http headers.
+        self.assertEqual(response_max_age(
+            data(cache_age=60, Cache_Control='max-age=3600')), 60)
+        self.assertEqual(response_max_age(
+            data(cache_age=0, Cache_Control='max-age=3600')), 3600)
+        self.assertEqual(response_max_age(
+            data(Cache_Control='public, max-age=3600, s-maxage=7200')), 7200)
+        self.assertEqual(response_max_age(
+            data(Cache_Control='max-age="120"')), 120)
+        self.assertEqual(response_max_age(
+            data(Cache_Control='private, max-age=0')), None)
+        self.assertEqual(response_max_age(data(Cache_Control='no-cache')),
+                         None)
+        self.assertEqual(response_max_age(data(
+            Date='Sat, 17 Oct 2026 10:00:00 GMT',
+            Expires='Sat, 17 Oct 2026 11:00:00 GMT')), 3600)
+        self.assertEqual(response_max_age(data(
+            Date='Sat, 17 Oct 2026 10:00:00 GMT', Expires='0')), None)
+
+    def test_cache_timeout(self):
+        class HeaderProvider(TestProvider):
+            cache_control = None
+            def fetch(self, url):
+                headers = Message()
+                if self.cache_control:
+                    headers['Cache-Control'] = self.cache_control
+                body = super(HeaderProvider, self).fetch(url)
+                return Response(body, 200, headers)
+
+        class TimeoutCache(Cache):
+            def set(self, k, v, timeout=None):
+                self.timeouts[k] = timeout
+                super(TimeoutCache, self).set(k, v, timeout)
+
+        cache = TimeoutCache()
+        provider = HeaderProvider('link')
+        pr = ProviderRegistry(cache)
+        pr.register(r'http://link\S*', provider)
+
+        def assertTimeout(expected):
+            cache.timeouts = {}
+            cache._cache.clear()
+            resp = pr.request('http://link-test1')
+            self.assertTrue(type(resp) is dict)
+            self.assertEqual(resp, test_pr.request('http://link-test1'))
+            self.assertEqual(list(cache.timeouts.values()), [expected])
+            cache.timeouts = {}
+            cache._cache.clear()
+            results = pr.request_many(['http://link-test1'])
+            self.assertTrue(type(results['http://link-test1']) is dict)
+            self.assertEqual(list(cache.timeouts.values()), [expected])
+
+        assertTimeout(None)
+        provider.cache_control = 'max-age=300'
+        assertTimeout(300)
+
+        pr.min_cache_age = 600
+        assertTimeout(600)
+        pr.min_cache_age = None
+        pr.max_cache_age = 60
+        assertTimeout(60)
+        provider.cache_control = None
+        assertTimeout(60)
+
+        # Responses are not cached past their timeout.
+        key = make_key('http://link-test1', {})
+        self.assertTrue(cache.get(key) is not None)
+        with mock.patch('micawber.cache.time.time',
+                        return_value=time.time() + 61):
+            self.assertTrue(cache.get(key) is None)
+
+        # Subclasses setting up only _cache themselves support timeouts too.
+        class DictCache(Cache):
+            def __init__(self):
+                self._cache = {}
+
+        cache = DictCache()
+        cache.set('k1', 'v1')
+        cache.set('k2', 'v2', 60)
+        cache.delete('k1')
+        self.assertEqual(cache.get_many(['k1', 'k2']), {'k2': 'v2'})
+        with mock.patch('micawber.cache.time.time',
+                        return_value=time.time() + 61):
+            self.assertTrue(cache.get('k2') is None)
+        self.assertEqual(DictCache().get('k1'), None)
+
+    def test_cache_without_timeout(self):
+        # Caches need only implement get() and set(key, value), responses
+        # with a lifetime being cached without it.
+        class MinimalCache(object):
+            def __init__(self):
+                self.data = {}
+            def get(self, key):
+                return self.data.get(key)
+            def set(self, key, value):
+                self.data[key] = value
+
+        class AgeProvider(TestProvider):
+            def fetch(self, url):
+                data = json.loads(super(AgeProvider, self).fetch(url))
+                return json.dumps(dict(data, cache_age=300))
+
+        cache = MinimalCache()
+        pr = ProviderRegistry(cache, render_cache=MinimalCache(),
+                              render_timeout=60)
+        pr.register(r'http://link\S*', AgeProvider('link'))
+        expected = dict(test_pr.request('http://link-test1'), cache_age=300)
+        self.assertEqual(pr.request('http://link-test1'), expected)
+        self.assertEqual(list(cache.data.values()), [expected])
+
+        cache.data.clear()
+        self.assertEqual(pr.request_many(['http://link-test1']),
+                         {'http://link-test1': expected})
+        cache.data.clear()
+        self.assertEqual(asyncio.run(pr.arequest('http://link-test1')),
+                         expected)
+        self.assertEqual(pr.parse_text('http://link-test1'),
+                         self.full_pairs['http://link-test1'])
+        self.assertEqual(len(pr.render_cache.data), 1)
+
     def test_make_key_stable(self):
         from micawber.providers import make_key
         k1 = make_key('http://foo', {'maxwidth': 600, 'maxheight': 400})
@@ -128,6 +658,28 @@ class ProviderTestCase(BaseTestCase):
                          make_key('http://foo', b=2, a=1))
         self.assertNotEqual(k1, make_key('http://foo', {'maxwidth': 600}))
 
+        # Params giving the same request give the same key.
+        self.assertEqual(k1, make_key('http://foo', {'maxwidth': '600',
+                                                     'maxheight': 400}))
+        self.assertNotEqual(make_key('http://foo', {}),
+                            make_key('http://foo/', {}))
+        self.assertNotEqual(make_key('http://foo', {'a': '1'}),
+                            make_key('http://foo', {'a': '1'}, 'x'))
+
+        # Separators within keys and values cannot be confused for others.
+        self.assertNotEqual(make_key('http://foo', {'a': 'b=c'}),
+                            make_key('http://foo', {'a=b': 'c'}))
+        self.assertNotEqual(make_key('http://foo', {'a': 'x\x00b=c'}),
+                            make_key('http://foo', {'a': 'x', 'b': 'c'}))
+        self.assertNotEqual(make_key('http://foo', {'a': 'x&b=c'}),
+                            make_key('http://foo', {'a': 'x', 'b': 'c'}))
+        self.assertNotEqual(make_key('http://foo\x00a=1', {}),
+                            make_key('http://foo', {'a': 1}))
+
+        # Keys are versioned, so keys of the previous scheme can coexist.
+        self.assertTrue(k1.startswith('k3.'))
+        self.assertEqual(len(k1), 35)
+
     def test_make_key_non_json_params(self):
         import datetime
         from decimal import Decimal
@@ -224,7 +776,11 @@ class ProviderTestCase(BaseTestCase):
             'https://www.youtube.com/shorts/aqz-KE-bpKQ',
         ]
         for url in urls:
-            self.assertTrue(pr.provider_for_url(url) is not None, url)
+            provider = pr.provider_for_url(url)
+            self.assertTrue(provider is not None, url)
+            # Canonical urls are handled by the same provider.
+            self.assertTrue(pr.provider_for_url(pr.canonical_url(url)) is
+                            provider, url)
 
     def test_bootstrap_iframely(self):
         # An api key (or md5-hashed "key") is required.
@@ -324,6 +880,455 @@ class EscapingTestCase(BaseTestCase):
             '<a href="http://video-nohtml/foo" title="broken">broken</a>')
 
 
+class AsyncTestCase(BaseTestCase):
+    def test_arequest(self):
+        resp = asyncio.run(test_pr_cache.arequest('http://link-test1'))
+        self.assertEqual(resp, test_pr.request('http://link-test1'))
+        self.assertCached('http://link-test1', resp)
+
+        # Cache hits do not reach the provider.
+        test_cache._cache[make_key('http://link-test1', {})] = {'cached': 1}
+        resp = asyncio.run(test_pr_cache.arequest('http://link-test1'))
+        self.assertEqual(resp, {'cached': 1})
+
+        with self.assertRaises(ProviderException):
+            asyncio.run(test_pr.arequest('http://not-here'))
+        with self.assertRaises(ProviderException):
+            asyncio.run(test_pr.arequest('http://link-test3'))
+
+    def test_async_parsers(self):
+        text = ('http://link-test1\nsee http://video-test1 and '
+                'http://link-test1\nhttp://rich-test2\nhttp://fapp.io/')
+        html = ('<p>http://link-test1</p><p>see http://video-test1</p>'
+                '<a href="#">http://link-test2</a><p>http://rich-test2</p>')
+
+        def run(fn, afn, s, **kwargs):
+            self.assertEqual(asyncio.run(afn(s, **kwargs)), fn(s, **kwargs))
+
+        run(test_pr.parse_text, test_pr.aparse_text, text)
+        run(test_pr.parse_text, test_pr.aparse_text, text, block_handler=None)
+        run(test_pr.parse_text_full, test_pr.aparse_text_full, text)
+        run(test_pr.parse_html, test_pr.aparse_html, html)
+        run(test_pr.extract, test_pr.aextract, text)
+        run(test_pr.extract_html, test_pr.aextract_html, html)
+
+    def test_concurrency_and_timeout(self):
+        class SlowProvider(TestProvider):
+            active = peak = 0
+            delay = 0.05
+            lock = threading.Lock()
+
+            def fetch(self, url):
+                with self.lock:
+                    SlowProvider.active += 1
+                    SlowProvider.peak = max(SlowProvider.peak,
+                                            SlowProvider.active)
+                time.sleep(self.delay)
+                with self.lock:
+                    SlowProvider.active -= 1
+                return super(SlowProvider, self).fetch(url)
+
+        pr = ProviderRegistry()
+        pr.register(r'http://\w+-test\d', SlowProvider('link'))
+        text = ' '.join('http://link-test%s' % i for i in range(6))
+
+        urls, extracted = asyncio.run(pr.aextract(text, concurrency=2))
+        self.assertEqual(len(urls), 6)
+        self.assertEqual(sorted(extracted), ['http://link-test1',
+                                             'http://link-test2'])
+        self.assertEqual(SlowProvider.peak, 2)
+
+        # Requests still pending when the timeout expires are treated as
+        # failures, so the url is merely urlized.
+        SlowProvider.delay = 1
+
+        async def timed():
+            start = time.time()
+            parsed = await pr.aparse_text('http://link-test1', timeout=0.1)
+            return parsed, time.time() - start
+
+        parsed, elapsed = asyncio.run(timed())
+        self.assertTrue(elapsed < 1)
+        self.assertEqual(parsed, '<a href="http://link-test1">'
+                                 'http://link-test1</a>')
+
+
+class MetricsTestCase(unittest.TestCase):
+    def test_metrics(self):
+        class TimeoutProvider(TestProvider):
+            def fetch(self, url):
+                if 'timeout' in url:
+                    raise ProviderException('timed out') from socket.timeout()
+                return super(TimeoutProvider, self).fetch(url)
+
+        events = []
+        metrics = Metrics(lambda *args: events.append(args))
+        pr = ProviderRegistry(Cache(), transient_error_timeout=60,
+                              metrics=metrics)
+        pr.register(r'http://link\S*', TimeoutProvider('link'))
+        pr.request('http://link-test1')
+        pr.request('http://link-test1')
+        for i in range(2):
+            self.assertRaises(ProviderException, pr.request,
+                              'http://link-timeout')
+        self.assertRaises(ProviderException, pr.request, 'http://link-bad')
+        self.assertRaises(ProviderException, pr.request, 'http://nope')
+        pr.request_many(['http://link-test1', 'http://link-test2'])
+        asyncio.run(pr.arequest('http://link-test2'))
+
+        snapshot = metrics.snapshot()
+        self.assertEqual(snapshot['counters'], {
+            'hits': {'link': 3},
+            'misses': {'link': 5, None: 1},
+            'negative_hits': {'link': 1},
+            'timeouts': {'link': 1},
+            'errors': {'link': 1}})
+
+        histograms = snapshot['histograms']
+        self.assertEqual(sorted(histograms),
+                         ['cache_get', 'cache_get_many', 'fetch'])
+        self.assertEqual(histograms['cache_get'][None]['count'], 7)
+        fetch = histograms['fetch']['link']
+        self.assertEqual(fetch['count'], 4)
+        self.assertEqual(sum(n for bound, n in fetch['buckets']), 4)
+        self.assertEqual(fetch['buckets'][-1][0], float('inf'))
+        self.assertTrue(fetch['sum'] >= 0)
+
+        self.assertEqual(events[:3], [
+            ('histogram', 'cache_get', None, events[0][3]),
+            ('counter', 'misses', 'link', 1),
+            ('histogram', 'fetch', 'link', events[2][3])])
+
+        metrics.reset()
+        self.assertEqual(metrics.snapshot(),
+                         {'counters': {}, 'histograms': {}})
+
+    def test_disabled(self):
+        pr = ProviderRegistry(Cache())
+        pr.register(r'http://link\S*', TestProvider('link'))
+        with mock.patch('micawber.providers.time.perf_counter') as clock:
+            pr.request('http://link-test1')
+            pr.request('http://link-test1')
+        self.assertFalse(clock.called)
+
+
+class LimiterTestCase(unittest.TestCase):
+    def run_threads(self, limiter, n, delay=0.02):
+        # Threads are queued one after the other, while every slot of the
+        # limiter is held, and return in the order they were let through.
+        active = []
+        order = []
+        peak = [0]
+        lock = threading.Lock()
+
+        def run(i):
+            limiter.acquire()
+            try:
+                with lock:
+                    order.append(i)
+                    active.append(i)
+                    peak[0] = max(peak[0], len(active))
+                time.sleep(delay)
+                with lock:
+                    active.remove(i)
+            finally:
+                limiter.release()
+
+        for i in range(limiter.concurrency):
+            limiter.acquire()
+        threads = []
+        for i in range(n):
+            threads.append(threading.Thread(target=run, args=(i,)))
+            threads[-1].start()
+            while len(limiter._waiters) <= i:
+                time.sleep(0.001)
+        for i in range(limiter.concurrency):
+            limiter.release()
+        for t in threads:
+            t.join()
+        return order, peak[0]
+
+    def test_concurrency(self):
+        order, peak = self.run_threads(Limiter(concurrency=1), 8, delay=0)
+        self.assertEqual(order, list(range(8)))
+        order, peak = self.run_threads(Limiter(concurrency=2, rate=1000), 8)
+        self.assertEqual(peak, 2)
+
+    def test_rate(self):
+        limiter = Limiter(rate=50, burst=2)
+        start = time.monotonic()
+        with ThreadPoolExecutor(6) as executor:
+            waited = list(executor.map(lambda i: limiter.acquire(), range(6)))
+        # Two requests are let through right away, the others 20ms apart.
+        self.assertTrue(time.monotonic() - start >= 0.075)
+        self.assertEqual(sorted(waited)[:2], [0, 0])
+        self.assertTrue(max(waited) >= 0.075)
+
+    def test_fail_fast_and_timeout(self):
+        limiter = Limiter(concurrency=1, block=False)
+        self.assertEqual(limiter.acquire(), 0)
+        self.assertRaises(RateLimitException, limiter.acquire)
+
+        start = time.monotonic()
+        self.assertRaises(RateLimitException, limiter.acquire, True, 0.05)
+        self.assertTrue(time.monotonic() - start >= 0.05)
+        self.assertFalse(limiter._waiters)
+
+        limiter.release()
+        with limiter:
+            self.assertRaises(RateLimitException, limiter.acquire)
+        self.assertEqual(limiter.acquire(), 0)
+
+    def test_threads_and_tasks(self):
+        limiter = Limiter(concurrency=1)
+        order = []
+        limiter.acquire()
+
+        def thread():
+            waited = limiter.acquire()
+            order.append('thread')
+            limiter.release()
+            return waited
+
+        async def main():
+            loop = asyncio.get_running_loop()
+            first = loop.run_in_executor(None, thread)
+            await asyncio.sleep(0.02)
+
+            async def task():
+                waited = await limiter.aacquire()
+                order.append('task')
+                limiter.release()
+                return waited
+
+            second = asyncio.ensure_future(task())
+            await asyncio.sleep(0.02)
+
+            # A cancelled task gives up its place in the queue.
+            cancelled = asyncio.ensure_future(limiter.aacquire())
+            await asyncio.sleep(0.01)
+            cancelled.cancel()
+            limiter.release()
+            return await first, await second
+
+        thread_wait, task_wait = asyncio.run(main())
+        self.assertEqual(order, ['thread', 'task'])
+        self.assertTrue(thread_wait >= 0.04)
+        self.assertTrue(task_wait >= 0.02)
+        self.assertEqual((limiter._active, len(limiter._waiters)), (0, 0))
+
+    def test_registry(self):
+        metrics = Metrics()
+        limiter = Limiter(concurrency=1, block=False)
+        pr = ProviderRegistry(Cache(), transient_error_timeout=60,
+                              metrics=metrics)
+        pr.register(r'http://link\S*', TestProvider('link', limiter=limiter))
+        self.assertEqual(pr.request('http://link-test1')['title'], 'test1')
+        self.assertEqual(asyncio.run(pr.arequest('http://link-test2'))['title'],
+                         'test2')
+
+        # Rejected requests are not cached as failures.
+        limiter.acquire()
+        self.assertRaises(RateLimitException, pr.request,
+                          'http://link-test1', width=100)
+        results = pr.request_many(['http://link-test1', 'http://link-test3'])
+        self.assertTrue(isinstance(results['http://link-test3'],
+                                   RateLimitException))
+        with self.assertRaises(RateLimitException):
+            asyncio.run(pr.arequest('http://link-test3'))
+        limiter.release()
+        self.assertEqual(pr.request('http://link-test1', width=100)['width'],
+                         99)
+        self.assertEqual(limiter._active, 0)
+
+        snapshot = metrics.snapshot()
+        self.assertEqual(snapshot['counters']['rejected'], {'link': 3})
+        self.assertEqual(snapshot['histograms']['queue_wait']['link']['count'],
+                         3)
+
+
+class LRUCacheTestCase(unittest.TestCase):
+    def test_eviction(self):
+        cache = LRUCache(max_size=3)
+        for k in 'abc':
+            cache.set(k, k.upper())
+        self.assertEqual(cache.get('a'), 'A')  # "b" is now least recent.
+        cache.set('d', 'D')
+        self.assertTrue(cache.get('b') is None)
+        self.assertEqual([cache.get(k) for k in 'acd'], ['A', 'C', 'D'])
+
+        # Overwriting a key does not evict anything.
+        cache.set('a', 'A2')
+        self.assertEqual([cache.get(k) for k in 'acd'], ['A2', 'C', 'D'])
+        self.assertEqual(cache.stats(), {'hits': 7, 'misses': 1,
+                                         'evictions': 1, 'size': 3,
+                                         'bytes': 0})
+
+        cache.delete('a')
+        cache.delete('missing')
+        self.assertTrue(cache.get('a') is None)
+        cache.clear()
+        self.assertEqual(cache.stats()['size'], 0)
+
+    def test_max_bytes(self):
+        import pickle
+        value = 'x' * 100
+        size = len(pickle.dumps(value))
+        cache = LRUCache(max_size=100, max_bytes=size * 3)
+        for i in range(5):
+            cache.set(i, value)
+        self.assertEqual(cache.stats()['size'], 3)
+        self.assertEqual(cache.stats()['bytes'], size * 3)
+        self.assertEqual(cache.stats()['evictions'], 2)
+        self.assertEqual([cache.get(i) is None for i in range(5)],
+                         [True, True, False, False, False])
+
+        # A value larger than the limit is not retained at all.
+        cache.set('big', 'x' * (size * 4))
+        self.assertTrue(cache.get('big') is None)
+
+    def test_timeout(self):
+        now = time.time()
+        cache = LRUCache(timeout=10)
+        cache.set('default', 1)
+        cache.set('short', 2, timeout=5)
+        cache.set('long', 3, timeout=60)
+        with mock.patch('micawber.cache.time.time', return_value=now + 7):
+            self.assertEqual([cache.get(k) for k in ('default', 'short',
+                                                     'long')],
+                             [1, None, 3])
+        with mock.patch('micawber.cache.time.time', return_value=now + 30):
+            self.assertEqual([cache.get(k) for k in ('default', 'long')],
+                             [None, 3])
+        stats = cache.stats()
+        self.assertEqual((stats['size'], stats['evictions']), (1, 0))
+
+    def test_registry(self):
+        cache = LRUCache(max_size=2)
+        pr = bootstrap_basic(cache)
+        self.assertTrue(pr.cache is cache)
+        test_pr_lru = ProviderRegistry(cache)
+        test_pr_lru.register(r'http://link\S*', TestProvider('link'))
+        resp = test_pr_lru.request('http://link-test1')
+        self.assertTrue(test_pr_lru.request('http://link-test1') is resp)
+        self.assertEqual(cache.stats()['hits'], 1)
+
+    def test_threads(self):
+        cache = LRUCache(max_size=50)
+        def worker(n):
+            for i in range(500):
+                cache.set((n, i % 80), i)
+                cache.get((n, (i * 7) % 80))
+        threads = [threading.Thread(target=worker, args=(n,))
+                   for n in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(cache.stats()['size'], 50)
+
+
+class TieredCacheTestCase(unittest.TestCase):
+    class CountingCache(Cache):
+        def get(self, k):
+            self.calls.append(k)
+            return super(TieredCacheTestCase.CountingCache, self).get(k)
+
+    def setUp(self):
+        self.l2 = self.CountingCache()
+        self.l2.calls = []
+        self.cache = TieredCache(self.l2, timeout=30)
+
+    def test_read_through(self):
+        self.l2.set('k1', 'v1')
+        self.assertEqual(self.cache.get('k1'), 'v1')
+        self.assertEqual(self.cache.get('k1'), 'v1')
+        self.assertTrue(self.cache.get('k2') is None)
+        self.assertEqual(self.l2.calls, ['k1', 'k2'])
+
+        self.l2.set('k2', 'v2')
+        self.l2.calls = []
+        self.assertEqual(self.cache.get_many(['k1', 'k2', 'k3']),
+                         {'k1': 'v1', 'k2': 'v2'})
+        self.assertEqual(self.l2.calls, ['k2', 'k3'])
+
+        self.l2.calls = []
+        self.assertEqual(asyncio.run(self.cache.aget('k2')), 'v2')
+        self.assertEqual(self.l2.calls, [])
+
+    def test_write_through(self):
+        now = time.time()
+        self.cache.set('k1', 'v1')
+        self.cache.set('k2', 'v2', 10)
+        self.cache.set_many({'k3': 'v3'}, 3600)
+        asyncio.run(self.cache.aset('k4', 'v4'))
+        for k in ('k1', 'k2', 'k3', 'k4'):
+            self.assertEqual(self.l2.get(k), 'v' + k[1])
+            self.assertEqual(self.cache.l1.get(k), 'v' + k[1])
+        self.assertTrue('k2' in self.l2._expires)
+
+        # Entries are kept in the first level for at most its timeout, or
+        # that of the entry if shorter.
+        with mock.patch('micawber.cache.time.time', return_value=now + 11):
+            self.assertTrue(self.cache.l1.get('k2') is None)
+            self.assertEqual(self.cache.l1.get('k3'), 'v3')
+        with mock.patch('micawber.cache.time.time', return_value=now + 31):
+            self.assertTrue(self.cache.l1.get('k3') is None)
+            self.assertEqual(self.cache.get('k3'), 'v3')
+
+        self.cache.delete('k3')
+        self.assertTrue(self.cache.get('k3') is None)
+        self.assertTrue(self.l2.get('k3') is None)
+
+    def test_registry(self):
+        pr = ProviderRegistry(self.cache)
+        pr.register(r'http://link\S*', TestProvider('link'))
+        resp = pr.request('http://link-test1')
+        self.assertEqual(pr.request('http://link-test1'), resp)
+        self.assertEqual(self.l2.calls, [make_key('http://link-test1', {})])
+
+
+class SerializerTestCase(unittest.TestCase):
+    data = {'type': 'rich', 'title': 'test', 'width': 100,
+            'html': '<iframe src="http://example.com/"></iframe>' * 50}
+
+    def test_serializers(self):
+        for name in ('pickle', 'json'):
+            serializer = Serializer(name)
+            data = serializer.dumps(self.data)
+            self.assertEqual(serializer.loads(data), self.data)
+
+        # Uncompressed pickles are stored as they always have been.
+        self.assertEqual(Serializer().dumps(self.data),
+                         pickle.dumps(self.data))
+        json_data = Serializer('json').dumps(self.data)
+        self.assertTrue(json_data.startswith(b'j-{'))
+
+        # Entries are readable whatever the settings they were written with.
+        for serializer in (Serializer(), Serializer('json', 'zlib')):
+            self.assertEqual(serializer.loads(pickle.dumps(self.data)),
+                             self.data)
+            self.assertEqual(serializer.loads(json_data), self.data)
+
+        self.assertRaises(ValueError, Serializer, 'yaml')
+        self.assertRaises(ValueError, Serializer, 'json', 'bz2')
+        self.assertRaises(ValueError, Serializer().loads, b'y-{}')
+
+    def test_compression(self):
+        serializer = Serializer('json', 'zlib', compress_threshold=256)
+        data = serializer.dumps(self.data)
+        self.assertTrue(data.startswith(b'jz'))
+        self.assertTrue(len(data) < len(Serializer('json').dumps(self.data)))
+        self.assertEqual(serializer.loads(data), self.data)
+
+        small = {'type': 'link'}
+        self.assertEqual(serializer.dumps(small), b'j-{"type":"link"}')
+
+        data = Serializer('pickle', 'zlib').dumps(self.data)
+        self.assertTrue(data.startswith(b'pz'))
+        self.assertEqual(Serializer().loads(data), self.data)
+
+
 class PickleCacheTestCase(unittest.TestCase):
     def setUp(self):
         self.tmpdir = tempfile.mkdtemp()
@@ -348,6 +1353,27 @@ class PickleCacheTestCase(unittest.TestCase):
         cache.save()
         self.assertEqual(PickleCache(self.filename).get('key'), 'value')
 
+    def test_timeout(self):
+        now = time.time()
+        cache = PickleCache(self.filename)
+        cache.set('key', 'value', 10)
+        cache.set('expired', 'value', 1)
+        cache.set('forever', 'value')
+        with mock.patch('micawber.cache.time.time', return_value=now + 5):
+            cache.save()
+            cache2 = PickleCache(self.filename)
+            self.assertEqual(sorted(cache2._cache), ['forever', 'key'])
+            self.assertEqual(cache2.get('key'), 'value')
+        with mock.patch('micawber.cache.time.time', return_value=now + 11):
+            self.assertTrue(cache2.get('key') is None)
+            self.assertEqual(cache2.get('forever'), 'value')
+
+    def test_load_unversioned(self):
+        import pickle
+        with open(self.filename, 'wb') as fh:
+            pickle.dump({'key': 'value'}, fh)
+        self.assertEqual(PickleCache(self.filename).get('key'), 'value')
+
     def test_save_load_roundtrip(self):
         cache = PickleCache(self.filename)
         cache.set('key', {'title': 'test', 'type': 'link'})
@@ -360,6 +1386,241 @@ class PickleCacheTestCase(unittest.TestCase):
         self.assertTrue(cache2.get('missing') is None)
 
 
+
+class SqliteCacheTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.filename = os.path.join(self.tmpdir, 'cache.sqlite')
+
+    def get_cache(self, **kwargs):
+        cache = SqliteCache(self.filename, **kwargs)
+        self.addCleanup(cache.close)
+        return cache
+
+    def count(self, cache):
+        return cache.conn.execute('SELECT COUNT(*) FROM cache').fetchone()[0]
+
+    def test_get_set(self):
+        cache = self.get_cache()
+        self.assertTrue(cache.get('key') is None)
+        cache.set('key', {'title': 'test', 'type': 'link'})
+        cache.set('key2', [1, 2, 3])
+        self.assertEqual(cache.get('key'), {'title': 'test', 'type': 'link'})
+
+        # Entries are persisted as they are written.
+        cache2 = self.get_cache()
+        self.assertEqual(cache2.get('key2'), [1, 2, 3])
+        self.assertEqual(cache2.get_many(['key', 'key2', 'key3']),
+                         {'key': {'title': 'test', 'type': 'link'},
+                          'key2': [1, 2, 3]})
+
+        cache2.set_many(dict(('k%s' % i, i) for i in range(1200)))
+        self.assertEqual(len(cache.get_many(['k%s' % i
+                                             for i in range(1200)])), 1200)
+        cache.delete('key')
+        self.assertTrue(cache2.get('key') is None)
+        cache.clear()
+        self.assertEqual(self.count(cache), 0)
+
+    def test_timeout(self):
+        now = time.time()
+        cache = self.get_cache(timeout=60)
+        cache.set('key', 'value', 10)
+        cache.set('default', 'value')
+        cache.set_many({'k1': 'v1', 'k2': 'v2'}, 1)
+        with mock.patch('micawber.cache.time.time', return_value=now + 5):
+            self.assertEqual(cache.get('key'), 'value')
+            self.assertEqual(cache.get_many(['k1', 'key']), {'key': 'value'})
+            cache.purge()
+            self.assertEqual(self.count(cache), 2)
+        with mock.patch('micawber.cache.time.time', return_value=now + 11):
+            self.assertTrue(cache.get('key') is None)
+            self.assertEqual(cache.get('default'), 'value')
+        with mock.patch('micawber.cache.time.time', return_value=now + 61):
+            self.assertTrue(cache.get('default') is None)
+
+    def test_max_size(self):
+        cache = self.get_cache(max_size=3)
+        cache.purge_interval = 4
+        for i in range(4):
+            cache.set('k%s' % i, i)
+        # Purged after the fourth write, evicting the oldest entry.
+        self.assertEqual(self.count(cache), 3)
+        self.assertTrue(cache.get('k0') is None)
+
+        cache.set('k1', 1)
+        cache.set('k4', 4)
+        cache.vacuum()
+        self.assertEqual(cache.get_many(['k%s' % i for i in range(5)]),
+                         {'k1': 1, 'k3': 3, 'k4': 4})
+
+    def test_serializer(self):
+        cache = self.get_cache(serializer='json', compression='zlib')
+        cache.set('key', {'html': 'x' * 2000})
+        value = cache.conn.execute('SELECT value FROM cache').fetchone()[0]
+        self.assertTrue(len(value) < 100)
+        self.assertEqual(cache.get('key'), {'html': 'x' * 2000})
+
+    def test_threads(self):
+        cache = self.get_cache()
+        pr = ProviderRegistry(cache)
+        pr.register(r'http://link\S*', TestProvider('link'))
+
+        def request(i):
+            try:
+                return pr.request('http://link-test%s' % (i % 2 + 1))
+            finally:
+                cache.close()
+
+        with ThreadPoolExecutor(4) as executor:
+            results = list(executor.map(request, range(20)))
+        self.assertEqual(results[0], test_pr.request('http://link-test1'))
+        self.assertEqual(results[1], test_pr.request('http://link-test2'))
+        self.assertEqual(self.count(cache), 2)
+        self.assertEqual(asyncio.run(cache.aget(make_key('http://link-test1',
+                                                         {}))), results[0])
+
+
+
+def warm_registry(cache):
+    # Used by the warm command tests as --providers.
+    pr = ProviderRegistry(cache)
+    pr.register(r'http://link\S*', TestProvider('link'))
+    pr.register(r'http://photo\S*', TestProvider('photo'))
+    return pr
+
+
+class WarmTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+
+    def write(self, filename, content):
+        filename = os.path.join(self.tmpdir, filename)
+        with open(filename, 'w') as fh:
+            fh.write(content)
+        return filename
+
+    def test_urls(self):
+        self.assertEqual(warm.text_urls('a http://link-test1 b\n'
+                                        'http://photo-test2.'),
+                         ['http://link-test1', 'http://photo-test2'])
+        self.assertEqual(warm.html_urls(
+            '<p>http://link-test1</p><p><a href="http://photo-test1">x</a> '
+            'http://photo-test2</p>'),
+            ['http://link-test1', 'http://photo-test2'])
+        self.assertEqual(list(warm.jsonl_urls([
+            '{"body": "see http://link-test1", "n": 1}\n',
+            '\n',
+            '"http://link-test2"\n',
+            '{"html": "<p>http://photo-test1</p><a>http://photo-test2</a>"}',
+        ])), ['http://link-test1', 'http://link-test2', 'http://photo-test1'])
+
+    def test_warm(self):
+        cache = Cache()
+        pr = warm_registry(cache)
+        pr.request('http://link-test2')
+
+        urls = ['http://link-test1', 'http://link-test2', 'http://link-test1',
+                'http://link-missing', 'http://video-test1']
+        state = open(os.path.join(self.tmpdir, 'state'), 'a+')
+        self.addCleanup(state.close)
+        progress = []
+        stats = warm.warm(pr, urls, state=state, progress=progress.append)
+        self.assertEqual(stats, {'urls': 4, 'done': 0, 'skipped': 1,
+                                 'resolved': 2, 'cached': 1, 'failed': 1})
+        self.assertEqual(len(progress), 3)
+        self.assertTrue(pr.metrics is None)
+        self.assertEqual(cache._cache[make_key('http://link-test1', {})],
+                         pr.request('http://link-test1'))
+
+        # Resolved urls are skipped when resuming, failed ones are retried.
+        stats = warm.warm(pr, urls, state=state)
+        self.assertEqual(stats, {'urls': 4, 'done': 2, 'skipped': 1,
+                                 'resolved': 0, 'cached': 0, 'failed': 1})
+        state.seek(0)
+        self.assertEqual(sorted(state.read().split()),
+                         ['http://link-test1', 'http://link-test2'])
+
+        # Parameters are passed along, metrics already set are kept.
+        pr.metrics = Metrics()
+        stats = warm.warm(pr, ['http://link-test1'], width=100)
+        self.assertEqual(stats['resolved'], 1)
+        self.assertEqual(stats['cached'], 0)
+        self.assertEqual(cache._cache[make_key('http://link-test1',
+                                               {'width': 100})]['width'], 99)
+        self.assertEqual(pr.metrics.snapshot()['counters']['misses'],
+                         {'link': 1})
+
+    def test_warm_cache_hits(self):
+        # Cache hits are counted without requests, metrics or throttling.
+        cache = Cache()
+        pr = warm_registry(cache)
+        pr.transient_error_timeout = 60
+        pr.request('http://link-test1')
+        self.assertRaises(ProviderException, pr.request, 'http://link-test3')
+        pr.metrics = Metrics()
+        with mock.patch.object(warm.HostLimiter, 'acquire') as acquire:
+            with mock.patch.object(warm.HostLimiter, 'release'):
+                stats = warm.warm(pr, ['http://link-test1',
+                                       'http://link-test3'])
+        self.assertEqual(stats, {'urls': 2, 'done': 0, 'skipped': 0,
+                                 'resolved': 1, 'cached': 1, 'failed': 1})
+        self.assertFalse(acquire.called)
+        self.assertEqual(pr.metrics.snapshot()['counters'], {})
+
+    def test_host_limiter(self):
+        limiter = warm.HostLimiter(concurrency=2, rate=50)
+        active = []
+        peak = []
+        lock = threading.Lock()
+
+        def run(host):
+            limiter.acquire(host)
+            try:
+                with lock:
+                    active.append(host)
+                    peak.append(active.count(host))
+                time.sleep(0.01)
+                with lock:
+                    active.remove(host)
+            finally:
+                limiter.release(host)
+
+        start = time.monotonic()
+        with ThreadPoolExecutor(8) as executor:
+            list(executor.map(run, ['a'] * 6 + ['b'] * 2))
+        # Six requests to "a" at 50 per second take at least 0.1s.
+        self.assertTrue(time.monotonic() - start >= 0.09)
+        self.assertTrue(max(peak) <= 2)
+
+    def test_main(self):
+        text = self.write('urls.txt', 'http://link-test1\nhttp://video-test1')
+        html = self.write('page.html', '<p>http://photo-test2</p>')
+        jsonl = self.write('docs.jsonl', '{"body": "http://link-test2"}\n')
+        state = os.path.join(self.tmpdir, 'state')
+        filename = os.path.join(self.tmpdir, 'cache.pkl')
+        args = ['warm', text, html, jsonl, '-c', 'pickle:' + filename,
+                '-p', 'micawber.tests.warm_registry', '--state', state, '-q']
+
+        with mock.patch('sys.stdout') as stdout:
+            self.assertEqual(warm.main(args), 0)
+        output = ''.join(c[0][0] for c in stdout.write.call_args_list)
+        self.assertTrue(output.startswith('4 urls: 3 resolved (0 already '
+                                          'cached), 0 failed, 1 without a '
+                                          'provider'), output)
+
+        cache = PickleCache(filename)
+        cache.load()
+        self.assertEqual(len(cache._cache), 3)
+        self.assertEqual(cache._cache[make_key('http://photo-test2', {})],
+                         {'title': 'ptest2', 'url': 'test2.jpg',
+                          'type': 'photo'})
+        with open(state) as fh:
+            self.assertEqual(len(fh.read().split()), 3)
+
+
 @unittest.skipIf(mcflask is None, 'markupsafe/flask is not installed')
 class McFlaskTestCase(BaseTestCase):
     class FakeApp(object):
@@ -423,16 +1684,84 @@ class FakeRedisConn(object):
     def __init__(self):
         self.data = {}
         self.expiry = {}
+        self.calls = []
+        self.subscribers = {}
 
     def get(self, name):
         return self.data.get(name)
 
-    def set(self, name, value, ex=None):
+    def set(self, name, value, ex=None, px=None, nx=False):
         if ex is not None and not isinstance(ex, int):
             raise ValueError('ex must be an integer number of seconds')
+        if nx and name in self.data:
+            return None
         self.data[name] = value
         if ex is not None:
             self.expiry[name] = ex
+        elif px is not None:
+            self.expiry[name] = px / 1000.
+        return True
+
+    def delete(self, name):
+        self.data.pop(name, None)
+
+    def eval(self, script, numkeys, name, token):
+        # The only script used is the compare-and-delete of RedisCache.unlock.
+        if self.data.get(name) == token:
+            self.delete(name)
+            return 1
+        return 0
+
+    def publish(self, channel, message):
+        for handler in list(self.subscribers.get(channel, ())):
+            handler({'type': 'message', 'channel': channel,
+                     'data': message.encode('utf-8')})
+
+    def pubsub(self, ignore_subscribe_messages=False):
+        return FakeRedisPubSub(self)
+
+    def mget(self, names):
+        self.calls.append('mget')
+        return [self.data.get(name) for name in names]
+
+    def pipeline(self, transaction=True):
+        return FakeRedisPipeline(self)
+
+
+class FakeRedisPubSub(object):
+    # Messages are delivered synchronously, rather than from a thread.
+    def __init__(self, conn):
+        self.conn = conn
+        self.handlers = {}
+
+    def subscribe(self, **handlers):
+        self.handlers.update(handlers)
+
+    def run_in_thread(self, sleep_time=0, daemon=False):
+        for channel, handler in self.handlers.items():
+            self.conn.subscribers.setdefault(channel, []).append(handler)
+        return self
+
+    def stop(self):
+        for channel, handler in self.handlers.items():
+            self.conn.subscribers[channel].remove(handler)
+
+
+class FakeRedisPipeline(object):
+    def __init__(self, conn):
+        self.conn = conn
+        self.commands = []
+
+    def __getattr__(self, attr):
+        def queue(*args, **kwargs):
+            self.commands.append((attr, args, kwargs))
+            return self
+        return queue
+
+    def execute(self):
+        self.conn.calls.append('pipeline')
+        return [getattr(self.conn, attr)(*args, **kwargs)
+                for attr, args, kwargs in self.commands]
 
 
 @unittest.skipIf(RedisCache is None, 'redis-py is not installed')
@@ -456,6 +1785,447 @@ class RedisCacheTestCase(unittest.TestCase):
         self.assertEqual(cache.get('key'), {'title': 'test'})
         self.assertEqual(cache.conn.expiry['micawber.key'], 60)
 
+    def test_per_entry_timeout(self):
+        cache = self.get_cache(timeout=60)
+        cache.set('key', {'title': 'test'}, 5.5)
+        cache.set('key2', {'title': 'test'})
+        self.assertEqual(cache.conn.expiry, {'micawber.key': 6,
+                                             'micawber.key2': 60})
+        cache.set_many({'key3': 'v'}, 10)
+        self.assertEqual(cache.conn.expiry['micawber.key3'], 10)
+
+    def test_get_set_many(self):
+        cache = self.get_cache(timeout=60)
+        cache.set_many({'k1': {'title': 't1'}, 'k2': {'title': 't2'}})
+        self.assertEqual(cache.conn.calls, ['pipeline'])
+        self.assertEqual(cache.conn.expiry, {'micawber.k1': 60,
+                                             'micawber.k2': 60})
+        self.assertEqual(cache.get_many(['k1', 'k2', 'k3']),
+                         {'k1': {'title': 't1'}, 'k2': {'title': 't2'}})
+        self.assertEqual(cache.conn.calls, ['pipeline', 'mget'])
+
+    def test_serializer(self):
+        cache = self.get_cache(serializer='json', compression='zlib',
+                               compress_threshold=64)
+        cache.set('small', {'title': 'test'})
+        cache.set('large', {'html': 'x' * 1000})
+        self.assertEqual(cache.conn.data['micawber.small'],
+                         b'j-{"title":"test"}')
+        self.assertTrue(cache.conn.data['micawber.large'].startswith(b'jz'))
+        self.assertTrue(len(cache.conn.data['micawber.large']) < 100)
+        self.assertEqual(cache.get_many(['small', 'large']),
+                         {'small': {'title': 'test'},
+                          'large': {'html': 'x' * 1000}})
+
+        # Existing pickled entries can still be read.
+        cache.conn.data['micawber.old'] = pickle.dumps({'title': 'old'})
+        self.assertEqual(cache.get('old'), {'title': 'old'})
+
+    def test_lock(self):
+        cache = self.get_cache()
+        token = cache.lock('key', 1.5)
+        self.assertTrue(token is not None)
+        self.assertEqual(cache.conn.expiry['micawber.lock.key'], 1.5)
+        self.assertTrue(cache.lock('key', 1.5) is None)
+
+        # Only the holder of the lock can release it.
+        cache.unlock('key', 'other')
+        self.assertTrue(cache.lock('key', 1.5) is None)
+        cache.unlock('key', token)
+        self.assertTrue(cache.lock('key', 1.5) is not None)
+
+    def test_tiered_invalidation(self):
+        cache = self.get_cache()
+        tc1 = TieredCache(cache, channel='invalidate')
+        tc2 = TieredCache(cache, channel='invalidate')
+        self.addCleanup(tc1.close)
+        self.addCleanup(tc2.close)
+
+        tc1.set('k1', 'v1')
+        self.assertEqual(tc2.get('k1'), 'v1')
+        self.assertEqual(tc2.l1.get('k1'), 'v1')
+
+        # Writes in one process evict the entry from the others' first level.
+        tc1.set('k1', 'v2')
+        self.assertTrue(tc2.l1.get('k1') is None)
+        self.assertEqual(tc2.get('k1'), 'v2')
+        self.assertEqual(tc1.l1.get('k1'), 'v2')
+
+        tc2.set_many({'k1': 'v3', 'k2': 'v3'})
+        self.assertEqual(tc1.get_many(['k1', 'k2']), {'k1': 'v3', 'k2': 'v3'})
+        tc1.delete('k2')
+        self.assertTrue(tc2.get('k2') is None)
+
+        tc2.close()
+        tc1.set('k1', 'v4')
+        self.assertEqual(tc2.get('k1'), 'v3')
+
+    def test_registry_lock(self):
+        class CountingProvider(TestProvider):
+            calls = 0
+            def fetch(self, url):
+                self.calls += 1
+                return super(CountingProvider, self).fetch(url)
+
+        cache = self.get_cache()
+        provider = CountingProvider('link')
+        pr = ProviderRegistry(cache, lock_timeout=5)
+        pr.register(r'http://link\S*', provider)
+        pr.lock_poll_interval = 0.01
+        expected = test_pr.request('http://link-test1')
+
+        self.assertEqual(pr.request('http://link-test1'), expected)
+        self.assertEqual(provider.calls, 1)
+        self.assertEqual([k for k in cache.conn.data if 'lock' in k], [])
+
+        # Another process is requesting the url -- its response is used.
+        key = make_key('http://link-test2', {})
+        token = cache.lock(key, 5)
+        with ThreadPoolExecutor(1) as executor:
+            future = executor.submit(pr.request, 'http://link-test2')
+            time.sleep(0.05)
+            self.assertFalse(future.done())
+            cache.set(key, {'title': 'other', 'type': 'link'})
+            self.assertEqual(future.result()['title'], 'other')
+        self.assertEqual(provider.calls, 1)
+
+        # The url is requested once the other process gives up the lock.
+        key = make_key('http://link-test3', {})
+        token = cache.lock(key, 5)
+        with ThreadPoolExecutor(1) as executor:
+            future = executor.submit(pr.request, 'http://link-test3')
+            time.sleep(0.05)
+            cache.unlock(key, token)
+            self.assertRaises(ProviderException, future.result)
+        self.assertEqual(provider.calls, 2)
+
+        # request_many() waits on the locks of other processes alike, and
+        # holds the locks of the urls it requests until they are cached.
+        def held():
+            # Locks taken since the previous requests.
+            return set(k for k in cache.conn.data if '.lock.' in k) - before
+
+        before = set(k for k in cache.conn.data if '.lock.' in k)
+        key = make_key('http://link-test2', {'width': 100})
+        token = cache.lock(key, 5)
+        locks = []
+        fetch = provider.fetch
+
+        def locked_fetch(url):
+            locks.append(held())
+            return fetch(url)
+
+        with mock.patch.object(provider, 'fetch', side_effect=locked_fetch):
+            with ThreadPoolExecutor(1) as executor:
+                future = executor.submit(
+                    pr.request_many, ['http://link-test1', 'http://link-test2'],
+                    width=100)
+                time.sleep(0.05)
+                self.assertFalse(future.done())
+                cache.set(key, {'title': 'other', 'type': 'link'})
+                results = future.result()
+        self.assertEqual(results['http://link-test1']['width'], 99)
+        self.assertEqual(results['http://link-test2']['title'], 'other')
+        self.assertEqual(locks, [set([
+            'micawber.lock.' + key,
+            'micawber.lock.' + make_key('http://link-test1', {'width': 100})])])
+        self.assertEqual(held(), set(['micawber.lock.' + key]))
+
+        # Responses cached by another process just before the lock is taken
+        # are not requested again.
+        lock = cache.lock
+
+        def cached_lock(key, timeout):
+            cache.set(key, {'title': 'other', 'type': 'link'})
+            return lock(key, timeout)
+
+        calls = provider.calls
+        with mock.patch.object(cache, 'lock', side_effect=cached_lock):
+            self.assertEqual(pr.request('http://link-test4')['title'], 'other')
+            results = pr.request_many(['http://link-test5'])
+        self.assertEqual(results['http://link-test5']['title'], 'other')
+        self.assertEqual(provider.calls, calls)
+        self.assertEqual(held(), set(['micawber.lock.' + key]))
+
+
+class OEmbedRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        super(OEmbedRequestHandler, self).setup()
+        self.server.connections += 1
+
+    def do_GET(self):
+        self.server.requests.append(self.path)
+        self.server.request_headers.append(self.headers)
+        if self.path.startswith('/etag'):
+            if self.headers.get('If-None-Match') == '"v1"':
+                self.send_response(304)
+                self.send_header('ETag', '"v1"')
+                self.end_headers()
+                return
+            self.send_json({'type': 'link', 'title': 'etag'}, [
+                ('Cache-Control', 'max-age=60'),
+                ('ETag', '"v1"'),
+                ('Last-Modified', 'Sat, 17 Oct 2026 10:00:00 GMT')])
+            return
+        if self.path.startswith('/redirect'):
+            self.send_response(302)
+            self.send_header('Location', '/oembed?url=redirected')
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        if not self.path.startswith('/oembed'):
+            self.send_error(404)
+            return
+        self.send_json({'type': 'link', 'title': 'local'})
+
+    def send_json(self, data, headers=()):
+        body = json.dumps(data).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        for header, value in headers:
+            self.send_header(header, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class LocalServerTestCase(unittest.TestCase):
+    def setUp(self):
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0),
+                                          OEmbedRequestHandler)
+        self.server.connections = 0
+        self.server.requests = []
+        self.server.request_headers = []
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+
+        self.transport = PooledTransport()
+        self.addCleanup(self.transport.close)
+        self.base = 'http://127.0.0.1:%s' % self.server.server_address[1]
+
+
+class PooledTransportTestCase(LocalServerTestCase):
+    def test_connection_reuse(self):
+        pr = ProviderRegistry()
+        pr.register(r'http://link\S*',
+                    Provider(self.base + '/oembed', transport=self.transport))
+        for i in range(3):
+            resp = pr.request('http://link-test%s' % i)
+            self.assertEqual(resp['title'], 'local')
+
+        self.assertEqual(len(self.server.requests), 3)
+        self.assertEqual(self.server.connections, 1)
+
+    def test_redirect_and_errors(self):
+        body = self.transport.fetch(self.base + '/redirect')
+        self.assertEqual(json.loads(body)['title'], 'local')
+        self.assertEqual(body.status, 200)
+        self.assertEqual(self.server.requests,
+                         ['/redirect', '/oembed?url=redirected'])
+
+        provider = Provider(self.base + '/missing', transport=self.transport)
+        with self.assertRaises(ProviderException) as ctx:
+            provider.request('http://link-test1')
+        self.assertEqual(ctx.exception.__cause__.code, 404)
+
+        provider = Provider('http://127.0.0.1:1/oembed', timeout=1.0,
+                            transport=self.transport)
+        self.assertRaises(ProviderException, provider.request,
+                          'http://link-test1')
+
+    def test_stale_connection(self):
+        self.transport.fetch(self.base + '/oembed')
+        # Close the pooled connection from under the transport, as a server
+        # would after its keep-alive timeout.
+        pool = self.transport._pools[('http', self.base[7:])]
+        pool[0].sock.shutdown(socket.SHUT_RDWR)
+        body = self.transport.fetch(self.base + '/oembed')
+        self.assertEqual(json.loads(body)['title'], 'local')
+
+
+class RevalidationTestCase(LocalServerTestCase):
+    def assertRevalidates(self, transport):
+        cache = Cache()
+        pr = ProviderRegistry(cache, stale_timeout=3600)
+        pr.register(r'http://link\S*',
+                    Provider(self.base + '/etag', transport=transport))
+        expected = {'type': 'link', 'title': 'etag', 'url': 'http://link1'}
+
+        def request_at(offset, expected_requests, fn=pr.request):
+            now = time.time() + offset
+            with mock.patch('micawber.providers.time.time',
+                            return_value=now):
+                with mock.patch('micawber.cache.time.time',
+                                return_value=now):
+                    self.assertEqual(fn('http://link1'), expected)
+            self.assertEqual(len(self.server.requests), expected_requests)
+
+        request_at(0, 1)
+        request_at(30, 1)
+
+        # The response has expired, and is revalidated with the validators
+        # of the original response.
+        request_at(61, 2)
+        headers = self.server.request_headers[-1]
+        self.assertEqual(headers['If-None-Match'], '"v1"')
+        self.assertEqual(headers['If-Modified-Since'],
+                         'Sat, 17 Oct 2026 10:00:00 GMT')
+
+        # The 304 extended the lifetime of the cached response.
+        request_at(100, 2)
+        request_at(125, 3)
+
+        def request_many(url):
+            return pr.request_many([url])[url]
+        request_at(190, 4, request_many)
+        request_at(200, 4, request_many)
+
+        def arequest(url):
+            return asyncio.run(pr.arequest(url))
+        request_at(255, 5, arequest)
+        request_at(260, 5, arequest)
+
+        # Once expired past the stale timeout, the response is requested in
+        # full.
+        cache._cache.clear()
+        request_at(0, 6)
+        self.assertTrue('If-None-Match' not in self.server.request_headers[-1])
+
+    def test_revalidate(self):
+        self.assertRevalidates(None)
+
+    def test_revalidate_pooled(self):
+        transport = PooledTransport()
+        self.addCleanup(transport.close)
+        self.assertRevalidates(transport)
+
+    def test_revalidate_plain_fetch(self):
+        # Providers overriding fetch() without its headers argument are
+        # requested in full instead.
+        class PlainProvider(Provider):
+            def fetch(self, url):
+                return super(PlainProvider, self).fetch(url)
+
+        cache = Cache()
+        pr = ProviderRegistry(cache, stale_timeout=3600)
+        provider = PlainProvider(self.base + '/etag')
+        pr.register(r'http://link\S*', provider)
+        resp = pr.request('http://link1')
+        self.assertEqual(provider.revalidate('http://link1', '"v1"'), resp)
+        with mock.patch('micawber.providers.time.time',
+                        return_value=time.time() + 61):
+            self.assertEqual(pr.request('http://link1'), resp)
+        self.assertEqual(len(self.server.requests), 3)
+        self.assertTrue(all('If-None-Match' not in headers
+                            for headers in self.server.request_headers))
+
+    def test_refresh_error(self):
+        cache = Cache()
+        pr = ProviderRegistry(cache, stale_timeout=3600)
+        provider = Provider(self.base + '/etag')
+        pr.register(r'http://link\S*', provider)
+        resp = pr.request('http://link1')
+
+        # The stale response is served when it cannot be refreshed.
+        provider.endpoint = 'http://127.0.0.1:1/etag'
+        with mock.patch('micawber.providers.time.time',
+                        return_value=time.time() + 61):
+            self.assertEqual(pr.request('http://link1'), resp)
+
+    def test_coalesced_refresh(self):
+        class VersionedProvider(Provider):
+            version = 0
+            released = threading.Event()
+
+            def fetch(self, url, headers=None):
+                self.released.wait(5)
+                self.version += 1
+                headers = Message()
+                headers['Cache-Control'] = 'max-age=60'
+                body = json.dumps({'type': 'link',
+                                   'title': 'v%s' % self.version})
+                return Response(body, 200, headers)
+
+        pr = ProviderRegistry(Cache(), stale_timeout=3600)
+        provider = VersionedProvider('http://oembed')
+        pr.register(r'http://link\S*', provider)
+        provider.released.set()
+        self.assertEqual(pr.request('http://link1')['title'], 'v1')
+
+        # Concurrent requests for an expired response refresh it once.
+        provider.released.clear()
+        with mock.patch('micawber.providers.time.time',
+                        return_value=time.time() + 61):
+            with ThreadPoolExecutor(10) as executor:
+                futures = [executor.submit(pr.request, 'http://link1')
+                           for i in range(9)]
+                futures.append(executor.submit(pr.request_many,
+                                               ['http://link1']))
+                while not pr._inflight:
+                    time.sleep(0.01)
+                time.sleep(0.05)
+                provider.released.set()
+                results = [future.result() for future in futures]
+        self.assertEqual([r['title'] for r in results[:9]], ['v2'] * 9)
+        self.assertEqual(results[9]['http://link1']['title'], 'v2')
+        self.assertEqual(provider.version, 2)
+        self.assertEqual(pr._inflight, {})
+
+    def test_background_refresh(self):
+        class VersionedProvider(Provider):
+            version = 0
+            released = threading.Event()
+
+            def fetch(self, url, headers=None):
+                self.released.wait(5)
+                self.version += 1
+                headers = Message()
+                headers['Cache-Control'] = 'max-age=60'
+                body = json.dumps({'type': 'link',
+                                   'title': 'v%s' % self.version})
+                return Response(body, 200, headers)
+
+        executor = ThreadPoolExecutor(2)
+        self.addCleanup(executor.shutdown)
+        pr = ProviderRegistry(Cache(), stale_timeout=3600,
+                              refresh_executor=executor)
+        provider = VersionedProvider('http://oembed')
+        pr.register(r'http://link\S*', provider)
+        provider.released.set()
+        self.assertEqual(pr.request('http://link1')['title'], 'v1')
+
+        provider.released.clear()
+        with mock.patch('micawber.providers.time.time',
+                        return_value=time.time() + 61):
+            # The expired response is served while it is refreshed, and only
+            # a single refresh is scheduled.
+            for i in range(3):
+                self.assertEqual(pr.request('http://link1')['title'], 'v1')
+            results = pr.request_many(['http://link1'])
+            self.assertEqual(results['http://link1']['title'], 'v1')
+            resp = asyncio.run(pr.arequest('http://link1'))
+            self.assertEqual(resp['title'], 'v1')
+            self.assertEqual(pr._refreshing,
+                             set([make_key('http://link1', {})]))
+
+            provider.released.set()
+            while pr._refreshing:
+                time.sleep(0.01)
+            self.assertEqual(pr.request('http://link1')['title'], 'v2')
+        self.assertEqual(provider.version, 2)
+
+        pr = ProviderRegistry(refresh_executor=1)
+        self.assertTrue(isinstance(pr.refresh_executor, ThreadPoolExecutor))
+        pr.refresh_executor.shutdown()
+
 
 class ParserTestCase(BaseTestCase):
     def test_parse_text_full(self):
@@ -557,6 +2327,62 @@ class ParserTestCase(BaseTestCase):
             parsed = test_pr.parse_html(test_str)
             self.assertHTMLEqual(parsed, frame % (url, expected_inline, expected_inline))
 
+    def test_line_breaks(self):
+        # Lines are split as str.splitlines() splits them, and joined with
+        # "\n".
+        link = self.full_pairs['http://link-test1']
+        inline = self.inline_pairs['http://link-test1']
+        for line_break in ('\n', '\r\n', '\r', '\x0c', '\x1e', '\u2028'):
+            text = (' http://link-test1\t%sa http://link-test1.%s%s'
+                    'http://nope%s' % ((line_break,) * 4))
+            self.assertEqual(test_pr.parse_text(text),
+                             '%s\na %s.\n\n'
+                             '<a href="http://nope">http://nope</a>' % (
+                                 link, inline))
+            self.assertEqual(test_pr.parse_text(text, urlize_all=False,
+                                                block_handler=None),
+                             '%s\na http://link-test1.\n\nhttp://nope' % link)
+        self.assertEqual(test_pr.parse_text('x\x1fhttp://link-test1\x1f'),
+                         'x\x1f%s\x1f' % inline)
+        self.assertEqual(test_pr.parse_text('\x1fhttp://link-test1\x1f'), link)
+        self.assertEqual(test_pr.parse_text(''), '')
+        self.assertEqual(test_pr.parse_text('\n\n'), '\n')
+        # Text without urls is only split into lines.
+        text = 'no links\r\nhere: ftp://x, HTTP://x\n'
+        self.assertEqual(test_pr.parse_text(text),
+                         'no links\nhere: ftp://x, HTTP://x')
+        self.assertEqual(test_pr.parse_text_full(text), text)
+        self.assertEqual(test_pr.extract(text), ([], {}))
+
+    def test_parse_text_stream(self):
+        text = ('http://link-test1\r\nsee http://video-test1 and '
+                'http://link-test1\r\n\nhttp://nope\n http://photo-test2 \n')
+        for window in (1, 2, 3, 10):
+            for lines in (io.StringIO(text, newline=''), text.splitlines(True),
+                          [text[:18], text[18:19], text[19:]], text):
+                chunks = list(test_pr.parse_text_stream(lines, window=window))
+                self.assertEqual(''.join(chunks), test_pr.parse_text(text))
+        self.assertEqual(list(test_pr.parse_text_stream([])), [])
+
+        # The output is produced as the lines are read.
+        def lines():
+            yield 'http://link-test1\n'
+            yield 'http://link-test2\n'
+            raise ValueError
+
+        chunks = test_pr.parse_text_stream(lines(), window=1)
+        self.assertEqual(next(chunks), self.full_pairs['http://link-test1'])
+        self.assertEqual(next(chunks), '\n')
+        self.assertEqual(next(chunks), test_pr.parse_text('http://link-test2'))
+        self.assertRaises(ValueError, next, chunks)
+
+        # Requests are collapsed within a window.
+        with mock.patch.object(TestProvider, 'fetch', autospec=True,
+                               side_effect=TestProvider.fetch) as fetch:
+            list(test_pr.parse_text_stream(['http://link-test1\n'] * 4,
+                                           window=2))
+        self.assertEqual(fetch.call_count, 2)
+
     def test_multiline_full(self):
         for url, expected in self.full_pairs.items():
             frame = 'this is inline: %s\n%s\nand yet another %s'
@@ -635,6 +2461,156 @@ class ParserTestCase(BaseTestCase):
         assertFetches(2, pr.parse_text,
                       'http://link-test1\nhttp://link-test2')
 
+    def test_render_cache(self):
+        cache = Cache()
+        render_cache = Cache()
+        pr = ProviderRegistry(cache, render_cache=render_cache)
+        pr.register(r'http://link\S*', TestProvider('link'))
+        pr.register(r'http://photo\S*', TestProvider('photo'))
+        text = 'http://link-test1\nsee http://photo-test2 and http://nope'
+        html = '<p>http://link-test1</p><p>see http://photo-test2</p>'
+        expected = test_pr.parse_text(text)
+        expected_html = test_pr.parse_html(html)
+
+        def render(fn, text, **kwargs):
+            original = getattr(micawber.providers, fn)
+            with mock.patch('micawber.providers.%s' % fn, autospec=True,
+                            side_effect=original) as parse:
+                output = getattr(pr, fn)(text, **kwargs)
+            return output, parse.call_count
+
+        self.assertEqual(render('parse_text', text), (expected, 1))
+        self.assertEqual(render('parse_text', text), (expected, 0))
+        self.assertEqual(render('parse_html', html), (expected_html, 1))
+        self.assertEqual(render('parse_html', html), (expected_html, 0))
+
+        # The parser options are part of the key.
+        self.assertEqual(render('parse_text', text, handler=inline_handler),
+                         (test_pr.parse_text(text, handler=inline_handler), 1))
+        self.assertEqual(render('parse_text', text, handler=inline_handler),
+                         (test_pr.parse_text(text, handler=inline_handler), 0))
+        self.assertEqual(render('parse_text', text, maxwidth=100)[1], 1)
+        self.assertEqual(render('parse_text_full', text)[1], 1)
+        self.assertEqual(render('parse_text_full', text)[1], 0)
+
+        # Output is rendered again when a response it embeds has changed.
+        key = make_key('http://photo-test2', {})
+        cache.set(key, dict(cache.get(key), title='changed'))
+        output, calls = render('parse_text', text)
+        self.assertEqual(calls, 1)
+        self.assertTrue('title="changed"' in output)
+        self.assertEqual(render('parse_text', text), (output, 0))
+
+        cache._cache.clear()
+        self.assertEqual(render('parse_text', text), (expected, 1))
+
+        # Or when the providers have changed.
+        version = pr.version
+        pr.register(r'http://nope\S*', TestProvider('link'))
+        self.assertNotEqual(pr.version, version)
+        self.assertEqual(render('parse_text', text)[1], 1)
+        pr.unregister(r'http://nope\S*')
+        self.assertEqual(pr.version, version)
+        self.assertEqual(render('parse_text', text), (expected, 0))
+
+    def test_render_cache_uncacheable(self):
+        pr = ProviderRegistry(render_cache=Cache())
+        provider = TestProvider('link')
+        pr.register(r'http://link\S*', provider)
+
+        def prefixed(prefix):
+            def handler(url, response_data, **params):
+                return prefix + response_data['title']
+            return handler
+
+        def handler(url, response_data, prefix='', **params):
+            return prefix + response_data['title']
+
+        class Handler(object):
+            def __init__(self, prefix):
+                self.prefix = prefix
+            def __call__(self, url, response_data, **params):
+                return self.prefix + response_data['title']
+            def render(self, url, response_data, **params):
+                return self(url, response_data)
+
+        # Callables which their name does not identify are never cached.
+        for make_handler in (prefixed, Handler,
+                             lambda prefix: Handler(prefix).render,
+                             lambda prefix: functools.partial(handler,
+                                                              prefix=prefix),
+                             lambda prefix: lambda url, data, **params:
+                                 prefix + data['title']):
+            for prefix in ('A:', 'B:'):
+                self.assertEqual(pr.parse_text('http://link-test1',
+                                               handler=make_handler(prefix)),
+                                 prefix + 'test1')
+        self.assertEqual(pr.render_cache._cache, {})
+
+        # Nor is output rendered while a provider was failing.
+        with mock.patch.object(provider, 'fetch', return_value=False):
+            self.assertEqual(pr.parse_text('http://link-test1'),
+                             '<a href="http://link-test1">http://link-test1</a>')
+        self.assertEqual(pr.render_cache._cache, {})
+        self.assertEqual(pr.parse_text('http://link-test1'),
+                         self.full_pairs['http://link-test1'])
+        self.assertEqual(len(pr.render_cache._cache), 1)
+
+        # Urls without a provider are no failure.
+        pr.render_cache._cache.clear()
+        pr.parse_text('http://nope')
+        self.assertEqual(len(pr.render_cache._cache), 1)
+
+    def test_prefetch(self):
+        class BarrierProvider(TestProvider):
+            # Each fetch waits for the others, so the urls must be fetched
+            # concurrently for any of them to succeed.
+            barrier = None
+            def fetch(self, url):
+                self.barrier.wait()
+                return super(BarrierProvider, self).fetch(url)
+
+        pr = ProviderRegistry()
+        pr.register(r'http://link\S*', BarrierProvider('link'))
+        pr.register(r'http://video\S*', BarrierProvider('video'))
+        pr.register(r'http://rich\S*', BarrierProvider('rich'))
+
+        def run(fn, text, **kwargs):
+            BarrierProvider.barrier = threading.Barrier(1)
+            expected = fn(text, **kwargs)
+            BarrierProvider.barrier = threading.Barrier(3, timeout=5)
+            self.assertEqual(fn(text, prefetch=4, **kwargs), expected)
+            BarrierProvider.barrier = threading.Barrier(3, timeout=5)
+            with ThreadPoolExecutor(max_workers=3) as executor:
+                self.assertEqual(fn(text, prefetch=executor, **kwargs),
+                                 expected)
+            return expected
+
+        text = ('http://link-test1\nsee http://video-test1 and '
+                'http://link-test1\nhttp://rich-test2\nhttp://fapp.io/')
+        parsed = run(pr.parse_text, text)
+        self.assertEqual(parsed, '\n'.join((
+            self.full_pairs['http://link-test1'],
+            'see %s and %s' % (self.inline_pairs['http://video-test1'],
+                               self.inline_pairs['http://link-test1']),
+            self.full_pairs['http://rich-test2'],
+            '<a href="http://fapp.io/">http://fapp.io/</a>')))
+        run(pr.parse_text_full, text)
+        run(lambda text, **kwargs: ''.join(pr.parse_text_stream(
+            text.splitlines(True), **kwargs)), text + '\n')
+
+        urls, extracted = run(pr.extract, text)
+        self.assertEqual(sorted(extracted), ['http://link-test1',
+                                             'http://rich-test2',
+                                             'http://video-test1'])
+
+        html = ('<p>http://link-test1</p><p>see http://video-test1</p>'
+                '<a href="#">http://link-test2</a><p>http://rich-test2</p>')
+        run(pr.parse_html, html)
+        urls, extracted = run(pr.extract_html, html)
+        self.assertEqual(urls, ['http://link-test1', 'http://video-test1',
+                                'http://rich-test2'])
+
     def test_replacement_backslash(self):
         # Replacements must be inserted literally, without backslash-escape
         # processing.
@@ -757,6 +2733,157 @@ class TestHTMLEntities(BaseTestCase):
             '<a href="http://baze.com">http://baze.com</a>\n'
             '&lt;foo&gt;</p>'))
 
+class HTMLEngineTestCase(BaseTestCase):
+    def assertEngines(self, html, engine='stream', **kwargs):
+        # The engines find the same urls and render them the same way.
+        expected = test_pr.parse_html(html, engine='soup', **kwargs)
+        parsed = test_pr.parse_html(html, engine=engine, **kwargs)
+        self.assertHTMLEqual(parsed, expected)
+        self.assertEqual(test_pr.extract_html(html, engine=engine),
+                         test_pr.extract_html(html, engine='soup'))
+        return parsed
+
+    @unittest.skipIf(BeautifulSoup is None, 'beautifulsoup4 is not installed')
+    def test_engines(self):
+        for url in self.full_pairs:
+            for frame in ('<p>%s</p>', '%s<p>testing</p>',
+                          '<div><p>see %s</p><p>\n%s\n</p></div>',
+                          '<p><a href="#foo">%s</a></p><span>%s</span>',
+                          '<ul><li>%s<br>%s</li></ul>',
+                          '<p>http://link-test1 %s</p><!-- %s -->',
+                          '<p><b>%s</p>%s</b>', '<p>%s &amp; %s</p>',
+                          '<pre>%s</pre><p>%s</p>',
+                          '<p><input>%s</p><p><br/>%s<img src="x"></p>'):
+                html = frame % ((url,) * frame.count('%s'))
+                for kwargs in ({}, {'urlize_all': False},
+                               {'block_handler': full_handler}):
+                    self.assertEngines(html, **kwargs)
+                    if lxml_html is not None:
+                        self.assertEngines(html, 'lxml', **kwargs)
+
+    @unittest.skipIf(BeautifulSoup is None, 'beautifulsoup4 is not installed')
+    def test_markup_preserved(self):
+        # Only the text nodes containing urls are rewritten, the rest of the
+        # markup is output as-is.
+        html = ('<!DOCTYPE html>\r\n<P CLASS=x>http://link-test1</P>'
+                '<br><img src="http://photo-test2">&nbsp;&copy; '
+                '<p>http://nope?a=1&amp;b=2 &lt;x&gt;</p></div>')
+        self.assertEqual(
+            self.assertEngines(html),
+            '<!DOCTYPE html>\r\n<P CLASS=x>%s</P>'
+            '<br><img src="http://photo-test2">&nbsp;&copy; '
+            '<p><a href="http://nope?a=1&amp;b=2">http://nope?a=1&amp;b=2</a>'
+            ' &lt;x&gt;</p></div>' % self.full_pairs['http://link-test1'])
+
+        for frame in ('<script>var u = "%s";</script>',
+                      '<style>body { background: url(%s) }</style>',
+                      '<svg><text>%s</text></svg>', '<title>%s</title>',
+                      '<textarea>%s</textarea>', '<!-- %s -->'):
+            html = frame % 'http://link-test1'
+            self.assertEqual(test_pr.parse_html(html, engine='stream'), html)
+
+    def test_engine(self):
+        with mock.patch('micawber.parsers.BeautifulSoup', None):
+            self.assertEqual(parse_html('<p>http://link-test1</p>', test_pr,
+                                        soup_class=None),
+                             '<p>%s</p>' % self.full_pairs['http://link-test1'])
+        self.assertRaises(ValueError, test_pr.parse_html, '', engine='tree')
+
+        # Without lxml, its engine falls back to the default one.
+        html = ('<p>http://link-test1</p>\n<p>see <b>http://video-test1</b>'
+                '<br> http://nope</p>')
+        with mock.patch('micawber.parsers.lxml_html', None):
+            self.assertEqual(test_pr.parse_html(html, engine='lxml'),
+                             test_pr.parse_html(html))
+            self.assertEqual(test_pr.extract_html(html, engine='lxml'),
+                             test_pr.extract_html(html))
+
+        html = '<p>http://link-test1</p><p>see http://video-test1</p>'
+        self.assertEqual(
+            asyncio.run(test_pr.aparse_html(html, engine='stream')),
+            test_pr.parse_html(html, engine='stream'))
+        self.assertEqual(
+            asyncio.run(test_pr.aextract_html(html, engine='stream')),
+            test_pr.extract_html(html))
+
+    @unittest.skipIf(BeautifulSoup is None, 'beautifulsoup4 is not installed')
+    def test_without_urls(self):
+        # Markup which cannot contain urls is not parsed, whatever the engine,
+        # and is returned as it was given.
+        html = '<p>a &amp; b<br><img src=x></p><div>no links'
+        with mock.patch('micawber.parsers._parse_soup') as parse_soup:
+            for engine in html_engines + (None,):
+                self.assertEqual(test_pr.parse_html(html, engine=engine), html)
+                self.assertEqual(test_pr.extract_html(html, engine=engine),
+                                 ([], {}))
+        self.assertFalse(parse_soup.called)
+
+        # The letters of urls may be written as character references.
+        html = '<p>&#104;ttp://link-test1</p>'
+        for engine in html_engines:
+            self.assertEqual(test_pr.parse_html(html, engine=engine),
+                             '<p>%s</p>' % self.full_pairs['http://link-test1'])
+
+    @unittest.skipIf(BeautifulSoup is None, 'beautifulsoup4 is not installed')
+    @unittest.skipIf(lxml_html is None, 'lxml is not installed')
+    def test_lxml(self):
+        link = self.full_pairs['http://link-test1']
+        html = ('<!DOCTYPE html>\n<html><head><title>http://link-test1</title>'
+                '</head><body><p>http://link-test1</p>'
+                '<p>x &amp; http://nope <i>\ue0000\ue000</i></p></body></html>')
+        self.assertEqual(
+            self.assertEngines(html, 'lxml'),
+            '<!DOCTYPE html>\n<html><head><title>http://link-test1</title>'
+            '</head><body><p>%s</p><p>x &amp; <a href="http://nope">'
+            'http://nope</a> <i>\ue0000\ue000</i></p></body></html>' % link)
+
+        html = 'http://link-test1<p>a http://link-test1</p> b'
+        self.assertEqual(self.assertEngines(html, 'lxml'),
+                         '%s<p>a %s</p> b' % (
+                             link, self.inline_pairs['http://link-test1']))
+
+        # Markup without urls is returned as-is.
+        for html in ('', ' ', '<p>x<br></p>'):
+            self.assertEqual(test_pr.parse_html(html, engine='lxml'), html)
+
+    @unittest.skipIf(lxml_html is None, 'lxml is not installed')
+    def test_lxml_documents(self):
+        full = '<p>%s</p>' % self.full_pairs['http://link-test1']
+        body = '<body><p>http://link-test1</p></body>'
+
+        # Placeholders written as character references are left alone.
+        for n in ('0', '7'):
+            html = '<p>http://link-test1</p><p>&#xe000;%s&#xe000;</p>' % n
+            self.assertEqual(test_pr.parse_html(html, engine='lxml'),
+                             '%s<p>%s</p>' % (full, n))
+
+        # Whatever precedes or follows the document is kept.
+        for prologue in ('<!-- c -->', '<?xml version="1.0"?>\n',
+                         '<!DOCTYPE html>\n<!-- c -->\n'):
+            html = '%s<html>%s</html>' % (prologue, body)
+            self.assertEqual(test_pr.parse_html(html, engine='lxml'),
+                             '%s<html><body>%s</body></html>' % (prologue, full))
+        html = '<html>%s</html>\n<p>http://link-test1</p><!-- c -->' % body
+        self.assertEqual(test_pr.parse_html(html, engine='lxml'),
+                         '<html><body>%s</body></html>\n%s<!-- c -->' % (
+                             full, full))
+
+        self.assertEqual(test_pr.parse_html('\x0c %s' % body[6:-7],
+                                            engine='lxml'), '\x0c %s' % full)
+        self.assertEqual(test_pr.parse_html(body, engine='lxml'),
+                         '<html><body>%s</body></html>' % full)
+        self.assertEqual(
+            test_pr.parse_html('<!DOCTYPE html>\nhttp://link-test1',
+                               engine='lxml'),
+            '<!DOCTYPE html>\n<html><body>%s</body></html>' %
+            self.full_pairs['http://link-test1'])
+
+        # Markup libxml2 refuses falls back to the default engine.
+        html = 'http://link-test1\x0c'
+        self.assertEqual(test_pr.parse_html(html, engine='lxml'),
+                         test_pr.parse_html(html))
+
+
 class GoogleMapsProviderTestCase(unittest.TestCase):
     def test_query_param_without_equals(self):
         p = GoogleMapsProvider('')
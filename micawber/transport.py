@@ -0,0 +1,149 @@
+import http.client
+import io
+import socket
+import ssl
+import threading
+
+from urllib.error import HTTPError
+from urllib.error import URLError
+from urllib.parse import urljoin
+from urllib.parse import urlsplit
+
+
+class Response(str):
+    """
+    The decoded body of an HTTP response, additionally carrying the status
+    code and headers of the response it was read from.
+    """
+    def __new__(cls, body, status=200, headers=None):
+        response = super(Response, cls).__new__(cls, body)
+        response.status = status
+        response.headers = headers
+        return response
+
+
+def decode_body(body, headers):
+    # oEmbed responses are JSON, for which the default charset is UTF-8
+    # (RFC 8259) -- many providers omit the charset parameter entirely.
+    charset = headers.get_param('charset') or 'utf-8'
+    return body.decode(charset)
+
+
+class Transport(object):
+    """
+    Interface for the HTTP transport used by a :py:class:`Provider`. Errors
+    are reported the same way ``urlopen`` reports them: ``HTTPError`` for a
+    non-2xx response, ``URLError`` or ``socket.timeout`` otherwise.
+    """
+    def fetch(self, url, headers=None, timeout=None):
+        raise NotImplementedError
+
+
+class PooledTransport(Transport):
+    """
+    Transport which keeps persistent (keep-alive) connections open to each
+    host, so that repeated requests to the same provider do not pay for a DNS
+    lookup and TCP/TLS handshake every time. Safe to share between threads.
+
+    :param int maxsize: maximum number of idle connections kept per host.
+        Requests beyond this many concurrent requests to a single host are
+        still made, but their connections are closed afterwards.
+    :param int max_redirects: maximum number of redirects to follow.
+    :param ssl_context: ``ssl.SSLContext`` used for https connections.
+    """
+    redirect_codes = (301, 302, 303, 307, 308)
+
+    def __init__(self, maxsize=4, max_redirects=5, ssl_context=None):
+        self.maxsize = maxsize
+        self.max_redirects = max_redirects
+        self.ssl_context = ssl_context or ssl.create_default_context()
+        self._pools = {}
+        self._lock = threading.Lock()
+
+    def connect(self, scheme, netloc, timeout=None):
+        kwargs = {}
+        if timeout:
+            kwargs['timeout'] = timeout
+        if scheme == 'https':
+            return http.client.HTTPSConnection(netloc,
+                                               context=self.ssl_context,
+                                               **kwargs)
+        return http.client.HTTPConnection(netloc, **kwargs)
+
+    def acquire(self, scheme, netloc, timeout=None):
+        # Returns a connection and a flag indicating whether the connection
+        # was reused from the pool.
+        with self._lock:
+            pool = self._pools.get((scheme, netloc))
+            conn = pool.pop() if pool else None
+
+        if conn is None:
+            return self.connect(scheme, netloc, timeout), False
+
+        conn.timeout = timeout or socket.getdefaulttimeout()
+        if conn.sock is not None:
+            conn.sock.settimeout(conn.timeout)
+        return conn, True
+
+    def release(self, scheme, netloc, conn):
+        with self._lock:
+            pool = self._pools.setdefault((scheme, netloc), [])
+            if len(pool) < self.maxsize:
+                pool.append(conn)
+                return
+        conn.close()
+
+    def close(self):
+        with self._lock:
+            pools, self._pools = self._pools, {}
+        for pool in pools.values():
+            for conn in pool:
+                conn.close()
+
+    def request(self, url, headers=None, timeout=None):
+        parts = urlsplit(url)
+        if parts.scheme not in ('http', 'https'):
+            raise URLError('unsupported url scheme "%s"' % parts.scheme)
+
+        path = parts.path or '/'
+        if parts.query:
+            path = '%s?%s' % (path, parts.query)
+
+        while True:
+            conn, reused = self.acquire(parts.scheme, parts.netloc, timeout)
+            try:
+                conn.request('GET', path, headers=headers or {})
+                resp = conn.getresponse()
+                body = resp.read()
+            except socket.timeout:
+                conn.close()
+                raise
+            except (http.client.HTTPException, OSError) as exc:
+                conn.close()
+                # The server may have closed an idle keep-alive connection in
+                # the meantime, in which case the request is retried.
+                if reused and isinstance(exc, (ConnectionError,
+                                               http.client.BadStatusLine)):
+                    continue
+                raise URLError(exc) from exc
+
+            if resp.will_close:
+                conn.close()
+            else:
+                self.release(parts.scheme, parts.netloc, conn)
+            return resp, body
+
+    def fetch(self, url, headers=None, timeout=None):
+        for _ in range(self.max_redirects + 1):
+            resp, body = self.request(url, headers, timeout)
+            location = resp.headers.get('Location')
+            if resp.status not in self.redirect_codes or not location:
+                break
+            url = urljoin(url, location)
+
+        if not 200 <= resp.status < 300:
+            raise HTTPError(url, resp.status, resp.reason, resp.headers,
+                            io.BytesIO(body))
+
+        return Response(decode_body(body, resp.headers), resp.status,
+                        resp.headers)
@@ -0,0 +1,294 @@
+"""
+Pre-resolve the urls found in a corpus of documents, storing the responses in
+the registry's cache. See ``python -m micawber warm --help``.
+"""
+import json
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit
+
+from micawber.exceptions import ProviderException
+from micawber.limiter import Limiter
+from micawber.parsers import _node_urls
+from micawber.parsers import _parse_markup
+from micawber.parsers import url_re
+from micawber.providers import _is_entry
+from micawber.providers import error_key
+from micawber.providers import make_key
+
+
+def text_urls(text):
+    # The urls extract() would request.
+    return url_re.findall(text)
+
+
+def html_urls(html):
+    # The urls extract_html() would request.
+    engine, document, nodes, texts = _parse_markup(html, None)
+    return _node_urls(texts)
+
+
+def jsonl_urls(lines):
+    # Urls in the string values of each JSON document, parsed as html when
+    # the document has an "html" field.
+    for line in lines:
+        line = line.strip()
+        if not line:
+            continue
+        document = json.loads(line)
+        if not isinstance(document, dict):
+            document = {None: document}
+        for key, value in document.items():
+            if isinstance(value, str):
+                if key == 'html':
+                    yield from html_urls(value)
+                else:
+                    yield from text_urls(value)
+
+
+def guess_format(filename):
+    if filename.endswith(('.html', '.htm')):
+        return 'html'
+    elif filename.endswith(('.jsonl', '.ndjson')):
+        return 'jsonl'
+    return 'text'
+
+
+def read_urls(fh, format='text'):
+    if format == 'html':
+        return html_urls(fh.read())
+    elif format == 'jsonl':
+        return jsonl_urls(fh)
+    return text_urls(fh.read())
+
+
+def cached(registry, url, params):
+    # How request() would answer from the cache, without a request being
+    # made: "resolved" for a response which has not expired, "failed" for a
+    # cached failure, else None.
+    cache = registry.cache
+    if cache is None:
+        return None
+    key = make_key(registry.canonical_url(url), params)
+    value = cache.get(key)
+    if value is not None:
+        if not _is_entry(value) or value['expires'] > time.time():
+            return 'resolved'
+    elif registry.caches_errors:
+        entry = cache.get(error_key(key))
+        if entry is not None and entry['expires'] > time.time():
+            return 'failed'
+    return None
+
+
+class HostLimiter(object):
+    """
+    Limits the requests made to each host to at most ``concurrency`` at a
+    time, and at most ``rate`` per second, using a Limiter for each host.
+    """
+    def __init__(self, concurrency=None, rate=None):
+        self.concurrency = concurrency
+        self.rate = rate
+        self._lock = threading.Lock()
+        self._limiters = {}
+
+    def limiter(self, host):
+        with self._lock:
+            limiter = self._limiters.get(host)
+            if limiter is None:
+                limiter = self._limiters[host] = Limiter(self.concurrency,
+                                                         self.rate)
+            return limiter
+
+    def acquire(self, host):
+        return self.limiter(host).acquire()
+
+    def release(self, host):
+        self.limiter(host).release()
+
+
+def warm(registry, urls, workers=8, per_host=None, rate=None, state=None,
+         progress=None, **params):
+    """
+    Request the given urls, storing the responses in the registry's cache.
+    Urls without a provider are skipped. Returns a dict of statistics.
+
+    :param registry: a ProviderRegistry, usually one with a cache.
+    :param urls: iterable of urls.
+    :param int workers: number of concurrent requests.
+    :param int per_host: maximum concurrent requests to each provider host.
+    :param float rate: maximum requests per second to each provider host.
+    :param state: file object listing the urls done already, one per line.
+        Completed urls are appended to it, so that an interrupted run can be
+        resumed.
+    :param progress: function called with the statistics after each url.
+    :param params: parameters for the requests, e.g. maxwidth.
+    """
+    done = set()
+    if state is not None:
+        state.seek(0)
+        done.update(line.strip() for line in state)
+
+    stats = {'urls': 0, 'done': 0, 'skipped': 0, 'resolved': 0, 'cached': 0,
+             'failed': 0}
+    pending = []
+    for url in dict.fromkeys(urls):
+        stats['urls'] += 1
+        if url in done:
+            stats['done'] += 1
+        elif registry.provider_for_url(url) is None:
+            stats['skipped'] += 1
+        else:
+            pending.append(url)
+
+    limiter = HostLimiter(per_host, rate)
+    lock = threading.Lock()
+
+    def resolve(url):
+        # Only requests to the provider are throttled, not cache hits.
+        key = cached(registry, url, params)
+        hit = key is not None
+        if not hit:
+            provider = registry.provider_for_url(url)
+            host = urlsplit(getattr(provider, 'endpoint', '') or url).netloc
+            limiter.acquire(host)
+            try:
+                registry.request(url, **params)
+            except ProviderException:
+                key = 'failed'
+            else:
+                key = 'resolved'
+            finally:
+                limiter.release(host)
+
+        with lock:
+            stats[key] += 1
+            if hit and key == 'resolved':
+                stats['cached'] += 1
+            if state is not None and key == 'resolved':
+                state.write(url + '\n')
+                state.flush()
+            if progress is not None:
+                progress(dict(stats))
+
+    with ThreadPoolExecutor(workers) as executor:
+        list(executor.map(resolve, pending))
+    return stats
+
+
+def _import(path):
+    module, _, name = path.rpartition('.')
+    return getattr(__import__(module, fromlist=[name]), name)
+
+
+def get_cache(spec):
+    """
+    Cache given on the command line: "sqlite:PATH", "pickle:PATH",
+    "redis://HOST[:PORT][/DB]" or the dotted path of a cache instance or of a
+    function returning one.
+    """
+    from micawber import cache
+    if spec.startswith('sqlite:'):
+        return cache.SqliteCache(spec[7:])
+    elif spec.startswith('pickle:'):
+        return cache.PickleCache(spec[7:])
+    elif spec.startswith('redis://'):
+        parts = urlsplit(spec)
+        db = parts.path.strip('/')
+        return cache.RedisCache(host=parts.hostname or 'localhost',
+                                port=parts.port or 6379,
+                                db=int(db) if db else 0)
+    obj = _import(spec)
+    return obj() if callable(obj) else obj
+
+
+def main(argv=None):
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        prog='python -m micawber',
+        description='Tools for working with micawber.')
+    commands = parser.add_subparsers(dest='command')
+    warm_parser = commands.add_parser(
+        'warm', help='resolve the urls found in documents into the cache')
+    warm_parser.add_argument(
+        'files', nargs='+', metavar='FILE',
+        help='documents or url lists to read urls from, "-" for stdin')
+    warm_parser.add_argument(
+        '-f', '--format', choices=('auto', 'text', 'html', 'jsonl'),
+        default='auto', help='format of the files, by default guessed from '
+        'their extension')
+    warm_parser.add_argument(
+        '-p', '--providers', default='micawber.providers.bootstrap_basic',
+        help='dotted path of the function setting up the provider registry, '
+        'called with the cache (default: %(default)s)')
+    warm_parser.add_argument(
+        '-c', '--cache', required=True,
+        help='cache to warm: sqlite:PATH, pickle:PATH, '
+        'redis://HOST[:PORT][/DB] or the dotted path of a cache')
+    warm_parser.add_argument(
+        '-w', '--workers', type=int, default=8,
+        help='number of concurrent requests (default: %(default)s)')
+    warm_parser.add_argument(
+        '--per-host', type=int, default=2,
+        help='maximum concurrent requests to each provider '
+        '(default: %(default)s)')
+    warm_parser.add_argument(
+        '--rate', type=float, default=None,
+        help='maximum requests per second to each provider')
+    warm_parser.add_argument(
+        '--state', metavar='FILE',
+        help='file recording the urls resolved, used to resume an '
+        'interrupted run')
+    warm_parser.add_argument('--maxwidth', type=int)
+    warm_parser.add_argument('--maxheight', type=int)
+    warm_parser.add_argument(
+        '-q', '--quiet', action='store_true', help='do not report progress')
+
+    args = parser.parse_args(argv)
+    if args.command != 'warm':
+        parser.print_help()
+        return 2
+
+    cache = get_cache(args.cache)
+    registry = _import(args.providers)(cache)
+
+    urls = []
+    for filename in args.files:
+        format = args.format
+        if format == 'auto':
+            format = guess_format(filename)
+        if filename == '-':
+            urls.extend(read_urls(sys.stdin, format))
+        else:
+            with open(filename) as fh:
+                urls.extend(read_urls(fh, format))
+
+    params = {}
+    if args.maxwidth:
+        params['maxwidth'] = args.maxwidth
+    if args.maxheight:
+        params['maxheight'] = args.maxheight
+
+    def progress(stats):
+        sys.stderr.write('\r%(resolved)s resolved, %(failed)s failed' % stats)
+        sys.stderr.flush()
+
+    state = open(args.state, 'a+') if args.state else None
+    try:
+        stats = warm(registry, urls, args.workers, args.per_host, args.rate,
+                     state, None if args.quiet else progress, **params)
+    finally:
+        if state is not None:
+            state.close()
+        if hasattr(cache, 'save'):
+            cache.save()
+
+    if not args.quiet:
+        sys.stderr.write('\n')
+    print('%(urls)s urls: %(resolved)s resolved (%(cached)s already cached), '
+          '%(failed)s failed, %(skipped)s without a provider, %(done)s done '
+          'in a previous run' % stats)
+    return 0